@@ -4,7 +4,9 @@ import os
 import time
 
 import modal
-from typing_extensions import List
+from typing_extensions import List, Tuple
+
+from ranker_batching import MicroBatcher
 
 MODEL_NAME = "akariasai/ranker_large"
 MODEL_DIR = f"/root/models/{MODEL_NAME}"
@@ -13,6 +15,12 @@ GPU_CONFIG = "T4:1"
 APP_NAME = "akariasai-ranker-large-update"
 APP_LABEL = APP_NAME.lower()
 
+# Pairs of concurrent requests which arrive within BATCH_WINDOW seconds are scored together, see ranker_batching.py
+BATCH_WINDOW = 0.01
+MAX_BATCH_PAIRS = 512
+MODEL_BATCH_SIZE = 32
+MAX_PAIR_LENGTH = 512
+
 
 # ## Define a container image
 #
@@ -71,6 +79,7 @@ reranker_image = (
             "model_name": MODEL_NAME,
         },
     )
+    .add_local_python_source("ranker_batching")
 )
 
 with reranker_image.imports():
@@ -102,15 +111,29 @@ class Model:
         start = time.monotonic_ns()
 
         self.reranker = FlagReranker(MODEL_DIR, use_fp16=True)
+        # the concurrent inputs of the container share the GPU through a single batcher
+        self.batcher = MicroBatcher(self.score_pairs, self.pair_lengths, BATCH_WINDOW, MAX_BATCH_PAIRS)
 
         duration_s = (time.monotonic_ns() - start) / 1e9
         print(f"🏎️ engine started in {duration_s:.0f}s")
 
+    def pair_lengths(self, sentence_pairs: List[Tuple[str, str]]) -> List[int]:
+        encoded = self.reranker.tokenizer(
+            [query for query, _ in sentence_pairs], [passage for _, passage in sentence_pairs],
+            truncation=True, max_length=MAX_PAIR_LENGTH,
+        )
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    def score_pairs(self, sentence_pairs: List[Tuple[str, str]]) -> List[float]:
+        scores = self.reranker.compute_score(
+            sentence_pairs, normalize=True, batch_size=MODEL_BATCH_SIZE, max_length=MAX_PAIR_LENGTH
+        )
+        # a single pair gets a single score back
+        return [float(s) for s in scores] if isinstance(scores, list) else [float(scores)]
+
     @modal.method()
     def get_scores(self, query: str, passages: List[str]) -> List[float]:
-        sentence_pairs = [(query, passage) for passage in passages]
-        scores = self.reranker.compute_score(sentence_pairs, normalize=True, batch_size=32)
-        return [float(s) for s in scores]
+        return self.batcher.score([(query, passage) for passage in passages])
 
 
 # ## Coupling a frontend web application
@@ -0,0 +1,74 @@
+# Recall of the lexical pre-filter (tool/lexical_prefilter.py) against full reranking, on a replay set of event traces
+# (the <task_id>.json files pushed to the open-scholar-demo bucket). For the first iteration of each trace, the
+# passages the full reranking keeps (the top n_rerank with a score of at least the context threshold) are compared
+# with the top-K passages of the pre-filter, for a range of K. Reranking only annotates the passages it keeps with their
+# scores, so the candidates of a trace are sent to the reranker deployment with --rescore, unless they all carry a
+# score. Traces without scores are skipped otherwise. Run from the api dir:
+#
+#     python -m benchmarks.prefilter_recall traces/*.json --rescore --top-k 25 50 100 150
+import argparse
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from tool.lexical_prefilter import prefilter_passages, reranker_input
+
+
+def reference_scores(trace: Dict[str, Any], rescore: bool) -> Optional[np.ndarray]:
+    candidates = trace["iterations"][0]["retrieval"]
+    if all("rerank_score" in c for c in candidates):
+        return np.array([c["rerank_score"] for c in candidates], dtype=float)
+    if not rescore:
+        return None
+    from tool.rag_subs import ModalRerankerNoBatch
+    reranker = ModalRerankerNoBatch("akariasai-ranker-large-update", "inference_api", gen_options=dict())
+    return np.array(reranker.get_scores(trace["query"], [reranker_input(c) for c in candidates]), dtype=float)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("traces", nargs="+")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[25, 50, 100, 150])
+    parser.add_argument("--context-threshold", type=float, default=0.5)
+    parser.add_argument("--rescore", action="store_true")
+    args = parser.parse_args()
+
+    replay = []
+    for path in args.traces:
+        with open(path) as f:
+            trace = json.load(f)
+        candidates = trace["iterations"][0]["retrieval"]
+        if not candidates or (scores := reference_scores(trace, args.rescore)) is None:
+            continue
+        # the passages kept by the full reranking, see PaperFinderWithRerankerThreshold
+        top = np.argsort(-scores, kind="stable")[:trace.get("n_rerank", 8)]
+        relevant = {int(idx) for idx in top if scores[idx] >= args.context_threshold}
+        replay.append((trace["query"], candidates, relevant))
+    print(f"{len(replay)} of {len(args.traces)} traces replayed, "
+          f"{np.mean([len(c) for _, c, _ in replay]):.0f} candidates on average")
+
+    print(f"{'top-k':>8}{'recall':>10}{'full recall':>14}{'payload':>10}{'reduction':>11}{'filter ms':>11}")
+    for top_k in args.top_k:
+        recalls: List[float] = []
+        n_full, n_sent, n_candidates, elapsed = 0, 0, 0, 0.0
+        for query, candidates, relevant in replay:
+            # identify the candidates by position, as the pre-filter returns the dicts themselves
+            positions = {id(c): idx for idx, c in enumerate(candidates)}
+            start = time.perf_counter()
+            kept = prefilter_passages(query, candidates, top_k)
+            elapsed += time.perf_counter() - start
+            kept_positions = {positions[id(c)] for c in kept}
+            n_sent += len(kept)
+            n_candidates += len(candidates)
+            if relevant:
+                recalls.append(len(relevant & kept_positions) / len(relevant))
+                n_full += relevant <= kept_positions
+        print(f"{top_k:>8}{np.mean(recalls):>10.1%}{n_full / max(1, len(recalls)):>14.1%}"
+              f"{n_sent / max(1, len(replay)):>10.0f}{n_candidates / max(1, n_sent):>10.1f}x"
+              f"{elapsed * 1000 / max(1, len(replay)):>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
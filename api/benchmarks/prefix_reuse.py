@@ -0,0 +1,157 @@
+# Measures how many prompt tokens of the OpenScholar generation, feedback and editing calls can be served from vLLM's
+# automatic prefix cache. The calls are made through OpenScholar itself, against a local OpenAI-compatible stand-in
+# which mimics the prefix cache: prompts are split into blocks of --block-size tokens, and a block is a hit if it and
+# all the blocks before it were seen in an earlier prompt. Run from the api dir:
+#
+#     python -m benchmarks.prefix_reuse --n-queries 20
+import argparse
+import json
+import random
+import re
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, cast
+from unittest import mock
+
+import tool.open_scholar
+from tool.context_packer import get_tokenizer
+from tool.locked_state import LockedStateManager
+from tool.models import AsyncTaskState
+from tool.open_scholar import OpenScholar
+
+RESPONSE = "[Response_Start]Retrieval augmented generation grounds answers in retrieved passages [0][1].[Response_End]"
+FEEDBACK = "[Response_Start]Feedback: The answer should discuss evaluation benchmarks.\n[Response_End]"
+
+
+class PrefixCacheStandIn:
+    """Block-level prefix cache, like vLLM's automatic prefix caching (without eviction)"""
+
+    def __init__(self, block_size: int) -> None:
+        self.block_size = block_size
+        self.tokenizer = get_tokenizer()
+        self._lock = threading.Lock()
+        self._blocks = set()
+        self.stats: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0])
+
+    def tokenize(self, text: str) -> List[str]:
+        if self.tokenizer is not None:
+            return [str(i) for i in self.tokenizer.encode(text, add_special_tokens=False).ids]
+        return re.findall(r"\w+|[^\w\s]", text)
+
+    def prefill(self, phase: str, messages: List[Dict[str, str]]) -> Dict[str, int]:
+        prompt = "".join(f"<|{m['role']}|>{m['content']}" for m in messages)
+        tokens = self.tokenize(prompt)
+        n_cached, prefix_hash, hit = 0, "", True
+        with self._lock:
+            # only full blocks are cached
+            for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+                prefix_hash = sha256((prefix_hash + " ".join(tokens[start:start + self.block_size])).encode()).hexdigest()
+                if hit and prefix_hash in self._blocks:
+                    n_cached += self.block_size
+                else:
+                    hit = False
+                    self._blocks.add(prefix_hash)
+            stats = self.stats[phase]
+            stats[0] += 1
+            stats[1] += len(tokens)
+            stats[2] += n_cached
+        return {"prompt_tokens": len(tokens), "cached_tokens": n_cached}
+
+
+class StandInServer(ThreadingHTTPServer):
+    # the OpenScholar call the next requests are made for, their prefix cache hits are counted under it
+    phase: str = "generation"
+
+
+def serve(cache: PrefixCacheStandIn) -> StandInServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            phase = cast(StandInServer, self.server).phase
+            usage = cache.prefill(phase, request["messages"])
+            content = FEEDBACK if phase == "feedback" else RESPONSE
+            body = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": request["model"],
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": usage["prompt_tokens"], "completion_tokens": 1,
+                          "total_tokens": usage["prompt_tokens"] + 1,
+                          "prompt_tokens_details": {"cached_tokens": usage["cached_tokens"]}},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = StandInServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def random_passages(rng: random.Random, vocabulary: List[str], n: int) -> List[Dict[str, str]]:
+    return [
+        {"title": " ".join(rng.choices(vocabulary, k=8)), "text": " ".join(rng.choices(vocabulary, k=120))}
+        for _ in range(n)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-queries", type=int, default=20)
+    parser.add_argument("--n-rerank", type=int, default=8)
+    parser.add_argument("--block-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cache = PrefixCacheStandIn(args.block_size)
+    server = serve(cache)
+    tool.open_scholar.LLM_BASE_URL = f"http://127.0.0.1:{server.server_port}/v1"
+    tool.open_scholar.LLM_KEY = "benchmark"
+
+    # only the prompting methods are used, the Modal client of the reranker is replaced as it is never called
+    state_dir = tempfile.mkdtemp()
+    with mock.patch("scholarqa.rag.reranker.modal_engine.ModalEngine"):
+        open_scholar = OpenScholar(
+            LockedStateManager(AsyncTaskState, state_dir), n_rerank=args.n_rerank, llm_model="os_8b",
+            stream_drafts=False,
+        )
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    for _ in range(args.n_queries):
+        query = "What is known about " + " ".join(rng.choices(vocabulary, k=6)) + "?"
+        ctxs = random_passages(rng, vocabulary, args.n_rerank)
+        server.phase = "generation"
+        answer = open_scholar.generate_response(query, ctxs)
+        server.phase = "feedback"
+        feedbacks = open_scholar.get_feedback(query, ctxs, answer)
+        server.phase = "edit"
+        for feedback, _ in feedbacks:
+            open_scholar.edit_with_feedback(query, ctxs, answer, feedback)
+        server.phase = "edit_with_retrieval"
+        open_scholar.edit_with_feedback_retrieval(
+            query=query, ctxs=random_passages(rng, vocabulary, args.n_rerank), previous_response=answer,
+            feedback="Discuss evaluation benchmarks.", passage_start_index=args.n_rerank,
+        )
+    server.shutdown()
+    shutil.rmtree(state_dir)
+
+    print(f"{'phase':<22}{'requests':>10}{'prompt tokens':>16}{'cached tokens':>16}{'reuse':>8}")
+    total = [0, 0, 0]
+    for phase, (n_requests, n_tokens, n_cached) in cache.stats.items():
+        total = [total[0] + n_requests, total[1] + n_tokens, total[2] + n_cached]
+        print(f"{phase:<22}{n_requests:>10}{n_tokens:>16}{n_cached:>16}{n_cached / max(1, n_tokens):>8.1%}")
+    print(f"{'total':<22}{total[0]:>10}{total[1]:>16}{total[2]:>16}{total[2] / max(1, total[1]):>8.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# Throughput of the reranker server with and without cross-request micro-batching (ranker_batching.py), on CPU with a
+# small cross-encoder. Clients send requests of --n-passages (query, passage) pairs concurrently. Without batching
+# every request is scored on its own, like the server used to do; with batching the pairs of concurrent requests are
+# fused and sorted by token length. Prints pairs/s, latency and the fraction of padding tokens per concurrency.
+# Needs torch and transformers. Run from the api dir:
+#
+#     python -m benchmarks.ranker_batching --model cross-encoder/ms-marco-MiniLM-L-6-v2 --concurrency 1 4 16
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple
+
+import numpy as np
+import torch
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from ranker_batching import MicroBatcher
+
+Pair = Tuple[str, str]
+
+
+class CrossEncoder:
+    """Scores pairs in batches of `batch_size`, padded to the longest pair of each batch, like FlagReranker"""
+
+    def __init__(self, model_name: str, batch_size: int, max_length: int) -> None:
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.lock = threading.Lock()
+        self.n_tokens = 0
+        self.n_padded_tokens = 0
+
+    def lengths(self, pairs: List[Pair]) -> List[int]:
+        encoded = self.tokenizer([q for q, _ in pairs], [p for _, p in pairs], truncation=True,
+                                 max_length=self.max_length)
+        return [len(ids) for ids in encoded["input_ids"]]
+
+    @torch.inference_mode()
+    def score(self, pairs: List[Pair]) -> List[float]:
+        scores = []
+        for start in range(0, len(pairs), self.batch_size):
+            batch = pairs[start:start + self.batch_size]
+            inputs = self.tokenizer([q for q, _ in batch], [p for _, p in batch], padding=True, truncation=True,
+                                    max_length=self.max_length, return_tensors="pt")
+            with self.lock:
+                self.n_tokens += int(inputs["attention_mask"].sum())
+                self.n_padded_tokens += inputs["attention_mask"].numel()
+            scores.extend(torch.sigmoid(self.model(**inputs).logits[:, 0]).tolist())
+        return scores
+
+
+def random_requests(rng: random.Random, n_requests: int, n_passages: int) -> List[List[Pair]]:
+    vocabulary = [f"term{i}" for i in range(2000)]
+    requests = []
+    for _ in range(n_requests):
+        query = " ".join(rng.choices(vocabulary, k=8))
+        # snippets vary a lot in length, which is where the padding comes from
+        requests.append([(query, " ".join(rng.choices(vocabulary, k=rng.randint(20, 250)))) for _ in range(n_passages)])
+    return requests
+
+
+def run(requests: List[List[Pair]], score: Callable[[List[Pair]], List[float]], concurrency: int) -> List[float]:
+    latencies = []
+
+    def _request(pairs: List[Pair]) -> None:
+        start = time.perf_counter()
+        score(pairs)
+        latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(_request, requests))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="cross-encoder/ms-marco-MiniLM-L-6-v2")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--n-requests", type=int, default=32)
+    parser.add_argument("--n-passages", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--max-wait", type=float, default=0.01)
+    parser.add_argument("--max-pairs", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    encoder = CrossEncoder(args.model, args.batch_size, args.max_length)
+    batcher = MicroBatcher(encoder.score, encoder.lengths, args.max_wait, args.max_pairs)
+    requests = random_requests(random.Random(args.seed), args.n_requests, args.n_passages)
+    # warm up
+    encoder.score(requests[0])
+
+    print(f"{'mode':<14}{'concurrency':>12}{'pairs/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'padding':>10}")
+    for concurrency in args.concurrency:
+        for mode, score in [("per-request", encoder.score), ("micro-batched", batcher.score)]:
+            encoder.n_tokens = encoder.n_padded_tokens = 0
+            start = time.perf_counter()
+            latencies = run(requests, score, concurrency)
+            elapsed = time.perf_counter() - start
+            padding = 1 - encoder.n_tokens / max(1, encoder.n_padded_tokens)
+            print(f"{mode:<14}{concurrency:>12}{len(requests) * args.n_passages / elapsed:>10.0f}"
+                  f"{np.percentile(latencies, 50) * 1000:>10.0f}{np.percentile(latencies, 95) * 1000:>10.0f}"
+                  f"{padding:>10.1%}")
+
+
+if __name__ == "__main__":
+    main()
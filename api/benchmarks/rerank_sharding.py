@@ -0,0 +1,109 @@
+# Latency and throughput of ModalRerankerNoBatch for a range of shard sizes and shard concurrencies. The reranker calls
+# go to a local stand-in for the Modal deployment: every call pays a fixed --call-overhead (network, queueing,
+# tokenization), then holds one of --gpu-slots for --per-pair seconds per passage. A call fails with --failure-rate,
+# and is a straggler (--straggler-delay slower) with --straggler-rate. Run from the api dir:
+#
+#     python -m benchmarks.rerank_sharding --n-docs 300 --n-queries 20
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+from unittest import mock
+
+import numpy as np
+
+from tool.rag_subs import ModalRerankerNoBatch
+
+
+class StandInScorer:
+    """Mimics `modal_engine.generate` of the reranker deployment"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.gpu = threading.Semaphore(args.gpu_slots)
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.n_calls = 0
+        self.n_failures = 0
+
+    def generate(self, inputs: Tuple[str, List[str]], streaming: bool = False) -> List[float]:
+        _, documents = inputs
+        with self.lock:
+            self.n_calls += 1
+            fails = self.rng.random() < self.args.failure_rate
+            straggles = self.rng.random() < self.args.straggler_rate
+        time.sleep(self.args.call_overhead + (self.args.straggler_delay if straggles else 0.0))
+        if fails:
+            with self.lock:
+                self.n_failures += 1
+            raise RuntimeError("stand-in reranker call failed")
+        with self.gpu:
+            time.sleep(self.args.per_pair * len(documents))
+        return [len(document) / 1000 for document in documents]
+
+
+def run(args: argparse.Namespace, shard_size: int, shard_concurrency: int) -> List[str]:
+    scorer = StandInScorer(args)
+    # the stand-in takes the place of the Modal client
+    with mock.patch("scholarqa.rag.reranker.modal_engine.ModalEngine", return_value=scorer):
+        reranker = ModalRerankerNoBatch("stand-in", "inference_api", shard_size=shard_size,
+                                        shard_concurrency=shard_concurrency, shard_retries=args.retries)
+
+    rng = random.Random(args.seed)
+    queries = [
+        (f"query {i}", [" ".join(f"w{rng.randrange(10000)}" for _ in range(50)) for _ in range(args.n_docs)])
+        for i in range(args.n_queries)
+    ]
+    latencies, n_errors = [], 0
+
+    def _query(query: str, documents: List[str]) -> None:
+        nonlocal n_errors
+        start = time.perf_counter()
+        try:
+            # scores are not cached, every pair goes to the stand-in
+            reranker.score_documents(query, documents)
+            latencies.append(time.perf_counter() - start)
+        except RuntimeError:
+            n_errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrent_queries) as executor:
+        list(executor.map(lambda q: _query(*q), queries))
+    elapsed = time.perf_counter() - start
+    reranker.shutdown()
+    return [
+        "all" if shard_size <= 0 else str(shard_size), str(shard_concurrency),
+        f"{np.percentile(latencies, 50) * 1000:.0f}" if latencies else "-",
+        f"{np.percentile(latencies, 95) * 1000:.0f}" if latencies else "-",
+        f"{len(latencies) * args.n_docs / elapsed:.0f}", str(scorer.n_calls), str(scorer.n_failures), str(n_errors),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n-docs", type=int, default=300)
+    parser.add_argument("--n-queries", type=int, default=20)
+    parser.add_argument("--concurrent-queries", type=int, default=1)
+    parser.add_argument("--shard-sizes", type=int, nargs="+", default=[0, 150, 75, 38])
+    parser.add_argument("--concurrencies", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--retries", type=int, default=1)
+    parser.add_argument("--call-overhead", type=float, default=0.08)
+    parser.add_argument("--per-pair", type=float, default=0.001)
+    parser.add_argument("--gpu-slots", type=int, default=1)
+    parser.add_argument("--failure-rate", type=float, default=0.02)
+    parser.add_argument("--straggler-rate", type=float, default=0.05)
+    parser.add_argument("--straggler-delay", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    header = ["shard size", "concurrency", "p50 ms", "p95 ms", "pairs/s", "calls", "failed calls", "failed queries"]
+    print("".join(f"{column:>15}" for column in header))
+    for shard_size in args.shard_sizes:
+        for shard_concurrency in ([1] if shard_size <= 0 else args.concurrencies):
+            print("".join(f"{column:>15}" for column in run(args, shard_size, shard_concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Cross-request micro-batching for the reranker deployment (akariasai-ranker-large.py). Concurrent calls hand their
+# (query, passage) pairs to a single scoring thread, which fuses the pairs that arrive within a short window, sorts
+# them by token length so that the model's batches hold pairs of similar length (and little padding), scores them
+# in one go and scatters the scores back to the callers.
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+Pair = Tuple[str, str]
+
+
+class MicroBatcher:
+    def __init__(
+            self,
+            score_fn: Callable[[List[Pair]], List[float]],
+            length_fn: Optional[Callable[[List[Pair]], List[int]]] = None,
+            max_wait: float = 0.01,
+            max_pairs: int = 512,
+    ):
+        """
+        `score_fn` scores a list of pairs (in batches of whatever size the model uses), and `length_fn` gives the
+        token length of each pair (the character length by default). The first call of a batch waits up to
+        `max_wait` seconds for more calls to join it, unless `max_pairs` pairs are already waiting.
+        """
+        self.score_fn = score_fn
+        self.length_fn = length_fn or (lambda pairs: [len(query) + len(passage) for query, passage in pairs])
+        self.max_wait = max_wait
+        self.max_pairs = max_pairs
+        self._cond = threading.Condition()
+        self._pending: List[Tuple[List[Pair], Future]] = []
+        self._n_pending_pairs = 0
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def score(self, pairs: List[Pair]) -> List[float]:
+        """Scores of the pairs, computed along with the pairs of concurrent calls"""
+        if not pairs:
+            return []
+        future = Future()
+        with self._cond:
+            self._pending.append((pairs, future))
+            self._n_pending_pairs += len(pairs)
+            self._cond.notify()
+        return future.result()
+
+    def _next_batch(self) -> List[Tuple[List[Pair], Future]]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending)
+            deadline = time.monotonic() + self.max_wait
+            while self._n_pending_pairs < self.max_pairs and (remaining := deadline - time.monotonic()) > 0:
+                self._cond.wait(remaining)
+            # calls are taken whole, a batch overshoots max_pairs rather than splitting a call
+            batch, n_pairs = [], 0
+            while self._pending and (not batch or n_pairs + len(self._pending[0][0]) <= self.max_pairs):
+                pairs, future = self._pending.pop(0)
+                batch.append((pairs, future))
+                n_pairs += len(pairs)
+            self._n_pending_pairs -= n_pairs
+            return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            pairs = [pair for call_pairs, _ in batch for pair in call_pairs]
+            try:
+                lengths = self.length_fn(pairs)
+                order = sorted(range(len(pairs)), key=lambda idx: lengths[idx])
+                sorted_scores = self.score_fn([pairs[idx] for idx in order])
+                if len(sorted_scores) != len(pairs):
+                    # the scores could not be matched with the pairs, none of the callers gets any
+                    raise ValueError(f"Got {len(sorted_scores)} scores for {len(pairs)} pairs")
+                scores = [0.0] * len(pairs)
+                for idx, score in zip(order, sorted_scores):
+                    scores[idx] = score
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for call_pairs, future in batch:
+                future.set_result(scores[start:start + len(call_pairs)])
+                start += len(call_pairs)
@@ -1,4 +1,10 @@
 #!/bin/bash
+# metrics of all gunicorn workers are aggregated through files in this dir, which must start out empty
+export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_multiproc}"
+rm -rf "$PROMETHEUS_MULTIPROC_DIR" && mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+# the task runner slots of all gunicorn workers are accounted for in this dir, which must start out empty too
+export TASK_RUNNER_DIR="${TASK_RUNNER_DIR:-/tmp/task_runners}"
+rm -rf "$TASK_RUNNER_DIR" && mkdir -p "$TASK_RUNNER_DIR"
 exec \
     gunicorn \
     -k uvicorn.workers.UvicornWorker \
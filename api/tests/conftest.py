@@ -0,0 +1,16 @@
+import pytest
+
+from tool.models import AsyncTaskState
+
+
+@pytest.fixture
+def new_task():
+    """Writes the state of a new, started task to a state store, along with the given extra state"""
+
+    def _new_task(task_mgr, task_id: str, **extra_state) -> None:
+        task_mgr.write_state(AsyncTaskState(
+            task_id=task_id, query="what is rag?", estimated_time="1 minute", task_status="STARTED",
+            task_result=None, extra_state=extra_state,
+        ))
+
+    return _new_task
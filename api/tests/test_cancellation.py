@@ -0,0 +1,40 @@
+from time import time
+from types import SimpleNamespace
+
+import pytest
+
+from tool.locked_state import LockedStateManager
+from tool.models import AsyncTaskState
+from tool.open_scholar import OpenScholar
+from tool.task_runner import TaskCancelledException
+
+
+@pytest.fixture
+def open_scholar(tmp_path):
+    # check_cancelled only needs the state store, not the retriever and LLM clients of a full OpenScholar
+    return SimpleNamespace(task_mgr=LockedStateManager(AsyncTaskState, str(tmp_path)), discarded_tasks=set())
+
+
+def test_running_task_is_not_stopped(open_scholar, new_task):
+    new_task(open_scholar.task_mgr, "t1", deadline=time() + 60)
+    OpenScholar.check_cancelled(open_scholar, "t1")
+
+
+def test_cancelled_task_is_stopped(open_scholar, new_task):
+    new_task(open_scholar.task_mgr, "t1", deadline=time() + 60, cancel_requested=True)
+    with pytest.raises(TaskCancelledException) as e:
+        OpenScholar.check_cancelled(open_scholar, "t1")
+    assert not e.value.timed_out
+
+
+def test_timed_out_task_is_not_reported_as_cancelled(open_scholar, new_task):
+    # failed by a poller which noticed the timeout, and cancelled by the client as well
+    new_task(open_scholar.task_mgr, "t1", deadline=time() + 60, timed_out=True, cancel_requested=True)
+    with pytest.raises(TaskCancelledException) as e:
+        OpenScholar.check_cancelled(open_scholar, "t1")
+    assert e.value.timed_out
+
+    new_task(open_scholar.task_mgr, "t2", deadline=time() - 1)
+    with pytest.raises(TaskCancelledException) as e:
+        OpenScholar.check_cancelled(open_scholar, "t2")
+    assert e.value.timed_out
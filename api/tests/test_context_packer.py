@@ -0,0 +1,69 @@
+import pytest
+
+from tool import context_packer
+from tool.context_packer import (
+    CHAT_TEMPLATE_OVERHEAD, LLM_MAX_MODEL_LEN, context_budget, count_passage_tokens, pack_passages,
+)
+
+
+class WordTokenizer:
+    """A token per word"""
+
+    class Encoding:
+        def __init__(self, ids):
+            self.ids = ids
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> "WordTokenizer.Encoding":
+        return self.Encoding(text.split())
+
+    def decode(self, ids) -> str:
+        return " ".join(ids)
+
+
+def _use_tokenizer(monkeypatch, tokenizer) -> None:
+    monkeypatch.setattr(context_packer, "_tokenizer", tokenizer)
+    monkeypatch.setattr(context_packer, "_tokenizer_loaded", True)
+    # counts cached with another tokenizer
+    context_packer._count_text_tokens.cache_clear()
+    context_packer._count_marker_tokens.cache_clear()
+
+
+@pytest.fixture
+def word_tokenizer(monkeypatch):
+    _use_tokenizer(monkeypatch, WordTokenizer())
+
+
+def _passage(idx: int, n_words: int) -> str:
+    return f"[{idx}] " + " ".join(["word"] * n_words) + "\n"
+
+
+def test_passages_are_packed_up_to_the_budget(word_tokenizer):
+    # 1 token for the marker and 10 for the text of each passage
+    passages = [_passage(idx, 10) for idx in range(4)]
+    assert pack_passages(passages, 33) == passages[:3]
+    assert pack_passages(passages, 32) == passages[:2]
+    assert pack_passages(passages, 100) == passages
+    # only a first passage which does not fit on its own is truncated
+    assert pack_passages(passages, 5) == ["[0] word word word word"]
+    assert pack_passages(passages, 0) == []
+
+
+def test_context_budget_leaves_room_for_the_prompt_and_the_generation(word_tokenizer):
+    assert context_budget("a prompt of six words here", 2000) == LLM_MAX_MODEL_LEN - 6 - CHAT_TEMPLATE_OVERHEAD - 2000
+
+
+def test_passage_texts_are_counted_once_whatever_their_index(word_tokenizer):
+    assert count_passage_tokens(_passage(0, 10)) == count_passage_tokens(_passage(12, 10)) == 11
+    assert context_packer._count_text_tokens.cache_info().currsize == 1
+    assert count_passage_tokens("no marker here") == 3
+
+
+def test_token_counts_are_estimated_from_words_without_a_tokenizer(monkeypatch):
+    _use_tokenizer(monkeypatch, None)
+    # 1.5 tokens per word, rounded up
+    assert count_passage_tokens(_passage(3, 10)) == 2 + 15
+    assert context_budget("a prompt of six words here", 100) == LLM_MAX_MODEL_LEN - 9 - CHAT_TEMPLATE_OVERHEAD - 100
+    passages = [_passage(idx, 10) for idx in range(3)]
+    assert pack_passages(passages, 34) == passages[:2]
+    assert pack_passages(passages, 33) == passages[:1]
+    assert pack_passages(passages, 10) == ["[0] word word word word word"]
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from tool.deadline import MIN_CALL_TIMEOUT, call_deadline, call_timeout, with_deadline
+
+
+def test_calls_time_out_at_the_deadline():
+    assert call_timeout(30) == 30
+    with call_deadline(time() + 10):
+        assert 9 < call_timeout(30) <= 10
+        assert call_timeout(5) == 5
+        with call_deadline(None):
+            assert call_timeout(30) == 30
+        # past the deadline, calls still get a chance to fail on their own
+        with call_deadline(time() - 10):
+            assert call_timeout(30) == MIN_CALL_TIMEOUT
+    assert call_timeout(30) == 30
+
+
+def test_deadline_is_passed_to_executor_threads():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with call_deadline(time() + 10):
+            bound = executor.submit(with_deadline(call_timeout), 30).result()
+            unbound = executor.submit(call_timeout, 30).result()
+        assert 9 < bound <= 10 and unbound == 30
+        # the executor thread is not left bound by the deadline
+        assert executor.submit(call_timeout, 30).result() == 30
@@ -0,0 +1,64 @@
+import random
+
+from tool.dedup import dedup_passages, near_duplicate_clusters
+
+_rng = random.Random(0)
+_VOCAB = [f"word{idx}" for idx in range(5000)]
+
+
+def _text(n_words: int) -> str:
+    return " ".join(_rng.choices(_VOCAB, k=n_words))
+
+
+def test_near_duplicates_keep_the_best_passage_in_order():
+    first, second = _text(60), _text(60)
+    # differs from `first` by its punctuation, case and a single word at the end
+    near_first = first.replace(" ", ", ", 5).upper().rsplit(" ", 1)[0] + " extra"
+    passages = [
+        {"corpus_id": 1, "text": first, "score": 0.2},
+        {"corpus_id": 2, "text": second, "score": 0.5},
+        {"corpus_id": 3, "text": near_first, "score": 0.9},
+    ]
+    assert [p["corpus_id"] for p in dedup_passages(passages)] == [2, 3]
+
+
+def test_ties_keep_the_first_passage():
+    text = _text(50)
+    passages = [{"corpus_id": idx, "text": text, "score": 0.5} for idx in range(3)]
+    assert [p["corpus_id"] for p in dedup_passages(passages)] == [0]
+    passages = [{"corpus_id": idx, "text": text} for idx in range(3)]
+    assert [p["corpus_id"] for p in dedup_passages(passages)] == [0]
+
+
+def test_passages_without_text_are_dropped():
+    passages = [
+        {"corpus_id": 1, "text": None},
+        {"corpus_id": 2, "text": ""},
+        {"corpus_id": 3, "text": " \n\t"},
+        {"corpus_id": 4, "text": "short snippet"},
+    ]
+    assert [p["corpus_id"] for p in dedup_passages(passages)] == [4]
+    assert dedup_passages(passages[:3]) == []
+    assert dedup_passages([]) == []
+
+
+def test_short_and_distinct_passages_are_kept():
+    texts = ["RAG", "retrieval augmented generation", "dense retrieval", _text(30), _text(30), _text(200)]
+    passages = [{"corpus_id": idx, "text": text, "score": 0.1} for idx, text in enumerate(texts)]
+    assert [p["corpus_id"] for p in dedup_passages(passages)] == list(range(len(texts)))
+
+
+def test_shared_prefix_is_a_duplicate():
+    prefix = _text(20)
+    # the same abstract cut at different lengths, far apart in Jaccard similarity, but texts which are not longer than
+    # the prefix are only compared on their shingles
+    texts = [prefix + " " + _text(100), prefix, prefix + " " + _text(10), _text(25)]
+    assert near_duplicate_clusters(texts).tolist() == [0, 1, 0, 3]
+
+
+def test_long_words_are_hashed_in_full():
+    # words which only differ in the middle, beyond their first 16 bytes and before their last 8
+    def _long_words(first: int) -> str:
+        return " ".join(f"{'a' * 16}{idx:04d}{'b' * 8}" for idx in range(first, first + 30))
+
+    assert near_duplicate_clusters([_long_words(0), _long_words(100), _long_words(0)]).tolist() == [0, 1, 0]
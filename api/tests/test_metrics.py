@@ -0,0 +1,22 @@
+from prometheus_client import REGISTRY
+
+from tool.metrics import record_llm_completion
+
+
+def _unused(call: str) -> float:
+    return REGISTRY.get_sample_value("openscholar_llm_unused_max_tokens_total", {"call": call}) or 0.0
+
+
+def test_unused_max_tokens_are_only_counted_at_a_given_stop_sequence():
+    stop = ["[Response_End]", "References:"]
+    record_llm_completion("test_unused", 2000, "stop", "References:", 500, stop)
+    assert _unused("test_unused") == 1500
+    # the end of sequence, the max_tokens budget, and a stop sequence which was not asked for
+    record_llm_completion("test_unused", 2000, "stop", None, 700, stop)
+    record_llm_completion("test_unused", 2000, "length", None, 2000, stop)
+    record_llm_completion("test_unused", 2000, "stop", "\n\n", 100, stop)
+    record_llm_completion("test_unused", 2000, "stop", "References:", 100)
+    assert _unused("test_unused") == 1500
+    assert REGISTRY.get_sample_value(
+        "openscholar_llm_finished_total", {"call": "test_unused", "reason": "stop_sequence"}
+    ) == 3
@@ -0,0 +1,82 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+import pytest
+
+from tool.paper_details import PaperDetailsFetcher
+
+
+class FakeS2:
+    """Stands in for the S2 paper/batch end point, which knows the papers with an even corpus id"""
+
+    def __init__(self) -> None:
+        self.calls: List[List[str]] = []
+        self.error = None
+        self._lock = threading.Lock()
+
+    def __call__(self, end_pt: str, method: str, params: Dict[str, Any], payload: Dict[str, Any]) -> List[Any]:
+        with self._lock:
+            self.calls.append(payload["ids"])
+        if self.error is not None:
+            raise self.error
+        return [
+            {"corpusId": int(paper_id.split(":")[1]), "fields": params["fields"]}
+            if int(paper_id.split(":")[1]) % 2 == 0 else None
+            for paper_id in payload["ids"]
+        ]
+
+
+@pytest.fixture
+def s2(monkeypatch):
+    fake = FakeS2()
+    monkeypatch.setattr("tool.paper_details.query_s2_api", fake)
+    return fake
+
+
+@pytest.fixture
+def fetcher():
+    fetcher = PaperDetailsFetcher(window=0.1)
+    yield fetcher
+    fetcher.shutdown()
+
+
+def test_concurrent_requests_share_one_call(s2, fetcher):
+    requests = [[2, 4], [4, 6, 7], [8]]
+    with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+        results = list(executor.map(lambda ids: fetcher.get(ids, "title"), requests))
+    assert len(s2.calls) == 1 and sorted(s2.calls[0]) == sorted(f"CorpusId:{cid}" for cid in [2, 4, 6, 7, 8])
+    assert [[paper and paper["corpusId"] for paper in result] for result in results] == [[2, 4], [4, 6, None], [8]]
+
+
+def test_long_id_lists_are_fetched_in_chunks(s2):
+    fetcher = PaperDetailsFetcher(window=0.1, batch_size=500)
+    try:
+        papers = fetcher.get(list(range(1200)), "title")
+    finally:
+        fetcher.shutdown()
+    assert sorted(len(call) for call in s2.calls) == [200, 500, 500]
+    assert [paper and paper["corpusId"] for paper in papers] == [cid if cid % 2 == 0 else None for cid in range(1200)]
+
+
+def test_cached_papers_are_not_fetched_again(s2, fetcher):
+    assert fetcher.get([2, 3], "title")[0] == {"corpusId": 2, "fields": "title"}
+    # papers unknown to S2 are cached too
+    assert fetcher.get([3, 2], "title") == [None, {"corpusId": 2, "fields": "title"}]
+    assert len(s2.calls) == 1
+    # but are cached per field set
+    fetcher.get([2], "title,year")
+    assert len(s2.calls) == 2
+
+
+def test_failures_reach_every_waiter(s2, fetcher):
+    s2.error = RuntimeError("S2 is down")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(fetcher.get, ids, "title") for ids in [[2, 4], [4, 6]]]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="S2 is down"):
+                future.result(timeout=2)
+    assert len(s2.calls) == 1
+    # failures are not cached
+    s2.error = None
+    assert fetcher.get([2], "title") == [{"corpusId": 2, "fields": "title"}]
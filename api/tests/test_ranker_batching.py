@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import pytest
+
+from ranker_batching import MicroBatcher, Pair
+
+
+class Scorer:
+    """Scores a pair by the number in its passage, and records the batches it was given"""
+
+    def __init__(self) -> None:
+        self.batches: List[List[Pair]] = []
+        self.n_missing = 0
+        # the first batch is held until released, so that the calls made meanwhile pile up
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, pairs: List[Pair]) -> List[float]:
+        self.release.wait()
+        self.batches.append(pairs)
+        return [float(passage) for _, passage in pairs][:len(pairs) - self.n_missing]
+
+
+def _pairs(*passages: int) -> List[Tuple[str, str]]:
+    return [("q", str(passage)) for passage in passages]
+
+
+def _score_concurrently(batcher: MicroBatcher, calls: List[List[Pair]]) -> List[List[float]]:
+    with ThreadPoolExecutor(max_workers=len(calls)) as executor:
+        return list(executor.map(batcher.score, calls))
+
+
+def test_calls_within_the_window_are_scored_together():
+    scorer = Scorer()
+    batcher = MicroBatcher(scorer, max_wait=0.2, max_pairs=100)
+    calls = [_pairs(1, 2), _pairs(3), _pairs(4, 5, 6)]
+    assert _score_concurrently(batcher, calls) == [[1.0, 2.0], [3.0], [4.0, 5.0, 6.0]]
+    assert len(scorer.batches) == 1 and len(scorer.batches[0]) == 6
+    assert batcher.score([]) == []
+
+
+def test_batches_are_capped_by_max_pairs():
+    scorer = Scorer()
+    # a long window, which full batches do not wait for, only the last one does
+    batcher = MicroBatcher(scorer, max_wait=1.0, max_pairs=4)
+    scorer.release.clear()
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        first = executor.submit(batcher.score, _pairs(1, 2, 3, 4))
+        # queued while the first batch is being scored
+        others = [executor.submit(batcher.score, pairs) for pairs in [_pairs(5, 6), _pairs(7, 8), _pairs(9)]]
+        scorer.release.set()
+        assert first.result(timeout=0.5) == [1.0, 2.0, 3.0, 4.0]
+        assert [future.result(timeout=0.5) for future in others[:2]] == [[5.0, 6.0], [7.0, 8.0]]
+        assert others[2].result(timeout=2) == [9.0]
+    # calls are not split across batches
+    assert [len(batch) for batch in scorer.batches] == [4, 4, 1]
+
+
+def test_scores_are_scattered_back_in_the_order_of_the_pairs():
+    scorer = Scorer()
+    # pairs are scored by length, which is the reverse of their order in the calls
+    batcher = MicroBatcher(scorer, length_fn=lambda pairs: [-len(passage) for _, passage in pairs], max_wait=0.2)
+    calls = [_pairs(1, 22, 333), _pairs(4444, 5), _pairs(66)]
+    assert _score_concurrently(batcher, calls) == [[1.0, 22.0, 333.0], [4444.0, 5.0], [66.0]]
+    assert [passage for _, passage in scorer.batches[0]][:2] == ["4444", "333"]
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    def _fail(pairs: List[Pair]) -> List[float]:
+        raise RuntimeError("model crashed")
+
+    batcher = MicroBatcher(_fail, max_wait=0.1)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [executor.submit(batcher.score, pairs) for pairs in [_pairs(1), _pairs(2, 3), _pairs(4)]]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="model crashed"):
+                future.result(timeout=2)
+
+
+def test_missing_scores_fail_every_caller_of_the_batch():
+    scorer = Scorer()
+    scorer.n_missing = 1
+    batcher = MicroBatcher(scorer, max_wait=0.1)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(batcher.score, pairs) for pairs in [_pairs(1, 2), _pairs(3)]]
+        for future in futures:
+            with pytest.raises(ValueError, match="Got 2 scores for 3 pairs"):
+                future.result(timeout=2)
+    # the batcher keeps scoring the next calls
+    scorer.n_missing = 0
+    assert batcher.score(_pairs(7)) == [7.0]
@@ -0,0 +1,43 @@
+import numpy as np
+
+from tool.rag_subs import select_top_passages
+
+
+def test_scores_below_the_threshold_are_dropped():
+    scores = np.array([0.2, 0.9, 0.5, 0.7])
+    top = select_top_passages(scores, threshold=0.5, k=10)
+    assert top.indices.tolist() == [1, 3, 2]
+    assert top.scores.tolist() == [0.9, 0.7, 0.5]
+
+
+def test_top_k_breaks_ties_by_position():
+    scores = np.array([0.5, 0.8, 0.5, 0.8, 0.5, 0.1])
+    assert select_top_passages(scores, threshold=0.0, k=3).indices.tolist() == [1, 3, 0]
+    assert select_top_passages(scores, threshold=0.0, k=4).indices.tolist() == [1, 3, 0, 2]
+    # k <= 0 does not cap the passages, like a full stable sort
+    assert select_top_passages(scores, threshold=0.0, k=0).indices.tolist() == [1, 3, 0, 2, 4, 5]
+
+
+def test_max_per_paper_keeps_the_best_passages_of_each_paper():
+    scores = np.array([0.9, 0.8, 0.7, 0.6, 0.5, 0.8])
+    papers = ["a", "a", "b", "a", "b", "a"]
+    top = select_top_passages(scores, threshold=0.0, k=3, papers=papers, max_per_paper=2)
+    assert top.indices.tolist() == [0, 1, 2]
+    top = select_top_passages(scores, threshold=0.0, k=10, papers=papers, max_per_paper=1)
+    assert top.indices.tolist() == [0, 2]
+    # without papers, or a cap of 0, passages are not capped per paper
+    assert select_top_passages(scores, threshold=0.0, k=3, max_per_paper=1).indices.tolist() == [0, 1, 5]
+    assert select_top_passages(scores, threshold=0.0, k=3, papers=papers).indices.tolist() == [0, 1, 5]
+
+
+def test_passages_without_a_paper_are_not_capped_together():
+    scores = np.array([0.9, 0.8, 0.7, 0.6, 0.5])
+    papers = [None, "a", None, "a", None]
+    top = select_top_passages(scores, threshold=0.0, k=10, papers=papers, max_per_paper=1)
+    assert top.indices.tolist() == [0, 1, 2, 4]
+
+
+def test_no_passage_is_selected():
+    assert select_top_passages(np.array([]), threshold=0.0, k=5).indices.tolist() == []
+    top = select_top_passages(np.array([0.1, 0.2]), threshold=0.5, k=5, papers=["a", "b"], max_per_paper=1)
+    assert (top.indices.tolist(), top.scores.tolist()) == ([], [])
@@ -0,0 +1,112 @@
+import threading
+from time import time
+from typing import Dict, List, Optional, Tuple
+
+import modal
+import pytest
+
+from tool.deadline import call_deadline
+from tool.rag_subs import RERANK_TIMEOUT, ModalRerankerNoBatch
+
+
+class FakeCall:
+    def __init__(self, engine: "FakeEngine", documents: List[str]) -> None:
+        self.engine = engine
+        self.documents = documents
+        self.cancelled = False
+
+    def get(self, timeout: Optional[float] = None) -> List[float]:
+        self.engine.timeouts.append(timeout)
+        if self.engine.hangs:
+            raise modal.exception.TimeoutError("no output")
+        return [float(document.split()[-1]) for document in self.documents]
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+
+class FakeEngine:
+    """Stands in for the reranker deployed on Modal, scoring a document by its number"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        self.calls: List[FakeCall] = []
+        self.timeouts: List[Optional[float]] = []
+        # number of times each shard, by its first document, fails before it is scored
+        self.failures: Dict[str, int] = {}
+        self.hangs = False
+        self._lock = threading.Lock()
+
+    def fn_lookup(self) -> Tuple["FakeEngine", None]:
+        return self, None
+
+    def spawn(self, query: str, documents: List[str]) -> FakeCall:
+        with self._lock:
+            call = FakeCall(self, documents)
+            self.calls.append(call)
+            if self.failures.get(documents[0], 0) > 0:
+                self.failures[documents[0]] -= 1
+                raise RuntimeError(f"shard of {documents[0]} failed")
+        return call
+
+
+@pytest.fixture
+def reranker(monkeypatch):
+    monkeypatch.setattr("scholarqa.rag.reranker.modal_engine.ModalEngine", FakeEngine)
+    reranker = ModalRerankerNoBatch("app", "api", shard_size=4, shard_concurrency=3, shard_retries=1)
+    yield reranker
+    reranker.shutdown()
+
+
+def _documents(n: int) -> List[str]:
+    return [f"passage {idx}" for idx in range(n)]
+
+
+def _calls(reranker) -> List[List[str]]:
+    return [call.documents for call in reranker.modal_engine.calls]
+
+
+def test_documents_are_split_in_shards(reranker):
+    assert reranker.score_documents("q", _documents(10)) == [float(idx) for idx in range(10)]
+    assert sorted(_calls(reranker)) == [_documents(10)[:4], _documents(10)[4:8], _documents(10)[8:]]
+
+
+def test_documents_are_not_split_without_a_shard_size(reranker):
+    reranker.shard_size = 0
+    assert reranker.score_documents("q", _documents(10)) == [float(idx) for idx in range(10)]
+    assert _calls(reranker) == [_documents(10)]
+
+
+def test_merged_scores_keep_the_order_of_the_documents(reranker):
+    documents = [f"passage {idx}" for idx in [7, 3, 11, 0, 5, 9, 2]]
+    assert reranker.score_documents("q", documents) == [7.0, 3.0, 11.0, 0.0, 5.0, 9.0, 2.0]
+
+
+def test_only_the_failed_shard_is_retried(reranker):
+    reranker.modal_engine.failures = {"passage 4": 1}
+    assert reranker.score_documents("q", _documents(10)) == [float(idx) for idx in range(10)]
+    assert len(_calls(reranker)) == 4 and _calls(reranker)[3:] == [_documents(10)[4:8]]
+
+
+def test_shard_failing_its_last_retry_raises(reranker):
+    reranker.modal_engine.failures = {"passage 8": 2}
+    with pytest.raises(RuntimeError, match="shard of passage 8 failed"):
+        reranker.score_documents("q", _documents(10))
+    # the shards which were scored are not retried
+    assert len(reranker.modal_engine.calls) == 4
+
+
+def test_shards_time_out_at_the_deadline(reranker):
+    with call_deadline(time() + 10):
+        reranker.score_documents("q", _documents(10))
+    assert all(5 < timeout <= 10 for timeout in reranker.modal_engine.timeouts)
+    # outside of a task
+    reranker.score_documents("q", _documents(2))
+    assert reranker.modal_engine.timeouts[-1] == RERANK_TIMEOUT
+
+
+def test_timed_out_calls_are_cancelled(reranker):
+    reranker.modal_engine.hangs = True
+    reranker.shard_size = 0
+    with pytest.raises(modal.exception.TimeoutError):
+        reranker.score_documents("q", _documents(10))
+    assert [call.cancelled for call in reranker.modal_engine.calls] == [True]
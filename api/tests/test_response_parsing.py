@@ -0,0 +1,29 @@
+from tool.open_scholar import parse_response, visible_response_text
+
+ANSWER = "RAG grounds the answer in retrieved passages [0], which reduces hallucinations [1]."
+
+
+def test_parse_response_cut_at_the_end_marker():
+    # the server stops at the stop sequence, which is not part of the output, and llm_inference drops the start
+    # marker of a response which is not terminated
+    assert parse_response(ANSWER) == ANSWER
+    assert parse_response(f"[Response_Start]{ANSWER}[Response_End]") == ANSWER
+    assert parse_response(f"Some preamble [Response_Start]{ANSWER}[Response_End] trailing text") == ANSWER
+
+
+def test_parse_response_cut_at_the_references():
+    assert parse_response(f"{ANSWER}\nReferences:") == f"{ANSWER}\n"
+    output = f"[Response_Start]{ANSWER}\nReferences:\n[0] Lewis et al.[Response_End]"
+    assert parse_response(output) == f"{ANSWER}\n"
+    # the references are kept when asked for
+    assert parse_response(output, strip_references=False) == f"{ANSWER}\nReferences:\n[0] Lewis et al."
+
+
+def test_visible_response_text_while_streaming():
+    assert visible_response_text("[Response_Start]RAG grounds") == "RAG grounds"
+    assert visible_response_text(f"[Response_Start]{ANSWER}[Response_End]") == ANSWER
+    assert visible_response_text(f"[Response_Start]{ANSWER}\nReferences:\n[0] Lewis") == f"{ANSWER}\n"
+    # a marker which is only partially generated so far is held back
+    assert visible_response_text(f"[Response_Start]{ANSWER}[Response_E") == ANSWER
+    assert visible_response_text(f"[Response_Start]{ANSWER}\nRefer") == f"{ANSWER}\n"
+    assert visible_response_text("[Response_St") == ""
@@ -0,0 +1,129 @@
+import pytest
+
+from tool.locked_state import LockedStateManager
+from tool.models import AsyncTaskState, GeneratedIteration, TaskResult
+from tool.result_cache import QueryResultCache
+from tool.sqlite_state import SqliteStateManager
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def task_mgr(request, tmp_path):
+    if request.param == "sqlite":
+        return SqliteStateManager(AsyncTaskState, str(tmp_path / "task_state.db"))
+    return LockedStateManager(AsyncTaskState, str(tmp_path))
+
+
+@pytest.fixture
+def start(new_task):
+    """Starts a task for the key of the cache"""
+
+    def _start(task_mgr, cache: QueryResultCache, key: str, task_id: str) -> None:
+        new_task(task_mgr, task_id)
+        cache.register(key, task_id)
+
+    return _start
+
+
+def _complete(task_mgr, task_id: str) -> None:
+    result = TaskResult(iterations=[GeneratedIteration(text="answer", citations=[])])
+    task_mgr.update_fields(task_id, task_status="COMPLETED", task_result=result)
+
+
+def test_make_key_normalizes_the_query():
+    assert QueryResultCache.make_key("What is RAG?", n_rerank=8) == QueryResultCache.make_key(" what is  rag", n_rerank=8)
+    assert QueryResultCache.make_key("what is rag", n_rerank=8) != QueryResultCache.make_key("what is rag", n_rerank=4)
+
+
+def test_identical_requests_attach_to_the_task_in_flight(task_mgr, start):
+    cache = QueryResultCache(task_mgr)
+    key = cache.make_key("what is rag?")
+    assert cache.lookup(key) == (None, False)
+
+    start(task_mgr, cache, key, "t1")
+    state, refresh = cache.lookup(key)
+    assert state is not None
+    assert (state.task_id, state.task_status, refresh) == ("t1", "STARTED", False)
+
+    _complete(task_mgr, "t1")
+    cache.finish(key, "t1")
+    state, refresh = cache.lookup(key)
+    assert state is not None
+    assert (state.task_id, state.task_status, refresh) == ("t1", "COMPLETED", False)
+
+
+def test_cancelled_and_failed_tasks_are_not_served(task_mgr, start):
+    cache = QueryResultCache(task_mgr)
+    key = cache.make_key("what is rag?")
+    start(task_mgr, cache, key, "t1")
+    task_mgr.update_fields("t1", extra_state={"cancel_requested": True})
+    assert cache.lookup(key) == (None, False)
+
+    task_mgr.update_fields("t1", task_status="FAILED")
+    cache.finish(key, "t1")
+    assert cache.lookup(key) == (None, False)
+
+
+def test_stale_results_are_served_while_refreshed(task_mgr, start):
+    cache = QueryResultCache(task_mgr, ttl=0.0, stale_ttl=60.0)
+    key = cache.make_key("what is rag?")
+    start(task_mgr, cache, key, "t1")
+    _complete(task_mgr, "t1")
+    cache.finish(key, "t1")
+
+    state, refresh = cache.lookup(key)
+    assert state is not None
+    assert (state.task_id, refresh) == ("t1", True)
+    # the stale result is still served, but only one refresh is started
+    start(task_mgr, cache, key, "t2")
+    state, refresh = cache.lookup(key)
+    assert state is not None
+    assert (state.task_id, refresh) == ("t1", False)
+
+
+def test_workers_attach_to_the_same_task(task_mgr, new_task):
+    # the caches of two workers of the pod, sharing the task state store
+    cache, other = QueryResultCache(task_mgr), QueryResultCache(task_mgr)
+    key = cache.make_key("what is rag?")
+    new_task(task_mgr, "t1")
+    new_task(task_mgr, "t2")
+    assert cache.register(key, "t1") == "t1"
+    # an identical request on the other worker which raced the first one
+    assert other.register(key, "t2") == "t1"
+    state, _ = other.lookup(key)
+    assert state is not None and state.task_id == "t1"
+
+    _complete(task_mgr, "t1")
+    cache.finish(key, "t1")
+    state, refresh = other.lookup(key)
+    assert state is not None
+    assert (state.task_id, state.task_status, refresh) == ("t1", "COMPLETED", False)
+
+
+def test_finished_tasks_release_their_key(task_mgr, start):
+    cache = QueryResultCache(task_mgr, max_size=8)
+    for idx in range(20):
+        key = cache.make_key(f"query {idx}")
+        start(task_mgr, cache, key, f"t{idx}")
+        if idx % 2:
+            _complete(task_mgr, f"t{idx}")
+        else:
+            task_mgr.update_fields(f"t{idx}", task_status="FAILED")
+        # none of the queries is ever asked again
+        cache.finish(key, f"t{idx}")
+        assert task_mgr.read_key(cache._in_flight_key(key)) is None
+        assert (task_mgr.read_key(cache._result_key(key)) is not None) == bool(idx % 2)
+    # the results stay in the store, the worker only keeps the ones it looked up
+    assert len(cache._results) == 0
+    state, _ = cache.lookup(cache.make_key("query 1"))
+    assert state is not None and state.task_id == "t1"
+    assert len(cache._results) == 1
+
+
+def test_tasks_which_never_finish_stop_being_attached_to(task_mgr, start):
+    # e.g. because their worker died before reporting them done
+    cache = QueryResultCache(task_mgr, in_flight_ttl=-1.0)
+    key = cache.make_key("what is rag?")
+    start(task_mgr, cache, key, "t1")
+    assert cache.lookup(key) == (None, False)
+    start(task_mgr, cache, key, "t2")
+    assert task_mgr.read_key(cache._in_flight_key(key))[0] == "t2"
@@ -0,0 +1,184 @@
+import os
+import threading
+from time import time
+
+import pytest
+from nora_lib.tasks.state import NoSuchTaskException
+
+from tool.locked_state import ACTIVE_TASK_AGE, LockedStateManager
+from tool.models import AsyncTaskState, GeneratedIteration, TaskResult
+from tool.sqlite_state import SqliteStateManager, check_local_db_path
+
+
+@pytest.fixture(params=["file", "sqlite"])
+def task_mgr(request, tmp_path):
+    if request.param == "sqlite":
+        return SqliteStateManager(AsyncTaskState, str(tmp_path / "task_state.db"))
+    return LockedStateManager(AsyncTaskState, str(tmp_path))
+
+
+def _make_old(task_mgr, task_id: str, age: float) -> None:
+    """Backdate the last update of the task by `age` seconds"""
+    updated_at = time() - age
+    if isinstance(task_mgr, SqliteStateManager):
+        task_mgr._connection().execute(
+            "UPDATE task_state SET updated_at = ? WHERE task_id = ?", (updated_at, task_id)
+        )
+    else:
+        os.utime(os.path.join(task_mgr._state_dir, f"{task_id}.json"), (updated_at, updated_at))
+
+
+def test_write_and_read_state(task_mgr, new_task):
+    new_task(task_mgr, "t1", start=1.0)
+    state = task_mgr.read_state("t1")
+    assert (state.task_id, state.query, state.task_status, state.extra_state) == ("t1", "what is rag?", "STARTED",
+                                                                                 {"start": 1.0})
+    with pytest.raises(NoSuchTaskException):
+        task_mgr.read_state("missing")
+
+
+def test_update_fields_merges_extra_state(task_mgr, new_task):
+    new_task(task_mgr, "t1", start=1.0)
+    result = TaskResult(iterations=[GeneratedIteration(text="answer", citations=[])])
+    task_mgr.update_fields("t1", task_status="COMPLETED", task_result=result, extra_state={"end": 2.0})
+
+    state = task_mgr.read_state("t1")
+    assert state.task_status == "COMPLETED"
+    assert state.estimated_time == "1 minute"
+    assert state.task_result.iterations[0].text == "answer"
+    assert state.extra_state == {"start": 1.0, "end": 2.0}
+    with pytest.raises(NoSuchTaskException):
+        task_mgr.update_fields("missing", task_status="FAILED", extra_state={"error": "boom"})
+
+
+def test_update_unless_finished_keeps_the_outcome(task_mgr, new_task):
+    new_task(task_mgr, "t1", start=1.0)
+    # a poller noticed the timeout first, then the runner stops and reports the task as cancelled
+    assert task_mgr.update_fields("t1", task_status="FAILED", extra_state={"timed_out": True}, unless_finished=True)
+    assert not task_mgr.update_fields(
+        "t1", task_status="TERMINATED", extra_state={"error": "Task was cancelled"}, unless_finished=True
+    )
+
+    state = task_mgr.read_state("t1")
+    assert state.task_status == "FAILED"
+    assert state.extra_state == {"start": 1.0, "timed_out": True}
+    with pytest.raises(NoSuchTaskException):
+        task_mgr.update_fields("missing", task_status="FAILED", unless_finished=True)
+
+
+def test_concurrent_updates_are_not_lost(task_mgr, new_task):
+    new_task(task_mgr, "t1", start=1.0)
+
+    def _update(idx: int) -> None:
+        for step in range(5):
+            task_mgr.update_fields("t1", extra_state={f"worker-{idx}-{step}": True})
+
+    threads = [threading.Thread(target=_update, args=(idx,)) for idx in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(task_mgr.read_state("t1").extra_state) == 1 + 4 * 5
+
+
+def test_events_are_numbered_in_order(task_mgr, new_task):
+    new_task(task_mgr, "t1", start=1.0)
+    assert task_mgr.read_events("t1") == ([], 0)
+    for idx in range(3):
+        task_mgr.append_event("t1", {"type": "status", "idx": idx})
+
+    events, _ = task_mgr.read_events("t1")
+    assert [seq for seq, _ in events] == [1, 2, 3]
+    assert [event["idx"] for _, event in events] == [0, 1, 2]
+    assert task_mgr.read_events("t1", after=2)[0] == [(3, {"type": "status", "idx": 2})]
+
+
+def test_read_events_from_offset(task_mgr, new_task):
+    new_task(task_mgr, "t1", start=1.0)
+    task_mgr.append_event("t1", {"type": "status", "idx": 0})
+    events, offset = task_mgr.read_events("t1")
+    assert [seq for seq, _ in events] == [1]
+
+    # a poller resuming from the returned offset only gets the events appended since
+    assert task_mgr.read_events("t1", 1, offset) == ([], offset)
+    task_mgr.append_event("t1", {"type": "status", "idx": 1})
+    task_mgr.append_event("t1", {"type": "status", "idx": 2})
+    events, offset = task_mgr.read_events("t1", 1, offset)
+    assert events == [(2, {"type": "status", "idx": 1}), (3, {"type": "status", "idx": 2})]
+    assert task_mgr.read_events("t1", 3, offset)[0] == []
+
+
+def test_expire_tasks_by_age_and_count(task_mgr, new_task):
+    for task_id in ["old", "older", "recent", "new"]:
+        new_task(task_mgr, task_id, start=1.0)
+        task_mgr.append_event(task_id, {"type": "status"})
+    _make_old(task_mgr, "older", 3 * ACTIVE_TASK_AGE)
+    _make_old(task_mgr, "old", 2 * ACTIVE_TASK_AGE)
+    _make_old(task_mgr, "recent", 10)
+
+    # only "older" is past the max age, and tasks updated within ACTIVE_TASK_AGE are kept beyond the max count
+    n_tasks, _ = task_mgr.expire_tasks(max_age=2.5 * ACTIVE_TASK_AGE, max_count=1)
+    assert n_tasks == 2
+    with pytest.raises(NoSuchTaskException):
+        task_mgr.read_state("older")
+    with pytest.raises(NoSuchTaskException):
+        task_mgr.read_state("old")
+    assert task_mgr.read_events("old")[0] == []
+    for task_id in ["recent", "new"]:
+        assert task_mgr.read_state(task_id).task_id == task_id
+
+
+def test_claim_key_keeps_the_recent_claim(task_mgr):
+    assert task_mgr.read_key("k") is None
+    assert task_mgr.claim_key("k", "t1", ttl=60.0) == "t1"
+    assert task_mgr.claim_key("k", "t2", ttl=60.0) == "t1"
+    task_id, updated_at = task_mgr.read_key("k")
+    assert task_id == "t1" and time() - updated_at < 60.0
+    # without a ttl, or once the claim is older than it, the key is taken over
+    assert task_mgr.claim_key("k", "t2") == "t2"
+    assert task_mgr.claim_key("k", "t3", ttl=-1.0) == "t3"
+
+    # only the task recorded for the key releases it
+    task_mgr.release_key("k", "t2")
+    assert task_mgr.read_key("k")[0] == "t3"
+    task_mgr.release_key("k", "t3")
+    assert task_mgr.read_key("k") is None
+
+
+def test_concurrent_claims_agree(task_mgr):
+    claimed = []
+
+    def _claim(idx: int) -> None:
+        claimed.append(task_mgr.claim_key("k", f"t{idx}", ttl=60.0))
+
+    threads = [threading.Thread(target=_claim, args=(idx,)) for idx in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(claimed) == 8 and set(claimed) == {task_mgr.read_key("k")[0]}
+
+
+def test_expire_tasks_drops_old_keys(task_mgr):
+    task_mgr.claim_key("old", "t1")
+    task_mgr.claim_key("new", "t2")
+    updated_at = time() - 2 * ACTIVE_TASK_AGE
+    if isinstance(task_mgr, SqliteStateManager):
+        task_mgr._connection().execute("UPDATE task_key SET updated_at = ? WHERE key = 'old'", (updated_at,))
+    else:
+        os.utime(f"{task_mgr._key_path('old')}.json", (updated_at, updated_at))
+
+    task_mgr.expire_tasks(max_age=ACTIVE_TASK_AGE, max_count=10)
+    assert task_mgr.read_key("old") is None
+    entry = task_mgr.read_key("new")
+    assert entry is not None and entry[0] == "t2"
+
+
+def test_database_is_rejected_on_the_network_filesystem(tmp_path):
+    network_dir = tmp_path / "async-state"
+    for db_path in [network_dir / "task_state.db", network_dir / "sub" / "task_state.db"]:
+        with pytest.raises(ValueError):
+            check_local_db_path(str(db_path), str(network_dir))
+    check_local_db_path(str(tmp_path / "local" / "task_state.db"), str(network_dir))
+    # a sibling directory which merely shares the prefix of its name
+    check_local_db_path(str(tmp_path / "async-state-local" / "task_state.db"), str(network_dir))
@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+
+from tool.task_runner import TaskQueueFullException, TaskRunnerPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = TaskRunnerPool(pool_size=2, max_pending=2, mode="thread", runner_dir=str(tmp_path))
+    yield pool
+    pool.shutdown(wait=False)
+
+
+def _blocking_task(started: threading.Event, release: threading.Event) -> None:
+    started.set()
+    release.wait(5)
+
+
+def test_tasks_wait_for_a_free_runner(pool):
+    release = threading.Event()
+    started = [threading.Event() for _ in range(3)]
+    positions = [pool.submit(f"task-{i}", _blocking_task, started[i], release) for i in range(3)]
+    assert positions == [0, 0, 1]
+    assert started[0].wait(5) and started[1].wait(5)
+    assert not started[2].is_set()
+    assert pool.queue_position("task-2") == 1
+    assert pool.n_tasks == 3
+
+    release.set()
+    assert started[2].wait(5)
+
+
+def test_full_queue_rejects_new_tasks(pool):
+    release = threading.Event()
+    for i in range(4):
+        pool.submit(f"task-{i}", _blocking_task, threading.Event(), release)
+    assert pool.is_full()
+    with pytest.raises(TaskQueueFullException) as e:
+        pool.submit("task-4", _blocking_task, threading.Event(), release)
+    assert e.value.retry_after >= 1
+    assert pool.queue_position("task-4") is None
+    release.set()
+
+
+def test_cancel_drops_a_queued_task_only(pool):
+    release = threading.Event()
+    started = [threading.Event() for _ in range(3)]
+    for i in range(3):
+        pool.submit(f"task-{i}", _blocking_task, started[i], release)
+    started[0].wait(5)
+
+    assert pool.cancel("task-2")
+    # running and unknown tasks are not in the queue
+    assert not pool.cancel("task-0")
+    assert not pool.cancel("task-9")
+    assert pool.queue_position("task-2") is None
+
+    release.set()
+    pool.shutdown(wait=True)
+    assert not started[2].is_set()
+
+
+def test_on_done_is_called_for_finished_and_cancelled_tasks(pool):
+    release = threading.Event()
+    done = []
+    for i in range(3):
+        pool.submit(f"task-{i}", _blocking_task, threading.Event(), release,
+                    on_done=lambda task_id=f"task-{i}": done.append(task_id))
+    pool.cancel("task-2")
+    assert done == ["task-2"]
+
+    release.set()
+    pool.shutdown(wait=True)
+    assert sorted(done) == ["task-0", "task-1", "task-2"]
+
+
+def test_runners_are_shared_by_the_workers_of_a_pod(pool, tmp_path):
+    # another gunicorn worker of the same pod
+    other_pool = TaskRunnerPool(pool_size=2, max_pending=2, mode="thread", runner_dir=str(tmp_path))
+    release, other_release = threading.Event(), threading.Event()
+    started = [threading.Event() for _ in range(3)]
+    assert other_pool.submit("task-0", _blocking_task, started[0], other_release) == 0
+    assert pool.submit("task-1", _blocking_task, started[1], release) == 0
+    assert pool.submit("task-2", _blocking_task, started[2], release) == 1
+    assert started[0].wait(5) and started[1].wait(5)
+    assert not started[2].is_set()
+
+    # the runner freed up by the other worker is picked up by polling
+    other_release.set()
+    assert started[2].wait(5)
+    release.set()
+    other_pool.shutdown(wait=True)
+
+
+def test_the_queue_is_shared_by_the_workers_of_a_pod(pool, tmp_path):
+    other_pool = TaskRunnerPool(pool_size=2, max_pending=2, mode="thread", runner_dir=str(tmp_path))
+    release = threading.Event()
+    started = [threading.Event() for _ in range(4)]
+    done = []
+    for i in range(4):
+        owner = pool if i % 2 else other_pool
+        owner.submit(f"task-{i}", _blocking_task, started[i], release, on_done=lambda i=i: done.append(i))
+    # positions and admission are the same from every worker
+    assert [other_pool.queue_position(f"task-{i}") for i in range(4)] == [0, 0, 1, 2]
+    assert pool.is_full() and other_pool.is_full()
+    with pytest.raises(TaskQueueFullException):
+        pool.submit("task-4", _blocking_task, threading.Event(), release)
+
+    # a task cancelled by another worker is dropped by its owner
+    assert pool.cancel("task-2")
+    assert pool.queue_position("task-2") is None and pool.queue_position("task-3") == 1
+    assert not pool.is_full()
+    release.set()
+    assert started[3].wait(5)
+    other_pool.shutdown(wait=True)
+    assert not started[2].is_set()
+    assert 2 in done
+
+
+def test_rejects_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        TaskRunnerPool(mode="fiber", runner_dir=str(tmp_path))
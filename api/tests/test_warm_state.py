@@ -0,0 +1,48 @@
+import threading
+import time
+
+from tool.warm_state import WarmStateTracker
+
+
+def _tracker(pings: list) -> WarmStateTracker:
+    tracker = WarmStateTracker()
+    # a deployment which is always cold, so every check pings it
+    tracker.register("llm", lambda: pings.append(threading.current_thread().name), scaledown_window=0.0)
+    return tracker
+
+
+def test_concurrent_warm_ups_share_a_ping():
+    release, pings = threading.Event(), []
+
+    def _ping() -> None:
+        release.wait(5)
+        pings.append(1)
+
+    tracker = WarmStateTracker()
+    tracker.register("llm", _ping, scaledown_window=60.0)
+    done = tracker.ensure_warm("llm")
+    assert done is not None and tracker.ensure_warm("llm") is done
+
+    release.set()
+    assert done.wait(5)
+    assert pings == [1]
+    assert tracker.is_warm("llm") and tracker.ensure_warm("llm") is None
+
+
+def test_only_the_leader_keeps_dependencies_warm(tmp_path):
+    lock_path = str(tmp_path / ".keep_warm.lock")
+    leader_pings, follower_pings = [], []
+    leader, follower = _tracker(leader_pings), _tracker(follower_pings)
+    leader.start_keep_warm(interval=0.01, lock_path=lock_path)
+    time.sleep(0.2)
+    follower.start_keep_warm(interval=0.01, lock_path=lock_path)
+    time.sleep(0.2)
+    assert leader_pings and not follower_pings
+
+    # the follower takes over once the leader is gone
+    leader.stop()
+    assert leader._thread is not None
+    leader._thread.join(5)
+    time.sleep(0.2)
+    follower.stop()
+    assert follower_pings
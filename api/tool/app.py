@@ -1,18 +1,27 @@
+import asyncio
+import json
 import logging
-import multiprocessing
+import math
 import os
 import uuid
-from json import JSONDecodeError
+from functools import partial
 from time import time
-from typing import Union
+from typing import Any, Dict, Optional, Tuple, Union, cast
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from nora_lib.tasks.models import TASK_STATUSES
 from nora_lib.tasks.state import NoSuchTaskException
 
 from tool import glog
+from tool.context_packer import get_tokenizer
+from tool.deadline import call_deadline
+from tool.janitor import StateJanitor
 from tool.locked_state import LockedStateManager
+from tool.metrics import render_metrics
 from tool.models import (
+    FINISHED_TASK_STATUSES,
     AsyncTaskState,
     AsyncToolResponse,
     Papers,
@@ -21,7 +30,11 @@ from tool.models import (
     ToolResponse
 )
 from tool.open_scholar import OpenScholar
-from tool.utils import query_s2_api
+from tool.paper_details import PaperDetailsFetcher
+from tool.result_cache import QueryResultCache
+from tool.sqlite_state import SqliteStateManager, check_local_db_path
+from tool.task_runner import TaskCancelledException, TaskQueueFullException, TaskRunnerPool
+from tool.warm_state import warm_state
 
 # If LOG_FORMAT is "google:json" emit log message as JSON in a format Google Cloud can parse.
 fmt = os.getenv("LOG_FORMAT")
@@ -33,18 +46,34 @@ logging.basicConfig(level=level, handlers=handlers)
 logger = logging.getLogger(__name__)
 
 ASYNC_STATE_DIR = os.getenv("ASYNC_STATE_DIR", "/async-state")
+# "file" keeps one json file per task in ASYNC_STATE_DIR, "sqlite" one row per task in the database at
+# TASK_STATE_DB_PATH. The database must be on a pod-local filesystem (not in ASYNC_STATE_DIR, which is mounted from a
+# network filesystem), so its tasks are only known to the pod which created them
+TASK_STATE_BACKEND = os.getenv("TASK_STATE_BACKEND", "file")
+TASK_STATE_DB_PATH = os.getenv("TASK_STATE_DB_PATH", "/var/lib/open-scholar/task_state.db")
 
 TIMEOUT = 240
+# How often (in seconds) the event stream of a task is checked for new events, and a keep-alive comment is sent
+EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", 0.25))
+EVENTS_KEEP_ALIVE_INTERVAL = 15
 
 if not os.path.exists(ASYNC_STATE_DIR):
     os.makedirs(ASYNC_STATE_DIR)
 
-task_state_manager = LockedStateManager(AsyncTaskState, ASYNC_STATE_DIR)
-async_context = multiprocessing.get_context("fork")
+if TASK_STATE_BACKEND == "sqlite":
+    check_local_db_path(TASK_STATE_DB_PATH, ASYNC_STATE_DIR)
+    os.makedirs(os.path.dirname(os.path.abspath(TASK_STATE_DB_PATH)), exist_ok=True)
+    task_state_manager = SqliteStateManager(AsyncTaskState, TASK_STATE_DB_PATH)
+else:
+    task_state_manager = LockedStateManager(AsyncTaskState, ASYNC_STATE_DIR)
+task_runner_pool = TaskRunnerPool()
 open_scholar = OpenScholar(task_state_manager, llm_model="os_8b")
+result_cache = QueryResultCache(task_state_manager, in_flight_ttl=TIMEOUT)
+state_janitor = StateJanitor(task_state_manager, ASYNC_STATE_DIR)
+paper_details_fetcher = PaperDetailsFetcher()
 
 
-def _do_task(tool_request: ToolRequest, task_id: str) -> TaskResult:
+def _do_task(tool_request: ToolRequest, task_id: str, timings: Optional[Dict[str, float]] = None) -> TaskResult:
     """
     TODO: BYO logic here. Don't forget to define `ToolRequest` and `TaskResult`
     in `models.py`!
@@ -52,7 +81,7 @@ def _do_task(tool_request: ToolRequest, task_id: str) -> TaskResult:
     The meat of whatever it is your tool or task agent actually
     does should be kicked off in here. This will be run synchonrously
     unless `_needs_to_be_async()` above returns True, in which case
-    it will be run in a background process.
+    it will be run by one of the runners of `task_runner_pool`.
 
     If you need to update state for an asynchronously running task, you can
     use `task_state_manager.read_state(task_id)` to retrieve, and `.write_state()`
@@ -60,24 +89,42 @@ def _do_task(tool_request: ToolRequest, task_id: str) -> TaskResult:
     """
 
     return open_scholar.answer_query(
-        tool_request, task_id
+        tool_request, task_id, timings
     )
 
 
-def _estimate_task_length(tool_request: ToolRequest) -> str:
+def _estimate_task_length(tool_request: ToolRequest) -> int:
     """
 
     For telling the user how long to wait before asking for a status
     update on async tasks. This can just be a static guess, but you
     have access to the request if you want to do something fancier.
+    Returns the estimate in minutes, without the time spent waiting in the queue.
     """
     return (
-        "1 minute"
+        1
         if not (tool_request.feedback_toggle and open_scholar.n_feedback)
-        else f"{1 + open_scholar.n_feedback} minutes"
+        else 1 + open_scholar.n_feedback
     )
 
 
+def _result_cache_key(tool_request: ToolRequest) -> str:
+    # requests are answered the same if their queries only differ trivially and they run the same pipeline
+    return result_cache.make_key(
+        tool_request.query,
+        n_retrieval=open_scholar.n_retrieval,
+        n_rerank=open_scholar.n_rerank,
+        n_feedback=open_scholar.n_feedback if tool_request.feedback_toggle else 0,
+        llm_model=open_scholar.llm_model,
+    )
+
+
+def _format_estimated_time(n_minutes: int, queue_position: int = 0) -> str:
+    # a queued task additionally waits for a runner to free up
+    n_minutes += math.ceil(task_runner_pool.estimate_wait(queue_position) / 60)
+    return "1 minute" if n_minutes == 1 else f"{n_minutes} minutes"
+
+
 ###########################################################################
 ### BELOW THIS LINE IS ALL TEMPLATE CODE THAT SHOULD NOT NEED TO CHANGE ###
 ###########################################################################
@@ -86,6 +133,20 @@ def _estimate_task_length(tool_request: ToolRequest) -> str:
 def create_app() -> FastAPI:
     app = FastAPI(root_path="/api")
 
+    @app.on_event("startup")
+    def startup():  # pyright: ignore reportUnusedFunction
+        state_janitor.start()
+        # load the tokenizer now rather than in the request path
+        get_tokenizer()
+        warm_state.start_keep_warm(lock_path=os.path.join(ASYNC_STATE_DIR, ".keep_warm.lock"))
+
+    @app.on_event("shutdown")
+    def shutdown():  # pyright: ignore reportUnusedFunction
+        state_janitor.stop()
+        warm_state.stop()
+        task_runner_pool.shutdown(wait=False)
+        paper_details_fetcher.shutdown()
+
     @app.get("/")
     def root():
         return "nothing to see here :)"
@@ -97,6 +158,11 @@ def create_app() -> FastAPI:
     def health():
         return "OK"
 
+    @app.get("/metrics")
+    def metrics() -> Response:  # pyright: ignore reportUnusedFunction
+        content, media_type = render_metrics()
+        return Response(content=content, media_type=media_type)
+
     @app.post("/query_open_scholar")
     def use_tool(
             tool_request: ToolRequest,
@@ -106,18 +172,135 @@ def create_app() -> FastAPI:
         if tool_request.task_id:
             return _handle_async_task_check_in(tool_request.task_id)
 
+        # Identical query answered recently, or being answered right now
+        cache_key = _result_cache_key(tool_request)
+        cached_state, refresh = result_cache.lookup(cache_key)
+        if refresh:
+            _refresh_cached_result(cache_key, tool_request)
+        if cached_state is not None:
+            if cached_state.task_status == TASK_STATUSES["COMPLETED"] and cached_state.task_result:
+                logger.info(f"{cached_state.task_id}: Serving cached result for query: {tool_request.query}")
+                return ToolResponse(
+                    task_id=cached_state.task_id,
+                    query=tool_request.query,
+                    task_result=cached_state.task_result,
+                )
+            logger.info(f"{cached_state.task_id}: Attaching to the in-flight task for query: {tool_request.query}")
+            return _handle_async_task_check_in(cached_state.task_id)
+
         # New task
         task_id = str(uuid.uuid4())
 
         logger.info(f"{task_id}: New task")
-        estimated_time = _start_async_task(task_id, tool_request)
+        try:
+            task_state, queue_position = _start_async_task(task_id, tool_request, cache_key)
+        except TaskQueueFullException as e:
+            logger.warning(f"{task_id}: Rejected, {e}")
+            raise HTTPException(
+                status_code=429,
+                detail="OpenScholar is handling too many requests right now, please try again in a bit.",
+                headers={"Retry-After": str(e.retry_after)},
+            )
 
         return AsyncToolResponse(
-            task_id=task_id,
+            task_id=task_state.task_id,
             query=tool_request.query,
-            estimated_time=estimated_time,
-            task_status=TASK_STATUSES["STARTED"],
+            estimated_time=task_state.estimated_time,
+            task_status=task_state.task_status,
             task_result=None,
+            queue_position=queue_position,
+        )
+
+    @app.get("/query_open_scholar/{task_id}/events")
+    async def task_events(  # pyright: ignore reportUnusedFunction
+            task_id: str,
+            request: Request,
+            last_event_id: Optional[str] = Header(default=None),
+    ) -> StreamingResponse:
+        """
+        Server-sent events stream of a task's status updates ("status"), generated iterations ("iteration"),
+        drafts streamed from the LLM ("draft") and its outcome ("completed", "failed" or "cancelled"), as an
+        alternative to polling `/query_open_scholar`. A draft event carries only what changed since the previous
+        draft of its stage: the draft is its first `offset` characters followed by `text`.
+        Reconnecting clients can resume from the `Last-Event-ID` header.
+        """
+        try:
+            task_state = await run_in_threadpool(task_state_manager.read_state, task_id)
+        except NoSuchTaskException:
+            raise HTTPException(
+                status_code=404, detail=f"Referenced task {task_id} does not exist."
+            )
+
+        async def event_stream():
+            after = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+            # only the events appended since the previous poll are read
+            offset, last_sent = 0, time()
+            while not await request.is_disconnected():
+                events, offset = await run_in_threadpool(task_state_manager.read_events, task_id, after, offset)
+                for seq, event in events:
+                    yield f"id: {seq}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                    after, last_sent = seq, time()
+                    if event["type"] in {"completed", "failed", "cancelled"}:
+                        return
+                if not events and time() - task_state.extra_state.get("start", time()) > TIMEOUT:
+                    # nobody might be polling, so the stream has to enforce the timeout as well
+                    state = await run_in_threadpool(task_state_manager.read_state, task_id)
+                    if state.task_status not in FINISHED_TASK_STATUSES:
+                        await run_in_threadpool(_fail_timed_out_task, task_id)
+                        continue
+                    # a task which finished before it had an event log
+                    event = {"type": {
+                        TASK_STATUSES["COMPLETED"]: "completed", TASK_STATUSES["TERMINATED"]: "cancelled"
+                    }.get(state.task_status, "failed")}
+                    yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+                    return
+                if time() - last_sent > EVENTS_KEEP_ALIVE_INTERVAL:
+                    yield ": keep-alive\n\n"
+                    last_sent = time()
+                await asyncio.sleep(EVENTS_POLL_INTERVAL)
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @app.delete("/query_open_scholar/{task_id}", status_code=202)
+    def cancel_task(task_id: str) -> AsyncToolResponse:  # pyright: ignore reportUnusedFunction
+        """
+        Cancel a task. A task waiting in the queue is dropped right away, whichever worker of the pod queued it. A
+        task queued on another pod is dropped once it gets to a runner. A running task stops at its next stage, or at
+        the next streamed chunk of a draft, which aborts the streamed LLM call. Calls which do not stream (Semantic
+        Scholar, the reranker, the non-streamed LLM calls) run to completion before the task stops and frees its runner.
+        """
+        try:
+            task_state = cast(AsyncTaskState, task_state_manager.read_state(task_id))
+        except NoSuchTaskException:
+            raise HTTPException(
+                status_code=404, detail=f"Referenced task {task_id} does not exist."
+            )
+        if task_state.task_status in FINISHED_TASK_STATUSES:
+            raise HTTPException(status_code=409, detail="Referenced task has already finished.")
+
+        logger.info(f"{task_id}: Cancellation requested")
+        if task_runner_pool.cancel(task_id):
+            # never got to a runner, so there is nobody else to record the outcome
+            error = "Task was cancelled"
+            task_state_manager.update_fields(
+                task_id, task_status=TASK_STATUSES["TERMINATED"], estimated_time="--",
+                extra_state={"error": error, "cancel_requested": True},
+            )
+            task_state_manager.append_event(task_id, {"type": "cancelled", "error": error})
+        else:
+            task_state_manager.update_fields(task_id, extra_state={"cancel_requested": True})
+
+        task_state = cast(AsyncTaskState, task_state_manager.read_state(task_id))
+        return AsyncToolResponse(
+            task_id=task_state.task_id,
+            query=task_state.query,
+            estimated_time=task_state.estimated_time,
+            task_status=task_state.task_status,
+            task_result=task_state.task_result,
         )
 
     @app.post("/paper_details")
@@ -125,55 +308,130 @@ def create_app() -> FastAPI:
         fieldstring = "authors,title,year"
         if papers.fields:
             fieldstring = ",".join(papers.fields)
-        data = query_s2_api(
-            end_pt="paper/batch",
-            method="post",
-            params={"fields": fieldstring},
-            payload={"ids": [f"CorpusId:{cid}" for cid in papers.corpus_ids]},
-        )
-        return data
+        return paper_details_fetcher.get(papers.corpus_ids, fieldstring)
 
     return app
 
 
-def _start_async_task(task_id: str, tool_request: ToolRequest) -> str:
-    estimated_time = _estimate_task_length(tool_request)
-
+def _do_task_and_write_result(tool_request: ToolRequest, task_id: str) -> None:
+    # the stages which ran are recorded whatever the outcome, failed and cancelled tasks are the slow ones
+    timings: Dict[str, float] = dict()
+    extra_state: Dict[str, Any] = {"timings": timings}
+    deadline = None
+    try:
+        # a task cancelled by another worker, or timed out, while waiting in the queue is not started at all
+        open_scholar.check_cancelled(task_id)
+        # the calls to the LLM, the reranker and S2 made for the task time out at its deadline
+        deadline = cast(AsyncTaskState, task_state_manager.read_state(task_id)).extra_state.get("deadline")
+        with call_deadline(deadline):
+            task_result = _do_task(tool_request, task_id, timings)
+        task_status = TASK_STATUSES["COMPLETED"]
+        extra_state["end"] = time()
+    except TaskCancelledException as e:
+        task_result = None
+        if e.timed_out:
+            task_status = TASK_STATUSES["FAILED"]
+            extra_state["error"] = f"Task timed out after {TIMEOUT} seconds"
+        else:
+            task_status = TASK_STATUSES["TERMINATED"]
+            extra_state["error"] = "Task was cancelled"
+        logger.info(f"{task_id}: stopped, {e}")
+        open_scholar.n_published_iterations.pop(task_id, None)
+    except Exception as e:
+        task_result = None
+        task_status = TASK_STATUSES["FAILED"]
+        if deadline is not None and time() > deadline:
+            # most likely a call which was cut short by the deadline
+            extra_state["error"] = f"Task timed out after {TIMEOUT} seconds"
+            extra_state["timed_out"] = True
+        else:
+            extra_state["error"] = str(e)
+        open_scholar.n_published_iterations.pop(task_id, None)
+
+    if not task_state_manager.update_fields(
+            task_id, task_status=task_status, estimated_time="--", task_result=task_result, extra_state=extra_state,
+            unless_finished=True,
+    ):
+        # e.g. failed by whoever noticed the timeout first, which also logged the outcome
+        logger.info(f"{task_id}: already finished, not overwriting its outcome with {task_status}")
+        task_state_manager.update_fields(task_id, extra_state={"timings": timings})
+        return
+    if task_status == TASK_STATUSES["COMPLETED"]:
+        task_state_manager.append_event(task_id, {"type": "completed"})
+    elif task_status == TASK_STATUSES["TERMINATED"]:
+        task_state_manager.append_event(task_id, {"type": "cancelled", "error": extra_state["error"]})
+    else:
+        task_state_manager.append_event(task_id, {"type": "failed", "error": extra_state["error"]})
+
+
+def _fail_timed_out_task(task_id: str) -> None:
+    error = f"Task timed out after {TIMEOUT} seconds"
+    # the runner checks for timed_out between stages and stops working on the task
+    if task_state_manager.update_fields(
+            task_id, task_status=TASK_STATUSES["FAILED"], extra_state={"error": error, "timed_out": True},
+            unless_finished=True,
+    ):
+        task_state_manager.append_event(task_id, {"type": "failed", "error": error})
+
+
+def _refresh_cached_result(cache_key: str, tool_request: ToolRequest) -> None:
+    """Re-run a query whose cached result went stale, the stale result is served in the meantime"""
+    task_id = str(uuid.uuid4())
+    try:
+        task_state, _ = _start_async_task(task_id, tool_request, cache_key)
+    except TaskQueueFullException:
+        # refreshing is best effort, it can wait for the next request once the load drops
+        return
+    if task_state.task_id != task_id:
+        # another worker is refreshing it already
+        return
+    logger.info(f"{task_id}: Refreshing the stale cached result for query: {tool_request.query}")
+
+
+def _start_async_task(task_id: str, tool_request: ToolRequest, cache_key: str) -> Tuple[AsyncTaskState, int]:
+    # reject early, before any state is written for a task which is never going to run
+    if task_runner_pool.is_full():
+        raise TaskQueueFullException(task_runner_pool.retry_after())
+
+    n_minutes = _estimate_task_length(tool_request)
+    queue_position = task_runner_pool.next_queue_position()
     task_state = AsyncTaskState(
         task_id=task_id,
         query=tool_request.query,
-        estimated_time=estimated_time,
-        task_status=TASK_STATUSES["STARTED"],
+        estimated_time=_format_estimated_time(n_minutes, queue_position),
+        task_status=(
+            f"{time()}:Waiting for a free task runner, position {queue_position} in the queue"
+            if queue_position else TASK_STATUSES["STARTED"]
+        ),
         task_result=None,
-        extra_state={"start": time()},
+        extra_state={"start": time(), "deadline": time() + TIMEOUT, "n_minutes": n_minutes},
     )
     task_state_manager.write_state(task_state)
 
-    def _do_task_and_write_result():
-        extra_state = {}
-        try:
-            task_result = _do_task(tool_request, task_id)
-            task_status = TASK_STATUSES["COMPLETED"]
-            extra_state["end"] = time()
-        except Exception as e:
-            task_result = None
-            task_status = TASK_STATUSES["FAILED"]
-            extra_state["error"] = str(e)
-
-        state = task_state_manager.read_state(task_id)
-        state.task_result = task_result
-        state.task_status = task_status
-        state.extra_state.update(extra_state)
-        state.estimated_time = "--"
-        task_state_manager.write_state(state)
-
-    async_context.Process(
-        target=_do_task_and_write_result,
-        name=f"Async Task {task_id}",
-        args=(),
-    ).start()
+    # identical requests attach to the task until the pool reports it done, which can happen before submit returns
+    owner_id = result_cache.register(cache_key, task_id)
+    if owner_id != task_id:
+        # an identical request on another worker got there first, attach to its task instead
+        error = f"Superseded by task {owner_id}"
+        task_state_manager.update_fields(task_id, task_status=TASK_STATUSES["TERMINATED"], estimated_time="--",
+                                         extra_state={"error": error})
+        task_state_manager.append_event(task_id, {"type": "cancelled", "error": error})
+        logger.info(f"{task_id}: {error}")
+        owner_state = cast(AsyncTaskState, task_state_manager.read_state(owner_id))
+        return owner_state, task_runner_pool.queue_position(owner_id) or 0
+    try:
+        queue_position = task_runner_pool.submit(
+            task_id, _do_task_and_write_result, tool_request, task_id,
+            on_done=partial(result_cache.finish, cache_key, task_id),
+        )
+    except TaskQueueFullException as e:
+        # lost the race for the last spot in the queue to a concurrent request
+        task_state_manager.update_fields(task_id, task_status=TASK_STATUSES["FAILED"], extra_state={"error": str(e)})
+        task_state_manager.append_event(task_id, {"type": "failed", "error": str(e)})
+        result_cache.finish(cache_key, task_id)
+        raise
 
-    return estimated_time
+    return task_state, queue_position
 
 
 def _handle_async_task_check_in(
@@ -194,15 +452,6 @@ def _handle_async_task_check_in(
         raise HTTPException(
             status_code=404, detail=f"Referenced task {task_id} does not exist."
         )
-    except JSONDecodeError as e:
-        logger.warning(f"{task_id} state file is corrupted, should be updated on next poll: {e}")
-        return AsyncToolResponse(
-            task_id=task_id,
-            query="",
-            estimated_time="1 minute",
-            task_status=f"{time()}: Processing user query",
-            task_result=None,
-        )
 
     # Retrieve data, which is just on local disk for now
     if task_state.task_status == TASK_STATUSES["FAILED"]:
@@ -229,22 +478,28 @@ def _handle_async_task_check_in(
             task_result=task_state.task_result,
         )
 
-    if task_state.task_status not in {TASK_STATUSES["COMPLETED"],
-                                      TASK_STATUSES["FAILED"]} and "start" in task_state.extra_state:
+    if task_state.task_status == TASK_STATUSES["TERMINATED"]:
+        raise HTTPException(status_code=410, detail="Referenced task was cancelled.")
+
+    if task_state.task_status not in FINISHED_TASK_STATUSES and "start" in task_state.extra_state:
         elapsed = time() - task_state.extra_state["start"]
         if elapsed > TIMEOUT:
-            task_state.task_status = TASK_STATUSES["FAILED"]
-            task_state.extra_state["error"] = f"Task timed out after {TIMEOUT} seconds"
-            task_state_manager.write_state(task_state)
+            _fail_timed_out_task(task_id)
             logger.info(f"{task_id}: timed out after {time() - task_state.extra_state['start']} seconds.")
             raise HTTPException(
                 status_code=500,
                 detail=f"Task timed out after {TIMEOUT} seconds.")
 
+    # queue positions are only known to the pod the task is queued on
+    queue_position = task_runner_pool.queue_position(task_id)
+    if queue_position and "n_minutes" in task_state.extra_state:
+        task_state.estimated_time = _format_estimated_time(task_state.extra_state["n_minutes"], queue_position)
+
     return AsyncToolResponse(
         task_id=task_state.task_id,
         query=task_state.query,
         estimated_time=task_state.estimated_time,
         task_status=task_state.task_status,
         task_result=task_state.task_result,
+        queue_position=queue_position,
     )
@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+from time import time
+from typing import Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """
+    Thread-safe LRU cache whose entries expire `ttl` seconds after they were set.
+    Entries are kept around for another `stale_ttl` seconds, during which they can still be read with `get_with_age`
+    (to serve them while they are refreshed), before they are evicted.
+    """
+
+    def __init__(self, max_size: int, ttl: float, stale_ttl: float = 0.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, Tuple[V, float]] = OrderedDict()
+
+    def get_with_age(self, key: Hashable) -> Optional[Tuple[V, float]]:
+        """The value for the key along with its age in seconds, which can exceed `ttl` for a stale value"""
+        with self._lock:
+            if key not in self._entries:
+                return None
+            value, created = self._entries[key]
+            age = time() - created
+            if age > self.ttl + self.stale_ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value, age
+
+    def get(self, key: Hashable) -> Optional[V]:
+        """The value for the key if it has not expired yet"""
+        entry = self.get_with_age(key)
+        return entry[0] if entry and entry[1] <= self.ttl else None
+
+    def set(self, key: Hashable, value: V) -> None:
+        with self._lock:
+            self._entries[key] = (value, time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return entry[0] if entry else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,116 @@
+import logging
+import math
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Optional
+
+try:
+    import tokenizers
+except ImportError:
+    tokenizers = None
+
+if TYPE_CHECKING:
+    from tokenizers import Tokenizer
+
+logger = logging.getLogger(__name__)
+
+# Path to the tokenizer.json of the generation model, baked into the image (see the Dockerfile),
+# or a Hugging Face hub id to download it from when it is loaded at startup
+LLM_TOKENIZER = os.getenv("LLM_TOKENIZER", "akariasai/os_8b")
+# Context length of the vLLM server, see max_model_len of the Modal deployment
+LLM_MAX_MODEL_LEN = int(os.getenv("LLM_MAX_MODEL_LEN", 8096))
+# Tokens added by the chat template around the system and user messages
+CHAT_TEMPLATE_OVERHEAD = 32
+# Used to estimate token counts when the tokenizer is not available, on the high side for scientific text
+TOKENS_PER_WORD = 1.5
+PASSAGE_TOKEN_CACHE_SIZE = int(os.getenv("PASSAGE_TOKEN_CACHE_SIZE", 50000))
+# the citation marker in front of a formatted passage, the space after it is tokenized with the word which follows
+_PASSAGE_MARKER = re.compile(r"\[\d+\]")
+
+_tokenizer: Optional["Tokenizer"] = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer() -> Optional["Tokenizer"]:
+    """
+    The tokenizer of the generation model, or None if it cannot be loaded.
+    It is loaded by the app at startup, so that a missing file never costs a download in the request path.
+    """
+    global _tokenizer, _tokenizer_loaded
+    with _tokenizer_lock:
+        if not _tokenizer_loaded:
+            _tokenizer_loaded = True
+            if tokenizers is None:
+                logger.warning("tokenizers is not installed, token counts are estimated from word counts")
+            else:
+                try:
+                    if os.path.exists(LLM_TOKENIZER):
+                        _tokenizer = tokenizers.Tokenizer.from_file(LLM_TOKENIZER)
+                    else:
+                        logger.error(f"Tokenizer file {LLM_TOKENIZER} not found, downloading it from the Hugging Face "
+                                     f"hub. Point LLM_TOKENIZER to the tokenizer.json baked into the image instead")
+                        _tokenizer = tokenizers.Tokenizer.from_pretrained(LLM_TOKENIZER)
+                except Exception as e:
+                    logger.error(f"Failed to load tokenizer {LLM_TOKENIZER}, token counts are estimated: {e}")
+        return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    if (tokenizer := get_tokenizer()) is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return math.ceil(len(text.split()) * TOKENS_PER_WORD)
+
+
+def count_passage_tokens(passage: str) -> int:
+    """
+    Token count of a passage formatted with its "[idx]" citation marker. The text is counted apart from the marker
+    and cached, as the same passages are packed into several prompts, at different indices.
+    """
+    if marker := _PASSAGE_MARKER.match(passage):
+        return _count_marker_tokens(marker.group()) + _count_text_tokens(passage[marker.end():])
+    return _count_text_tokens(passage)
+
+
+@lru_cache(maxsize=PASSAGE_TOKEN_CACHE_SIZE)
+def _count_text_tokens(text: str) -> int:
+    return count_tokens(text)
+
+
+@lru_cache(maxsize=1024)
+def _count_marker_tokens(marker: str) -> int:
+    return count_tokens(marker)
+
+
+def truncate_to_tokens(text: str, n_tokens: int) -> str:
+    if (tokenizer := get_tokenizer()) is not None:
+        ids = tokenizer.encode(text, add_special_tokens=False).ids
+        return tokenizer.decode(ids[:n_tokens])
+    return " ".join(text.split()[:int(n_tokens / TOKENS_PER_WORD)])
+
+
+def context_budget(prompt_without_context: str, max_tokens: int) -> int:
+    """Number of tokens left for the context, once the rest of the prompt and the generated tokens are accounted for"""
+    return LLM_MAX_MODEL_LEN - count_tokens(prompt_without_context) - CHAT_TEMPLATE_OVERHEAD - max_tokens
+
+
+def pack_passages(passages: List[str], budget: int) -> List[str]:
+    """
+    The longest prefix of `passages` (in rerank order) which fits into `budget` tokens. Passages are kept whole,
+    so that citation indices keep pointing to the passages they were assigned to. Only a first passage which does
+    not fit on its own is truncated.
+    """
+    packed, n_tokens = [], 0
+    for passage in passages:
+        passage_tokens = count_passage_tokens(passage)
+        if n_tokens + passage_tokens > budget:
+            break
+        packed.append(passage)
+        n_tokens += passage_tokens
+    if not packed and passages and budget > 0:
+        packed.append(truncate_to_tokens(passages[0], budget))
+    if len(packed) < len(passages):
+        logger.info(f"Packed {len(packed)} of {len(passages)} passages into a context of {budget} tokens")
+    return packed
@@ -0,0 +1,45 @@
+import os
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from time import time
+from typing import Callable, Iterator, Optional, TypeVar
+
+# A call to the LLM, the reranker or S2 made for a task times out at the deadline of the task, and gets at least
+# MIN_CALL_TIMEOUT seconds so that a call made right at the deadline fails fast rather than polls
+MIN_CALL_TIMEOUT = float(os.getenv("MIN_CALL_TIMEOUT", 1))
+
+T = TypeVar("T")
+
+_local = threading.local()
+
+
+@contextmanager
+def call_deadline(deadline: Optional[float]) -> Iterator[None]:
+    """Bound the calls made by the current thread by `deadline` (a time() timestamp), None does not bound them"""
+    previous = getattr(_local, "deadline", None)
+    _local.deadline = deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous
+
+
+def call_timeout(max_timeout: float) -> float:
+    """Timeout of a call made now by the current thread, the time left until its deadline and at most `max_timeout`"""
+    deadline = getattr(_local, "deadline", None)
+    if deadline is None:
+        return max_timeout
+    return min(max(deadline - time(), MIN_CALL_TIMEOUT), max_timeout)
+
+
+def with_deadline(fn: Callable[..., T]) -> Callable[..., T]:
+    """`fn` bound by the deadline of the current thread, for the threads of an executor which run it"""
+    deadline = getattr(_local, "deadline", None)
+
+    @wraps(fn)
+    def _bound(*args, **kwargs) -> T:
+        with call_deadline(deadline):
+            return fn(*args, **kwargs)
+
+    return _bound
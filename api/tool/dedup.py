@@ -0,0 +1,217 @@
+import os
+import string
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# Measured on a single core with passages of ~200 words: deduplicating the ~300 passages of a query takes ~15 ms,
+# 1000 passages ~50 ms and 2000 ~110 ms, about half of which is spent finding and hashing the words. The cost is linear
+# in the number of words, so thousands of passages take tens of ms rather than a few.
+
+# Passages whose estimated Jaccard similarity (over word shingles) is at least DEDUP_THRESHOLD are near-duplicates
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", 64))
+DEDUP_SHINGLE_SIZE = int(os.getenv("DEDUP_SHINGLE_SIZE", 3))
+# Passages which start with the same words are duplicates too, e.g. the same abstract cut at different lengths
+DEDUP_PREFIX_WORDS = 20
+
+# once lower-cased and with punctuation replaced by spaces, the words of the (utf-8 encoded) texts are the runs of
+# bytes above the space, i.e. of anything but ASCII whitespace and control characters. The texts are joined by a
+# separator word made of a single DEL character, which would not be part of any text
+_TEXT_SEPARATOR = " \x7f "
+_PUNCTUATION_TO_SPACE = str.maketrans({c: " " for c in string.punctuation + "\u00a0"})
+_SPACE_BYTE = ord(" ")
+_MAX_HASH = np.uint64(np.iinfo(np.uint32).max)
+# offset added per bin by the densification of one permutation MinHash, an arbitrary odd constant
+_DENSIFY_OFFSET = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _lsh_rows_per_band(threshold: float, num_perm: int) -> int:
+    """
+    Number of signature rows per LSH band, so that pairs at the similarity threshold are (very likely) candidates.
+    Candidates are verified against their signatures, so the bands err on the side of recall.
+    """
+    rows = 1
+    for r in range(1, num_perm + 1):
+        if num_perm % r == 0 and (r / num_perm) ** (1 / r) <= 0.8 * threshold:
+            rows = r
+    return rows
+
+
+def _mix(hashes: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, spreads the entropy of uint64 hashes over all their bits"""
+    hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return hashes ^ (hashes >> np.uint64(31))
+
+
+def _word_hashes(texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Hash of every (lower-cased) word of the texts and the index of its text, in a few passes over their bytes"""
+    text = _TEXT_SEPARATOR.join(texts).lower().translate(_PUNCTUATION_TO_SPACE).encode("utf-8")
+    data = np.frombuffer(text, dtype=np.uint8)
+    is_word = np.concatenate([[False], data > _SPACE_BYTE, [False]])
+    # words start and end alternately where bytes turn from separators to word bytes and back
+    boundaries = np.flatnonzero(is_word[1:] != is_word[:-1])
+    starts, lengths = boundaries[0::2], boundaries[1::2] - boundaries[0::2]
+    separators = (lengths == 1) & (data[starts] == ord(_TEXT_SEPARATOR.strip()))
+    text_of_word = np.cumsum(separators)[~separators]
+    starts, lengths = starts[~separators], lengths[~separators]
+    return _mix(_token_hashes(text, starts, lengths) + lengths.astype(np.uint64)), text_of_word
+
+
+def _token_hashes(data: bytes, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Hash of all the bytes of every token, folding its 8-byte chunks into the mixed hash of the chunks before them.
+    Every step hashes the next chunk of the tokens which are long enough, so the steps add up to a pass over the bytes.
+    """
+    # the (little-endian) 8 bytes at every offset, padded so that windows at the end of the data are complete
+    windows = np.ndarray(shape=(len(data),), dtype="<u8", buffer=data + bytes(8), strides=(1,))
+
+    def _chunk(idx: np.ndarray, offset: int) -> np.ndarray:
+        # the bytes of the tokens from `offset` on, up to 8 of them
+        n_bytes = np.minimum(lengths[idx] - offset, 8).astype(np.uint64)
+        return windows[starts[idx] + offset] & (~np.uint64(0) >> (np.uint64(64) - np.uint64(8) * n_bytes))
+
+    hashes = _chunk(np.arange(len(starts)), 0)
+    offset, long_tokens = 8, np.flatnonzero(lengths > 8)
+    while len(long_tokens):
+        hashes[long_tokens] = _mix(hashes[long_tokens]) ^ _chunk(long_tokens, offset)
+        offset += 8
+        long_tokens = long_tokens[lengths[long_tokens] > offset]
+    return hashes
+
+
+def shingle_hashes(texts: List[str],
+                   shingle_size: int = DEDUP_SHINGLE_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Hashes of the word n-grams of all the texts, along with the index of the text of each n-gram, and the hash of
+    the first words of each text. Texts shorter than `shingle_size` words are a single shingle, texts without words
+    have none.
+    """
+    word_hashes, text_of_word = _word_hashes(texts)
+    lengths = np.bincount(text_of_word, minlength=len(texts))
+    # the n-grams over the words of all the texts, of which those within a single text are kept
+    n_grams = max(len(word_hashes) - shingle_size + 1, 0)
+    hashes = np.zeros(n_grams, dtype=np.uint64)
+    for k in range(shingle_size):
+        hashes = hashes * np.uint64(1000003) + word_hashes[k:k + n_grams]
+    starts = np.flatnonzero(text_of_word[:n_grams] == text_of_word[shingle_size - 1:])
+    hashes, text_of_hash = hashes[starts], text_of_word[starts]
+    word_hashes = np.concatenate([word_hashes, np.zeros(DEDUP_PREFIX_WORDS, dtype=np.uint64)])
+    short_texts = np.flatnonzero((lengths > 0) & (lengths < shingle_size))
+    if len(short_texts):
+        firsts = (np.cumsum(lengths) - lengths)[short_texts]
+        short_hashes = np.zeros(len(short_texts), dtype=np.uint64)
+        for k in range(shingle_size):
+            short_hashes = short_hashes * np.uint64(1000003) + np.where(
+                k < lengths[short_texts], word_hashes[firsts + k], np.uint64(0)
+            )
+        hashes, text_of_hash = np.concatenate([hashes, short_hashes]), np.concatenate([text_of_hash, short_texts])
+    return _mix(hashes), text_of_hash, _prefix_hashes(word_hashes, lengths)
+
+
+def _prefix_hashes(word_hashes: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """Hash of the first DEDUP_PREFIX_WORDS words of each text, 0 for texts which are not longer than that"""
+    firsts = np.cumsum(lengths) - lengths
+    long_enough = lengths > DEDUP_PREFIX_WORDS
+    hashes = np.zeros(len(lengths), dtype=np.uint64)
+    for k in range(DEDUP_PREFIX_WORDS):
+        hashes[long_enough] = hashes[long_enough] * np.uint64(1000003) + word_hashes[firsts[long_enough] + k]
+    return hashes
+
+
+def minhash_signatures(hashes: np.ndarray, text_of_hash: np.ndarray, n_texts: int,
+                       num_perm: int = DEDUP_NUM_PERM) -> np.ndarray:
+    """
+    (n texts x num_perm) one permutation MinHash signatures of the (mixed) shingle hashes: a single hash function
+    splits the shingles of a text into num_perm bins and keeps the minimum of each bin, bins left empty take the
+    minimum of the next non-empty bin (rotation densification). Texts without shingles have empty signatures.
+    """
+    signatures = np.full(n_texts * num_perm, _MAX_HASH, dtype=np.uint64)
+    bins = (hashes >> np.uint64(32)) % np.uint64(num_perm)
+    np.minimum.at(signatures, text_of_hash.astype(np.uint64) * np.uint64(num_perm) + bins, hashes & _MAX_HASH)
+    signatures = signatures.reshape(n_texts, num_perm)
+    empty = signatures == _MAX_HASH
+    if not empty.any():
+        return signatures
+    # index of the next non-empty bin, over the bins followed by themselves to wrap around
+    positions = np.where(np.tile(~empty, 2), np.arange(2 * num_perm), 2 * num_perm)
+    next_bin = np.minimum.accumulate(positions[:, ::-1], axis=1)[:, ::-1][:, :num_perm]
+    densified = (signatures[np.arange(n_texts)[:, None], next_bin % num_perm]
+                 + (next_bin - np.arange(num_perm)).astype(np.uint64) * _DENSIFY_OFFSET)
+    return np.where(empty & (next_bin < 2 * num_perm), densified, signatures)
+
+
+def _connected_components(n: int, firsts: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+    """Smallest index of the connected component of each of the n nodes, given the edges between them"""
+    labels = np.arange(n)
+    while True:
+        # every node takes the smallest label among its neighbours, then that of the node its label points to
+        previous = labels.copy()
+        np.minimum.at(labels, seconds, labels[firsts])
+        np.minimum.at(labels, firsts, labels[seconds])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+
+def _lsh_candidate_pairs(signatures: np.ndarray, indices: np.ndarray, rows: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pairs of the texts at `indices` which share a band of `rows` rows of their signatures, as the indices of the
+    first and second text of each pair
+    """
+    n, num_perm = len(signatures), signatures.shape[1]
+    # texts with the same band fall into the same bucket, i.e. are adjacent once sorted by the hash of the band
+    bands = signatures[indices].reshape(len(indices), num_perm // rows, rows)
+    band_hashes = np.zeros(bands.shape[:2], dtype=np.uint64)
+    for row in range(rows):
+        band_hashes = band_hashes * np.uint64(1000003) + bands[:, :, row]
+    order = np.argsort(band_hashes, axis=0, kind="stable")
+    sorted_hashes = np.take_along_axis(band_hashes, order, axis=0)
+    positions = np.broadcast_to(np.arange(len(indices))[:, None], order.shape)
+    # pair every member of a bucket with the first member of the bucket
+    new_bucket = np.concatenate([np.ones((1, order.shape[1]), dtype=bool),
+                                 sorted_hashes[1:] != sorted_hashes[:-1]])
+    bucket_starts = np.maximum.accumulate(np.where(new_bucket, positions, 0), axis=0)
+    members = ~new_bucket
+    pairs = np.unique(indices[np.take_along_axis(order, bucket_starts, axis=0)[members]] * n
+                      + indices[order[members]])
+    return pairs // n, pairs % n
+
+
+def _shared_prefix_pairs(prefix_hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Pairs of each text with a prefix hash and the first text with the same prefix hash"""
+    long_texts = np.flatnonzero(prefix_hashes)
+    _, first_with_prefix, prefix_idx = np.unique(prefix_hashes[long_texts], return_index=True, return_inverse=True)
+    return long_texts[first_with_prefix[prefix_idx]], long_texts
+
+
+def near_duplicate_clusters(texts: List[str], threshold: float = DEDUP_THRESHOLD,
+                            num_perm: int = DEDUP_NUM_PERM) -> np.ndarray:
+    """Cluster label of each text, near-duplicate texts share the label of the first of them"""
+    hashes, text_of_hash, prefix_hashes = shingle_hashes(texts)
+    signatures = minhash_signatures(hashes, text_of_hash, len(texts), num_perm)
+    # texts without words are never near-duplicates
+    firsts, seconds = _lsh_candidate_pairs(signatures, np.unique(text_of_hash), _lsh_rows_per_band(threshold, num_perm))
+    # candidates are verified against their whole signatures
+    similar = np.mean(signatures[firsts] == signatures[seconds], axis=1) >= threshold
+    prefix_firsts, prefix_seconds = _shared_prefix_pairs(prefix_hashes)
+    return _connected_components(len(texts), np.concatenate([firsts[similar], prefix_firsts]),
+                                 np.concatenate([seconds[similar], prefix_seconds]))
+
+
+def dedup_passages(passages: List[Dict[str, Any]], threshold: float = DEDUP_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    Keep one passage per cluster of near-duplicates, the one with the best retrieval score (the first one on ties),
+    in the order of the kept passages.
+    """
+    # passages without text would all be merged into one cluster, and are of no use to the generation anyway
+    passages = [p for p in passages if p["text"] is not None and p["text"].strip()]
+    if not passages:
+        return []
+    labels = near_duplicate_clusters([p["text"] for p in passages], threshold)
+    scores = np.array([p.get("score") or 0.0 for p in passages], dtype=float)
+    # sort by label, then best score, then position, and keep the first passage of each label
+    order = np.lexsort((np.arange(len(passages)), -scores, labels))
+    keep = order[np.concatenate([[True], labels[order][1:] != labels[order][:-1]])]
+    return [passages[idx] for idx in np.sort(keep)]
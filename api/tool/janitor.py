@@ -0,0 +1,57 @@
+import logging
+import os
+import threading
+from typing import Union
+
+from filelock import FileLock, Timeout
+
+from tool.locked_state import LockedStateManager
+from tool.sqlite_state import SqliteStateManager
+
+logger = logging.getLogger(__name__)
+
+# How often (in seconds) the janitor runs, and how long and how many tasks are retained
+STATE_JANITOR_INTERVAL = float(os.getenv("STATE_JANITOR_INTERVAL", 60 * 60))
+STATE_MAX_AGE = float(os.getenv("STATE_MAX_AGE", 7 * 24 * 60 * 60))
+STATE_MAX_TASKS = int(os.getenv("STATE_MAX_TASKS", 100000))
+
+
+class StateJanitor:
+    """
+    Background thread which periodically expires old tasks from the state store.
+    Every gunicorn worker runs one, but a lock in the state dir lets only one of them clean up at a time.
+    """
+
+    def __init__(self, task_mgr: Union[LockedStateManager, SqliteStateManager], state_dir: str,
+                 interval: float = STATE_JANITOR_INTERVAL, max_age: float = STATE_MAX_AGE,
+                 max_count: int = STATE_MAX_TASKS) -> None:
+        self.task_mgr = task_mgr
+        self.interval = interval
+        self.max_age = max_age
+        self.max_count = max_count
+        self._lock = FileLock(os.path.join(state_dir, ".janitor.lock"))
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_once(self) -> None:
+        try:
+            with self._lock.acquire(timeout=0):
+                n_tasks, n_bytes = self.task_mgr.expire_tasks(self.max_age, self.max_count)
+            logger.info(f"State janitor expired {n_tasks} task(s) and reclaimed {n_bytes} bytes")
+        except Timeout:
+            logger.debug("State janitor of another worker is running, skipping")
+        except Exception as e:
+            logger.exception(f"State janitor failed: {e}")
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="state-janitor", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
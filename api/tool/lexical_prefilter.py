@@ -0,0 +1,59 @@
+import logging
+import os
+import string
+from typing import Any, Dict, List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Only the LEXICAL_PREFILTER_TOP_K passages with the best BM25 scores are sent to the reranker, 0 sends all of them.
+# See benchmarks/prefilter_recall.py for the recall this costs.
+LEXICAL_PREFILTER_TOP_K = int(os.getenv("LEXICAL_PREFILTER_TOP_K", 0))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_TEXT_SEPARATOR = "\x00"
+_PUNCTUATION_TO_SPACE = str.maketrans({c: " " for c in string.punctuation})
+
+
+def _tokenize(text: str) -> List[str]:
+    return text.lower().translate(_PUNCTUATION_TO_SPACE).split()
+
+
+def reranker_input(passage: Dict[str, Any]) -> str:
+    """The text of the passage as scored by the reranker"""
+    return passage["title"] + " " + passage["text"] if "title" in passage else passage["text"]
+
+
+def bm25_scores(query: str, texts: List[str], k1: float = BM25_K1, b: float = BM25_B) -> np.ndarray:
+    """BM25 score of each text for the query, with the texts themselves as the collection"""
+    terms = {term: idx for idx, term in enumerate(dict.fromkeys(_tokenize(query)))}
+    n_texts = len(texts)
+    if not terms or not n_texts:
+        return np.zeros(n_texts)
+    # a single pass over all the texts, separated by a token of their own
+    tokens = _tokenize(f" {_TEXT_SEPARATOR} ".join(texts))
+    term_of_token = np.fromiter((terms.get(token, -1) for token in tokens), dtype=np.int64, count=len(tokens))
+    is_separator = np.fromiter((token == _TEXT_SEPARATOR for token in tokens), dtype=bool, count=len(tokens))
+    text_of_token = np.cumsum(is_separator)
+    lengths = np.bincount(text_of_token[~is_separator], minlength=n_texts).astype(float)
+    # (texts x query terms) term frequencies
+    matches = term_of_token >= 0
+    tf = np.bincount(text_of_token[matches] * len(terms) + term_of_token[matches],
+                     minlength=n_texts * len(terms)).reshape(n_texts, len(terms)).astype(float)
+    df = np.count_nonzero(tf, axis=0)
+    idf = np.log1p((n_texts - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    return (tf * (k1 + 1) / (tf + norm[:, None])) @ idf
+
+
+def prefilter_passages(query: str, passages: List[Dict[str, Any]],
+                       top_k: int = LEXICAL_PREFILTER_TOP_K) -> List[Dict[str, Any]]:
+    """The `top_k` passages with the best BM25 scores for the query, in their original order"""
+    if top_k <= 0 or len(passages) <= top_k:
+        return passages
+    scores = bm25_scores(query, [reranker_input(p) for p in passages])
+    keep = np.sort(np.argpartition(-scores, top_k - 1)[:top_k])
+    logger.info(f"Lexical pre-filter kept {top_k} of {len(passages)} passages for reranking")
+    return [passages[idx] for idx in keep]
@@ -0,0 +1,76 @@
+import os
+import threading
+from time import perf_counter
+from typing import Any, Callable, Dict, Optional
+
+import httpx
+from openai import OpenAI
+
+from tool.metrics import HTTP_CONNECT_SECONDS, HTTP_CONNECTIONS_OPENED, HTTP_REQUESTS
+
+# Connection pool of the LLM client, shared by all the task runner threads of a process
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 32))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", 16))
+# Idle connections are closed after this many seconds, which should stay below the server's own idle timeout
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+# Default timeouts (in seconds), a call can override them with the `timeout` argument of the OpenAI client
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 300))
+
+_lock = threading.Lock()
+_clients: Dict[str, Any] = dict()
+_pid = None
+
+
+def _trace_connections(client_name: str) -> Callable[[str, Dict[str, Any]], None]:
+    """httpcore trace callback which records the connections a request had to open, and how long that took"""
+    started = dict()
+
+    def _trace(event: str, info: Dict[str, Any]) -> None:
+        # e.g. connection.connect_tcp.started, connection.start_tls.complete
+        if not event.startswith(("connection.connect_tcp.", "connection.start_tls.")):
+            return
+        _, phase, step = event.split(".")
+        if step == "started":
+            started[phase] = perf_counter()
+        elif step == "complete" and phase in started:
+            HTTP_CONNECT_SECONDS.labels(client_name, phase).observe(perf_counter() - started.pop(phase))
+            if phase == "connect_tcp":
+                HTTP_CONNECTIONS_OPENED.labels(client_name).inc()
+
+    return _trace
+
+
+def _client_kwargs(client_name: str) -> Dict[str, Any]:
+    def _on_request(request: httpx.Request) -> None:
+        HTTP_REQUESTS.labels(client_name).inc()
+        request.extensions["trace"] = _trace_connections(client_name)
+
+    return dict(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        event_hooks={"request": [_on_request]},
+    )
+
+
+def _get_client(name: str, factory: Callable[[], Any]) -> Any:
+    global _pid
+    with _lock:
+        # connections must not be shared with forked (task runner) processes, which build their own clients
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+        if name not in _clients:
+            _clients[name] = factory()
+        return _clients[name]
+
+
+def get_llm_client(api_key: Optional[str], base_url: str) -> OpenAI:
+    """Process-wide OpenAI client for `base_url`, which keeps its connections alive across calls and threads"""
+    return _get_client(base_url, lambda: OpenAI(
+        api_key=api_key, base_url=base_url, http_client=httpx.Client(**_client_kwargs("llm"))
+    ))
@@ -1,20 +1,199 @@
-from typing import Type
+import json
+import os
+import tempfile
+from hashlib import sha256
+from time import time
+from typing import Any, Dict, List, Optional, Tuple, Type
 
 from nora_lib.tasks.models import AsyncTaskState, R
 from nora_lib.tasks.state import StateManager
-from filelock import FileLock
+from filelock import BaseFileLock, FileLock
 
+from tool.models import FINISHED_TASK_STATUSES
+
+# Tasks updated within the last hour are never expired, irrespective of the max count
+ACTIVE_TASK_AGE = 60 * 60
+
+
+class LockedStateManager(StateManager[R]):
+    """
+    Stores task state as one json file per task. Writes go to a temp file which atomically replaces the state file,
+    so readers never see a partially written state and do not need to lock. Read-modify-write updates are serialized
+    with a lock file per task, kept in the `.locks` sub-directory of the state dir.
+    The tasks recorded for keys (see `claim_key`) are kept in the `.keys` sub-directory, one file and lock per key.
+    """
 
-class LockedStateManager(StateManager):
     def __init__(self, task_state_class: Type[AsyncTaskState[R]], state_dir) -> None:
         super().__init__(task_state_class, state_dir)
+        self._lock_dir = os.path.join(state_dir, ".locks")
+        self._key_dir = os.path.join(state_dir, ".keys")
+        os.makedirs(self._lock_dir, exist_ok=True)
+        os.makedirs(self._key_dir, exist_ok=True)
+
+    def _lock(self, task_id: str) -> BaseFileLock:
+        return FileLock(os.path.join(self._lock_dir, f"{task_id}.lock"))
 
-    def read_state(self, task_id: str) -> AsyncTaskState[R]:
-        lock = FileLock(f"{task_id}.lock")
-        with lock:
-            return super().read_state(task_id)
+    @staticmethod
+    def _write_json(path: str, data: Dict[str, Any]) -> None:
+        directory, name = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name[:-len('.json')]}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
 
     def write_state(self, state: AsyncTaskState[R]) -> None:
-        lock = FileLock(f"{state.task_id}.lock")
-        with lock:
-            super().write_state(state)
+        self._write_json(os.path.join(self._state_dir, f"{state.task_id}.json"), state.model_dump())
+
+    def update_fields(
+            self,
+            task_id: str,
+            task_status: Optional[str] = None,
+            estimated_time: Optional[str] = None,
+            task_result: Optional[R] = None,
+            extra_state: Optional[Dict[str, Any]] = None,
+            unless_finished: bool = False,
+    ) -> bool:
+        """
+        Update only the given fields of a task's state, `extra_state` is merged into the existing one.
+        With `unless_finished`, the state of a task which already has an outcome is left as is.
+        Returns whether the state was updated.
+        """
+        # read and write under a single acquisition of the lock, so that concurrent updates are not lost
+        with self._lock(task_id):
+            state = self.read_state(task_id)
+            if unless_finished and state.task_status in FINISHED_TASK_STATUSES:
+                return False
+            if task_status is not None:
+                state.task_status = task_status
+            if estimated_time is not None:
+                state.estimated_time = estimated_time
+            if task_result is not None:
+                state.task_result = task_result
+            if extra_state:
+                state.extra_state.update(extra_state)
+            self.write_state(state)
+            return True
+
+    def append_event(self, task_id: str, event: Dict[str, Any]) -> None:
+        """Append an event to the task's event log, a json lines file next to its state file"""
+        line = (json.dumps(event) + "\n").encode("utf-8")
+        # a single write to a file opened with O_APPEND is not interleaved with writes from other processes
+        fd = os.open(self._events_path(task_id), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def read_events(
+            self, task_id: str, after: int = 0, offset: int = 0
+    ) -> Tuple[List[Tuple[int, Dict[str, Any]]], int]:
+        """
+        Events logged for the task with a sequence number greater than `after`, as (sequence number, event), and the
+        offset to pass to the next call. `offset` is the byte offset of event `after` + 1 in the event log as returned
+        by the previous call, so that a poller only reads what was appended since; 0 reads the log from the start.
+        """
+        try:
+            with open(self._events_path(task_id), "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+        # the part after the last newline is either empty or a line which is still being written
+        complete = data[:data.rfind(b"\n") + 1]
+        first_seq = after + 1 if offset else 1
+        events = [
+            (seq, json.loads(line)) for seq, line in enumerate(complete.splitlines(), start=first_seq) if seq > after
+        ]
+        return events, offset + len(complete)
+
+    def _events_path(self, task_id: str) -> str:
+        return os.path.join(self._state_dir, f"{task_id}.events.jsonl")
+
+    def _key_path(self, key: str) -> str:
+        # without the extension, which is .json for the entry and .lock for its lock
+        return os.path.join(self._key_dir, sha256(key.encode("utf-8")).hexdigest())
+
+    def read_key(self, key: str) -> Optional[Tuple[str, float]]:
+        """The task recorded for the key and when it was recorded, if any"""
+        try:
+            with open(f"{self._key_path(key)}.json") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        return entry["task_id"], entry["updated_at"]
+
+    def claim_key(self, key: str, task_id: str, ttl: float = 0.0) -> str:
+        """
+        Record the task for the key, unless another task was recorded for it less than `ttl` seconds ago.
+        Returns the task recorded for the key, which concurrent claims agree on.
+        """
+        path = self._key_path(key)
+        with FileLock(f"{path}.lock"):
+            entry = self.read_key(key)
+            if entry is not None and time() - entry[1] < ttl:
+                return entry[0]
+            self._write_json(f"{path}.json", {"key": key, "task_id": task_id, "updated_at": time()})
+        return task_id
+
+    def release_key(self, key: str, task_id: str) -> None:
+        """Forget the task recorded for the key, if it is still `task_id`"""
+        path = self._key_path(key)
+        with FileLock(f"{path}.lock"):
+            entry = self.read_key(key)
+            if entry is not None and entry[0] == task_id:
+                self._remove(f"{path}.json")
+
+    def expire_tasks(self, max_age: float, max_count: int) -> Tuple[int, int]:
+        """
+        Delete the files of tasks which were last updated more than `max_age` seconds ago, and of the oldest tasks
+        beyond the newest `max_count`, along with their lock files and leftover temp files. Keys recorded more than
+        `max_age` seconds ago are deleted too.
+        Returns the number of tasks expired and the number of bytes reclaimed.
+        """
+        now = time()
+        task_mtimes, n_bytes = [], 0
+        with os.scandir(self._state_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".json") and entry.is_file():
+                    task_mtimes.append((entry.stat().st_mtime, entry.name[:-len(".json")]))
+                elif entry.name.endswith(".tmp") and now - entry.stat().st_mtime > ACTIVE_TASK_AGE:
+                    # left behind by a writer which crashed before renaming it
+                    n_bytes += self._remove(entry.path)
+        task_mtimes.sort(reverse=True)
+        expired = [
+            task_id for idx, (mtime, task_id) in enumerate(task_mtimes)
+            if now - mtime > max_age or (idx >= max_count and now - mtime > ACTIVE_TASK_AGE)
+        ]
+        for task_id in expired:
+            n_bytes += self._remove(os.path.join(self._state_dir, f"{task_id}.json"))
+            n_bytes += self._remove(self._events_path(task_id))
+            n_bytes += self._remove(os.path.join(self._lock_dir, f"{task_id}.lock"))
+        # locks of tasks whose state is already gone
+        with os.scandir(self._lock_dir) as entries:
+            for entry in entries:
+                if now - entry.stat().st_mtime > ACTIVE_TASK_AGE and not os.path.exists(
+                        os.path.join(self._state_dir, f"{entry.name[:-len('.lock')]}.json")):
+                    n_bytes += self._remove(entry.path)
+        with os.scandir(self._key_dir) as entries:
+            for entry in entries:
+                age = now - entry.stat().st_mtime
+                if (entry.name.endswith(".json") and age > max_age) or (
+                        not entry.name.endswith(".json") and age > ACTIVE_TASK_AGE
+                        and not os.path.exists(os.path.join(self._key_dir, f"{entry.name.rsplit('.', 1)[0]}.json"))):
+                    n_bytes += self._remove(entry.path)
+        return len(expired), n_bytes
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        # files may be removed concurrently by the janitor of another worker
+        try:
+            n_bytes = os.path.getsize(path)
+            os.remove(path)
+            return n_bytes
+        except FileNotFoundError:
+            return 0
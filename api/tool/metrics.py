@@ -0,0 +1,102 @@
+import os
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+# With several gunicorn workers (or process task runners), set PROMETHEUS_MULTIPROC_DIR to an empty directory shared
+# by all processes, so that /metrics aggregates the samples of every process instead of just the one serving it.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 240.0)
+
+STAGE_SECONDS = Histogram(
+    "openscholar_stage_seconds", "Time spent in each stage of answering a query", ["stage"], buckets=LATENCY_BUCKETS
+)
+DEPENDENCY_SECONDS = Histogram(
+    "openscholar_dependency_seconds", "Latency of calls to external dependencies", ["dependency", "outcome"],
+    buckets=LATENCY_BUCKETS,
+)
+DEPENDENCY_ERRORS = Counter(
+    "openscholar_dependency_errors_total", "Failed calls to external dependencies", ["dependency"]
+)
+
+HTTP_REQUESTS = Counter("openscholar_http_requests_total", "Requests sent by pooled HTTP clients", ["client"])
+HTTP_CONNECTIONS_OPENED = Counter(
+    "openscholar_http_connections_opened_total", "New connections opened by pooled HTTP clients (i.e. not reused)",
+    ["client"]
+)
+HTTP_CONNECT_SECONDS = Histogram(
+    "openscholar_http_connect_seconds", "Time spent in TCP connects and TLS handshakes of new connections",
+    ["client", "phase"], buckets=LATENCY_BUCKETS,
+)
+
+LLM_COMPLETION_TOKENS = Histogram(
+    "openscholar_llm_completion_tokens", "Tokens generated per LLM call", ["call"],
+    buckets=(1, 10, 50, 100, 250, 500, 750, 1000, 1500, 2000),
+)
+LLM_FINISHED = Counter(
+    "openscholar_llm_finished_total", "LLM calls by how the generation ended (stop_sequence, eos or length)",
+    ["call", "reason"]
+)
+LLM_UNUSED_MAX_TOKENS = Counter(
+    "openscholar_llm_unused_max_tokens_total",
+    "max_tokens budget left unused by generations which ended at one of the stop sequences they were given", ["call"]
+)
+
+RERANK_CACHE_LOOKUPS = Counter(
+    "openscholar_rerank_cache_lookups_total", "Lookups of (query, passage) scores in the reranker cache", ["result"]
+)
+
+
+@contextmanager
+def timed_stage(stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """Record the duration of a pipeline stage, and add it to the task's `timings` if provided"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        if timings is not None:
+            # stages like edits run once per feedback, their durations add up
+            timings[stage] = round(timings.get(stage, 0.0) + elapsed, 3)
+
+
+@contextmanager
+def timed_dependency(dependency: str) -> Iterator[None]:
+    """Record the latency and outcome of a call to an external dependency"""
+    start = perf_counter()
+    try:
+        yield
+    except BaseException:
+        DEPENDENCY_SECONDS.labels(dependency, "error").observe(perf_counter() - start)
+        DEPENDENCY_ERRORS.labels(dependency).inc()
+        raise
+    DEPENDENCY_SECONDS.labels(dependency, "ok").observe(perf_counter() - start)
+
+
+def record_llm_completion(call: str, max_tokens: Optional[int], finish_reason: Optional[str],
+                          stop_reason: Optional[Any], completion_tokens: Optional[int],
+                          stop: Optional[List[str]] = None) -> None:
+    # vLLM reports the matched stop string as stop_reason, and None (or the token id) for the end of sequence
+    if finish_reason == "length":
+        reason = "length"
+    elif isinstance(stop_reason, str):
+        reason = "stop_sequence"
+    else:
+        reason = "eos"
+    LLM_FINISHED.labels(call, reason).inc()
+    if completion_tokens is not None:
+        LLM_COMPLETION_TOKENS.labels(call).observe(completion_tokens)
+        if finish_reason == "stop" and stop and stop_reason in stop and max_tokens:
+            LLM_UNUSED_MAX_TOKENS.labels(call).inc(max(0, max_tokens - completion_tokens))
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """The metrics in the Prometheus text format, and its content type"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
@@ -1,10 +1,15 @@
 from typing import Any, Dict, List, Optional
 
 from nora_lib.tasks.models import AsyncTaskState as BaseAsyncTaskState
+from nora_lib.tasks.models import TASK_STATUSES
 
 from pydantic import BaseModel, Field
 
 
+# Statuses of tasks which are not going to be updated anymore
+FINISHED_TASK_STATUSES = {TASK_STATUSES["COMPLETED"], TASK_STATUSES["FAILED"], TASK_STATUSES["TERMINATED"]}
+
+
 class Papers(BaseModel):
     corpus_ids: List[int] = Field(description="List of corpus ids of the papers")
     fields: Optional[List[str]] = Field(description="List of fields to be fetched from the papers")
@@ -82,3 +87,7 @@ class AsyncToolResponse(BaseModel):
     estimated_time: str = Field(description="How long we expect this task to take from start to finish")
     task_status: str = Field(description="Current human-readable status of the task.")
     task_result: Optional[TaskResult] = Field(description="Final result of the task.")
+    queue_position: Optional[int] = Field(default=None, description=(
+        "Position of the task in the queue of tasks waiting for a free runner, 0 once the task is running. "
+        "Not set if the position is unknown to the server handling the request."
+    ))
@@ -2,20 +2,30 @@ import copy
 import logging
 import os
 import re
-import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from time import time
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, List, Optional, Set, Union
 
-from openai import OpenAI
 from openai import moderations
+from openai.types.chat import ChatCompletionMessageParam
 from scholarqa import FullTextRetriever
+from scholarqa.rag import retriever_base
 
 import tool.instructions
+from tool.context_packer import context_budget, pack_passages
+from tool.deadline import call_timeout, with_deadline
+from tool.dedup import dedup_passages
 from tool.event_tracing import EventTrace
+from tool.lexical_prefilter import prefilter_passages
+from tool.llm_client import LLM_READ_TIMEOUT, get_llm_client
 from tool.locked_state import LockedStateManager
+from tool.metrics import record_llm_completion, timed_dependency, timed_stage
 from tool.models import Citation, GeneratedIteration, TaskResult, ToolRequest
 from tool.rag_subs import PaperFinderWithRerankerThreshold, ModalRerankerNoBatch
-from tool.utils import extract_citations, remove_citations
+from tool.sqlite_state import SqliteStateManager
+from tool.task_runner import TaskCancelledException
+from tool.utils import extract_citations, query_s2_api, remove_citations
+from tool.warm_state import LLM_SCALEDOWN_WINDOW, RERANKER_SCALEDOWN_WINDOW, warm_state
 
 logger = logging.getLogger(__name__)
 
@@ -29,22 +39,66 @@ MODAL_WEB_AUTH_KEY = os.getenv("MODAL_WEB_AUTH")
 LLM_BASE_URL = MODAL_OPENAI_BASE_URL
 LLM_KEY = MODAL_WEB_AUTH_KEY
 SNIPPET_LENGTH = int(os.getenv("SNIPPET_LENGTH", 300))
+# Min interval (in seconds) between two updates of a draft which is being streamed from the LLM
+DRAFT_STREAM_INTERVAL = float(os.getenv("DRAFT_STREAM_INTERVAL", 0.5))
+# Number of extracted keywords searched on S2 to augment the retrieved passages, and how many searches run at once
+N_SS_KEYWORDS = int(os.getenv("N_SS_KEYWORDS", 2))
+SS_SEARCH_CONCURRENCY = int(os.getenv("SS_SEARCH_CONCURRENCY", 4))
+# Moderate the query while retrieval is already running, instead of before it starts
+SPECULATIVE_MODERATION = os.getenv("SPECULATIVE_MODERATION", "true").lower() == "true"
+
+SYSTEM_PROMPT = "You are a helpful AI assistant for scientific literature review. Please carefully follow user's instruction and help them to understand the most recent papers."
 
 filter_demo_pattern = r"\s*[^.!?]*\[20\]\."
 
+# the searches of the retriever go through the pooled S2 session, which also bounds them by the deadline of the task
+retriever_base.query_s2_api = query_s2_api
+
+
+def visible_response_text(text: str) -> str:
+    """The part of a (partially) generated response which can be shown to the user"""
+    if "[Response_Start]" in text:
+        text = text.split("[Response_Start]", 1)[1]
+    text = text.split("[Response_End]")[0].split("References:")[0]
+    # hold back a marker which is only partially generated so far
+    for marker in ("[Response_Start]", "[Response_End]", "References:"):
+        for idx in range(len(marker) - 1, 0, -1):
+            if text.endswith(marker[:idx]):
+                return text[:-idx]
+    return text
+
+
+def parse_response(outputs: str, strip_references: bool = True) -> str:
+    """The text of the first response marked by [Response_Start] and [Response_End], without its references"""
+    raw_output = (
+        [
+            t.split("[Response_End]")[0]
+            for t in outputs.split("[Response_Start]")
+            if "[Response_End]" in t
+        ][0]
+        if "[Response_End]" in outputs
+        else outputs
+    )
+    if strip_references and "References:" in raw_output:
+        raw_output = raw_output.split("References:")[0]
+    return raw_output
+
 
 class OpenScholar:
     def __init__(
             self,
-            task_mgr: LockedStateManager,
+            task_mgr: Union[LockedStateManager, SqliteStateManager],
             n_retrieval: int = 300,
             n_rerank: int = 8,
             n_feedback: int = 0,
             context_threshold: float = 0.5,
             llm_model: str = "akariasai/os_8b",  # env
             reranker_model: str = "akariasai-ranker-large-update",  # env
+            stream_drafts: bool = True,
+            speculative_moderation: bool = SPECULATIVE_MODERATION,
     ):
         # TODO: Initialize retriever and re-ranker clients here
+        self.n_retrieval = n_retrieval
         self.n_rerank = n_rerank
         self.n_feedback = n_feedback
         self.task_mgr = task_mgr
@@ -62,80 +116,146 @@ class OpenScholar:
         self.ss_retriever = True
         self.use_contexts = True
         self.llm_model = llm_model
+        self.stream_drafts = stream_drafts
+        self.speculative_moderation = speculative_moderation
         logger.info(f"using model {self.llm_model} for inference")
+        # number of iterations of each running task already published to its event stream
+        self.n_published_iterations: Dict[str, int] = dict()
+        # tasks whose query was flagged while work on it was already in flight, that work stops at its next stage
+        self.discarded_tasks: Set[str] = set()
+        warm_state.register("llm", self.ping_llm, LLM_SCALEDOWN_WINDOW)
+        warm_state.register("reranker", reranker.ping, RERANKER_SCALEDOWN_WINDOW)
 
     ############################ OpenScholar Functions
 
-    def llm_inference(self, input_query: str, **opt_kwargs):
-        client = OpenAI(
-            api_key=LLM_KEY,
-            base_url=LLM_BASE_URL,
-        )
-        messages = [
+    def llm_inference(
+            self, input_query: str, on_text: Optional[Callable[[str], None]] = None, call: str = "other", **opt_kwargs
+    ):
+        """
+        Prompt the LLM with `input_query`. If `on_text` is provided, the output is streamed and `on_text` is called
+        with the visible response text generated so far at most every DRAFT_STREAM_INTERVAL seconds.
+        `call` labels the metrics of the generation.
+        """
+        client = get_llm_client(LLM_KEY, LLM_BASE_URL)
+        messages: List[ChatCompletionMessageParam] = [
             {
                 "role": "system",
-                "content": "You are a helpful AI assistant for scientific literature review. Please carefully follow user's instruction and help them to understand the most recent papers.",
+                "content": SYSTEM_PROMPT,
             },
             {
                 "role": "user",
                 "content": input_query,
             },
         ]
-        output = client.chat.completions.create(
-            model=self.llm_model, messages=messages, **opt_kwargs
-        )
+        # the generation is cut short at the deadline of the task
+        timeout = call_timeout(LLM_READ_TIMEOUT)
+        if on_text is None:
+            with timed_dependency("llm"):
+                output = client.chat.completions.create(
+                    model=self.llm_model, messages=messages, timeout=timeout, **opt_kwargs
+                )
+            choice = output.choices[0]
+            finish_reason, stop_reason = choice.finish_reason, getattr(choice, "stop_reason", None)
+            completion_tokens = output.usage.completion_tokens if getattr(output, "usage", None) else None
+            output = choice.message.content
+        else:
+            chunks, published = [], ""
+            finish_reason = stop_reason = completion_tokens = None
+            last_published = time()
+            # closing the stream (also when on_text raises) drops the connection, which aborts the generation
+            with timed_dependency("llm"), client.chat.completions.create(
+                    model=self.llm_model, messages=messages, stream=True, stream_options={"include_usage": True},
+                    timeout=timeout, **opt_kwargs
+            ) as stream:
+                for chunk in stream:
+                    if usage := getattr(chunk, "usage", None):
+                        # the last chunk, without choices
+                        completion_tokens = usage.completion_tokens
+                    if chunk.choices and getattr(chunk.choices[0], "finish_reason", None):
+                        finish_reason = chunk.choices[0].finish_reason
+                        stop_reason = getattr(chunk.choices[0], "stop_reason", None)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                        if time() - last_published >= DRAFT_STREAM_INTERVAL:
+                            text = visible_response_text("".join(chunks))
+                            if text.strip() and text != published:
+                                on_text(text)
+                                published, last_published = text, time()
+            output = "".join(chunks)
+            if (text := visible_response_text(output)) != published:
+                on_text(text)
+
+        warm_state.mark_warm("llm")
+        record_llm_completion(call, opt_kwargs.get("max_tokens"), finish_reason, stop_reason, completion_tokens,
+                              opt_kwargs.get("stop"))
 
-        output = output.choices[0].message.content
         if "[Response_Start]" in output and "[Response_End]" not in output:
             return output.split("[Response_Start]")[1]
         else:
             return output
 
-    def process_passage(self, retrieved_ctxs: List[Dict[str, Any]]):
-        ctxs = ""
+    def generate(
+            self, input_query: str, call: str, strip_references: bool = True,
+            on_text: Optional[Callable[[str], None]] = None, **opt_kwargs
+    ) -> str:
+        """
+        Generate a response marked by [Response_Start] and [Response_End], and return its text.
+        The end marker (and, with `strip_references`, the reference list the model appends to its answers) is passed
+        as a stop sequence, so the server stops generating where the text we keep ends.
+        """
+        stop = ["[Response_End]", "References:"] if strip_references else ["[Response_End]"]
+        outputs = self.llm_inference(input_query, on_text=on_text, call=call, stop=stop, **opt_kwargs)
+        return parse_response(outputs, strip_references)
+
+    def ping_llm(self) -> None:
+        """Minimal completion, which boots a container if the deployment scaled down"""
+        client = get_llm_client(LLM_KEY, LLM_BASE_URL)
+        with timed_dependency("llm"):
+            client.chat.completions.create(
+                model=self.llm_model, messages=[{"role": "user", "content": "ping"}], max_tokens=1
+            )
+
+    def format_passages(self, retrieved_ctxs: List[Dict[str, Any]]) -> List[str]:
+        passages = []
         for doc_idx, doc in enumerate(retrieved_ctxs[: self.n_rerank]):
             if "title" in doc and len(doc["title"]) > 0:
-                ctxs += "[{0}] Title: {1} Text: {2}\n".format(
+                passages.append("[{0}] Title: {1} Text: {2}\n".format(
                     doc_idx, doc["title"], doc["text"]
-                )
+                ))
             else:
-                ctxs += "[{0}] {1}\n".format(doc_idx, doc["text"])
+                passages.append("[{0}] {1}\n".format(doc_idx, doc["text"]))
+        return passages
 
-        return ctxs
+    def process_passage(self, retrieved_ctxs: List[Dict[str, Any]]):
+        return "".join(self.format_passages(retrieved_ctxs))
 
     def generate_response(
             self,
             query: str,
             retrieved_ctxs: List[Dict[str, Any]],
             max_tokens: int = 2000,
+            task_id: Optional[str] = None,
     ):
-        ctxs_text = self.process_passage(retrieved_ctxs)
-        if len(ctxs_text.split()) > 4500:
-            ctxs_text = ctxs_text.split()
-            ctxs_text = " ".join(ctxs_text[:4000])
-        logger.info(f"Context length (words): {len(ctxs_text.split())}")
+        prompt_without_context = SYSTEM_PROMPT + tool.instructions.generation_instance_prompts_w_references.format_map(
+            {"context": "", "input": query}
+        )
+        # whole passages, in rerank order, which fit next to the prompt and the generated tokens in the model length
+        passages = pack_passages(
+            self.format_passages(retrieved_ctxs), context_budget(prompt_without_context, max_tokens)
+        )
+        ctxs_text = "".join(passages)
+        logger.info(f"Context length: {len(passages)} passages, {len(ctxs_text.split())} words")
         input_query = (
             tool.instructions.generation_instance_prompts_w_references.format_map(
                 {"context": ctxs_text, "input": query}
             )
         )
 
-        outputs = self.llm_inference(
-            input_query, temperature=0.7, max_tokens=max_tokens
+        raw_output = self.generate(
+            input_query, "initial_draft", on_text=self.draft_publisher(task_id, "initial_draft"), temperature=0.7,
+            max_tokens=max_tokens
         )
-
-        logger.info(f"Generated response: {outputs[:100]}...{len(outputs)}")
-        raw_output = (
-            [
-                t.split("[Response_End]")[0]
-                for t in outputs.split("[Response_Start]")
-                if "[Response_End]" in t
-            ][0]
-            if "[Response_End]" in outputs
-            else outputs
-        )
-        if "References:" in raw_output:
-            raw_output = raw_output.split("References:")[0]
+        logger.info(f"Generated response: {raw_output[:100]}...{len(raw_output)}")
         return raw_output
 
     # Feedback: send feedback on model' predictions.
@@ -150,14 +270,9 @@ class OpenScholar:
         return ratings
 
     def check_paper_duplication(self, retrieved_papers: List[Dict[str, Any]]):
-        papers_dicts = {
-            " ".join(paper["text"].split(" ")[:20]): paper
-            for paper in retrieved_papers
-            if paper["text"] is not None and len(paper["text"].split(" ")) > 20
-        }
-        dedup_papers = list(papers_dicts.values())
-
-        return dedup_papers
+        # near-identical passages, e.g. the same abstract from the full-text index and from S2, are reranked and
+        # prompted only once
+        return dedup_passages(retrieved_papers)
 
     def get_feedback(
             self,
@@ -174,17 +289,7 @@ class OpenScholar:
             }
         )
 
-        outputs = self.llm_inference(input_query, temperature=0.7, max_tokens=1000)
-
-        raw_output = (
-            [
-                t.split("[Response_End]")[0]
-                for t in outputs.split("[Response_Start]")
-                if "[Response_End]" in t
-            ][0]
-            if "[Response_End]" in outputs
-            else outputs
-        )
+        raw_output = self.generate(input_query, "feedback", strip_references=False, temperature=0.7, max_tokens=1000)
         feedbacks = self.process_feedack(raw_output)
         return feedbacks
 
@@ -195,6 +300,7 @@ class OpenScholar:
             previous_response: str,
             feedback: str,
             max_tokens: int = 2000,
+            task_id: Optional[str] = None,
     ):
         input_query = tool.instructions.editing_instance_prompt.format_map(
             {
@@ -205,24 +311,10 @@ class OpenScholar:
             }
         )
 
-        outputs = self.llm_inference(
-            input_query, temperature=0.7, max_tokens=max_tokens
-        )
-
-        raw_output = (
-            [
-                t.split("[Response_End]")[0]
-                for t in outputs.split("[Response_Start]")
-                if "[Response_End]" in t
-            ][0]
-            if "[Response_End]" in outputs
-            else outputs
+        return self.generate(
+            input_query, "edit", on_text=self.draft_publisher(task_id, "edit"), temperature=0.7, max_tokens=max_tokens
         )
 
-        if "References:" in raw_output:
-            raw_output = raw_output.split("References:")[0]
-        return raw_output
-
     def edit_with_feedback_retrieval(
             self,
             query: str,
@@ -231,6 +323,7 @@ class OpenScholar:
             feedback: str,
             passage_start_index,
             max_tokens=2000,
+            task_id: Optional[str] = None,
     ):
         processed_passages = ""
         for doc_idx, doc in enumerate(ctxs[: self.n_rerank]):
@@ -254,22 +347,10 @@ class OpenScholar:
             )
         )
 
-        outputs = self.llm_inference(
-            input_query, temperature=0.7, max_tokens=max_tokens
+        return self.generate(
+            input_query, "edit_with_retrieval", on_text=self.draft_publisher(task_id, "edit"), temperature=0.7,
+            max_tokens=max_tokens
         )
-        raw_output = (
-            [
-                t.split("[Response_End]")[0]
-                for t in outputs.split("[Response_Start]")
-                if "[Response_End]" in t
-            ][0]
-            if "[Response_End]" in outputs
-            else outputs
-        )
-
-        if "References:" in raw_output:
-            raw_output = raw_output.split("References:")[0]
-        return raw_output
 
     def retrieve_keywords(self, input_query: str):
         prompt = [
@@ -278,7 +359,7 @@ class OpenScholar:
             )
         ]
 
-        outputs = self.llm_inference(prompt[0], temperature=0.7, max_tokens=1500)
+        outputs = self.llm_inference(prompt[0], call="keywords", temperature=0.7, max_tokens=1500)
 
         search_queries = outputs.split(", ")[:3]
         search_queries = [
@@ -298,14 +379,52 @@ class OpenScholar:
     ):
         logger.info(f"{task_id}: {status}")
         if task_id:
+            # every stage of the pipeline reports its status, so that is where we stop a cancelled task
+            self.check_cancelled(task_id)
             status = f"{time()}:{status}"
-            task_state = self.task_mgr.read_state(task_id)
-            task_state.task_status = status
-            if estimated_time:
-                task_state.estimated_time = estimated_time
+            self.task_mgr.update_fields(
+                task_id,
+                task_status=status,
+                estimated_time=estimated_time,
+                task_result=TaskResult(iterations=curr_response) if curr_response else None,
+            )
+            self.task_mgr.append_event(task_id, {"type": "status", "status": status, "estimated_time": estimated_time})
             if curr_response:
-                task_state.task_result = TaskResult(iterations=curr_response)
-            self.task_mgr.write_state(task_state)
+                n_published = self.n_published_iterations.get(task_id, 0)
+                for idx, iteration in enumerate(curr_response[n_published:], start=n_published):
+                    self.task_mgr.append_event(
+                        task_id, {"type": "iteration", "index": idx, "iteration": iteration.model_dump()}
+                    )
+                self.n_published_iterations[task_id] = len(curr_response)
+
+    def check_cancelled(self, task_id: str) -> None:
+        """Raise a TaskCancelledException if the task was cancelled, or has run past its deadline"""
+        extra_state = self.task_mgr.read_state(task_id).extra_state
+        # the deadline first, a timed out task has already been failed and must not be reported as cancelled
+        if extra_state.get("timed_out") or ("deadline" in extra_state and time() > extra_state["deadline"]):
+            raise TaskCancelledException(task_id, timed_out=True)
+        if extra_state.get("cancel_requested") or task_id in self.discarded_tasks:
+            raise TaskCancelledException(task_id)
+
+    def draft_publisher(self, task_id: Optional[str], stage: str) -> Optional[Callable[[str], None]]:
+        """Callback publishing a draft streamed from the LLM to the task's event stream"""
+        if not (task_id and self.stream_drafts):
+            return None
+
+        published = ""
+
+        def _publish(text: str):
+            nonlocal published
+            # raising here aborts the in-flight completion
+            self.check_cancelled(task_id)
+            # only the part after the prefix shared with the previous draft, so the event log grows linearly
+            offset = len(os.path.commonprefix([published, text]))
+            self.task_mgr.append_event(
+                task_id, {"type": "draft", "stage": stage, "offset": offset, "text": text[offset:]}
+            )
+            published = text
+
+        return _publish
 
     def retrieve(
             self, query: str, task_id: str, prefix: str = ""
@@ -330,6 +449,7 @@ class OpenScholar:
     def rerank(
             self, query: str, retrieved_ctxs: List[Dict[str, Any]], filtering: bool = True
     ) -> List[Dict[str, Any]]:
+        retrieved_ctxs = prefilter_passages(query, retrieved_ctxs)
         sorted_ctxs = self.paper_finder.rerank(query, retrieved_ctxs)
         if filtering is True and len(sorted_ctxs) < 1:
             logger.warning("No relevant information found for the query.")
@@ -338,14 +458,20 @@ class OpenScholar:
                 "OpenScholar is not designed to answer non-scientific questions or questions that require sources outside the scientific literature.")
         return sorted_ctxs
 
+    def search_keyword(self, keyword: str) -> Optional[List[Dict[str, Any]]]:
+        return self.paper_finder.retrieve_additional_papers(keyword, minCitationCount=10, sort="citationCount:desc")
+
     def retrieve_additional_passages_ss(self, query: str):
         new_papers = []
-        new_keywords = self.retrieve_keywords(query)
+        new_keywords = self.retrieve_keywords(query)[:N_SS_KEYWORDS]
         paper_list = {}
         if len(new_keywords) > 0:
-            for keyword in new_keywords[:2]:
-                top_papers = self.paper_finder.retrieve_additional_papers(keyword, minCitationCount=10,
-                                                                          sort="citationCount:desc", )
+            # searches run concurrently, map returns the results in the order of the keywords,
+            # so the merge below (first keyword wins) is deterministic
+            with ThreadPoolExecutor(max_workers=min(len(new_keywords), SS_SEARCH_CONCURRENCY),
+                                    thread_name_prefix="keyword-search") as executor:
+                keyword_results = list(executor.map(with_deadline(self.search_keyword), new_keywords))
+            for keyword, top_papers in zip(new_keywords, keyword_results):
                 if top_papers is None:
                     print(keyword)
                 else:
@@ -357,16 +483,29 @@ class OpenScholar:
         return new_papers
 
     def moderation_api(self, text: str) -> bool:
-        response = moderations.create(input=text, model=MODERATION_MODEL)
+        with timed_dependency("moderation"):
+            response = moderations.create(input=text, model=MODERATION_MODEL, timeout=call_timeout(LLM_READ_TIMEOUT))
         return response.results[0].flagged
 
-    def validate(self, query: str, task_id: str) -> None:
-        def _starts_with_who_is(question: str):
-            # Regular expression to match "Who is" at the beginning of the question
-            pattern = r"^who is\b"
-            # Perform case-insensitive match
-            return bool(re.match(pattern, question.lower(), re.IGNORECASE))
+    def retrieve_feedback_evidence(
+            self, query: str, question: str, task_id: str, feedback_idx: int
+    ) -> List[Dict[str, Any]]:
+        """Passages retrieved for a feedback's follow-up question, reranked against the question and the query"""
+        prefix = f"Feedback {(feedback_idx + 1)}- "
+        # FIXME: Fix API endpoint
+        with timed_stage("feedback_retrieval"):
+            new_papers = self.retrieve(question, task_id, prefix)
+            if self.ss_retriever is True:
+                new_papers += self.retrieve_additional_passages_ss(question)
+        if len(new_papers) > 0:
+            # TODO: add dedup check
+            new_papers = self.check_paper_duplication(new_papers)
+            self.update_task_state(task_id, f"{prefix}Re-ranking top passages")
+            with timed_stage("feedback_rerank"):
+                new_papers = self.rerank(question + " " + query, new_papers, filtering=False)
+        return new_papers
 
+    def moderate(self, query: str, task_id: str) -> None:
         if OPENAI_API_KEY:
             # self.update_task_state(task_id, "Validating the query")
             logger.info(
@@ -376,13 +515,25 @@ class OpenScholar:
                 raise Exception(
                     "The input query contains harmful content. Please try again with a different query"
                 )
+
+    def validate(self, query: str, task_id: str, with_moderation: bool = True) -> None:
+        def _starts_with_who_is(question: str):
+            # Regular expression to match "Who is" at the beginning of the question
+            pattern = r"^who is\b"
+            # Perform case-insensitive match
+            return bool(re.match(pattern, question.lower(), re.IGNORECASE))
+
+        if with_moderation:
+            self.moderate(query, task_id)
         if _starts_with_who_is(query):
             raise Exception(
                 "We cannot answer questions about people. Please try again with a different query"
             )
         logger.info(f"{task_id}: {query} is valid")
 
-    def answer_query(self, req: ToolRequest, task_id: str) -> TaskResult:
+    def answer_query(
+            self, req: ToolRequest, task_id: str, timings: Optional[Dict[str, float]] = None
+    ) -> TaskResult:
         """
         This function takes a query and returns a response.
         Goes through the following steps:
@@ -392,6 +543,7 @@ class OpenScholar:
         4) Get feedback and call retrieval again based on the feedback
 
         :param query: A scientific query posed to nora by a user
+        :param timings: Filled with the seconds spent in each stage, also when the task fails or is cancelled
         :return: A response to the query
         """
 
@@ -430,28 +582,64 @@ class OpenScholar:
         event_trace = EventTrace(
             task_id,
             self.llm_model,
-            self.paper_finder.retriever.n_retrieval,
+            self.n_retrieval,
             self.n_rerank,
             self.n_feedback,
             req,
         )
 
-        self.validate(query, task_id)
+        # seconds spent in each stage, stored with the task state by the caller
+        timings = timings if timings is not None else dict()
+        speculative = self.speculative_moderation and bool(OPENAI_API_KEY)
+        with timed_stage("validate", timings):
+            self.validate(query, task_id, with_moderation=not speculative)
 
         responses = []
         citation_lists = []
-        logger.info(f"{task_id}: Waking the modal deployment for a warm start")
-        t = threading.Thread(target=self.llm_inference, args=("Just waking you up",))
-        t.start()
-
-        retrieved_candidates = self.retrieve(query, task_id)
+        # only pings the deployments which may have scaled down since they last responded
+        llm_warm_up = warm_state.ensure_warm("llm")
+        warm_state.ensure_warm("reranker")
 
-        self.update_task_state(
-            task_id, "Augmenting retrieved results with Semantic Scholar"
-        )
-        retrieved_candidates += self.retrieve_additional_passages_ss(query)
+        def _retrieve_full_text() -> List[Dict[str, Any]]:
+            with timed_stage("retrieve", timings):
+                return self.retrieve(query, task_id)
 
-        retrieved_candidates = self.check_paper_duplication(retrieved_candidates)
+        def _augment_with_ss() -> List[Dict[str, Any]]:
+            self.update_task_state(
+                task_id, "Augmenting retrieved results with Semantic Scholar"
+            )
+            with timed_stage("s2_augmentation", timings):
+                ss_papers = self.retrieve_additional_passages_ss(query)
+            self.update_task_state(task_id, f"Retrieved {len(ss_papers)} additional papers from Semantic Scholar")
+            return ss_papers
+
+        def _discard_if_flagged(future: Future) -> None:
+            if future.exception() is not None:
+                self.discarded_tasks.add(task_id)
+
+        # both branches only depend on the query, so their latencies overlap instead of adding up.
+        # In speculative mode the query is moderated alongside them, nothing they retrieve is used before it passes.
+        try:
+            with timed_stage("retrieval_fan_out", timings), ThreadPoolExecutor(
+                    max_workers=3, thread_name_prefix=f"retrieval-{task_id}") as executor:
+                moderation_future = (
+                    executor.submit(with_deadline(self.moderate), query, task_id) if speculative else None
+                )
+                if moderation_future is not None:
+                    moderation_future.add_done_callback(_discard_if_flagged)
+                full_text_future = executor.submit(with_deadline(_retrieve_full_text))
+                ss_future = executor.submit(with_deadline(_augment_with_ss))
+                try:
+                    retrieved_candidates = full_text_future.result() + ss_future.result()
+                finally:
+                    # raises for a flagged query, which takes precedence over the branches being stopped
+                    if moderation_future is not None:
+                        moderation_future.result()
+        finally:
+            self.discarded_tasks.discard(task_id)
+
+        with timed_stage("dedup", timings):
+            retrieved_candidates = self.check_paper_duplication(retrieved_candidates)
         logger.info(
             f"{task_id}: {len(retrieved_candidates)} remain after de-duplication"
         )
@@ -470,20 +658,24 @@ class OpenScholar:
         self.update_task_state(
             task_id, f"Re-ranking to obtain top {self.n_rerank} passages"
         )
-        retrieved_candidates = self.rerank(query, retrieved_candidates)
+        with timed_stage("rerank", timings):
+            retrieved_candidates = self.rerank(query, retrieved_candidates)
         event_trace.trace_rerank_event(retrieved_candidates, 0)
         citation_lists.append(retrieved_candidates)
 
-        self.update_task_state(task_id, "Waiting for model cold start...")
-        t.join()
+        if llm_warm_up is not None and not llm_warm_up.is_set():
+            self.update_task_state(task_id, "Waiting for model cold start...")
+            with timed_stage("cold_start_wait", timings):
+                llm_warm_up.wait()
         # generate response
         self.update_task_state(task_id, "Generating the initial draft")
-        initial_response = self.generate_response(query, retrieved_candidates)
-        if len(initial_response) < 10:
-            logger.warning(
-                f"Initial response is too short: {initial_response}, retrying"
-            )
-            initial_response = self.generate_response(query, retrieved_candidates)
+        with timed_stage("draft", timings):
+            initial_response = self.generate_response(query, retrieved_candidates, task_id=task_id)
+            if len(initial_response) < 10:
+                logger.warning(
+                    f"Initial response is too short: {initial_response}, retrying"
+                )
+                initial_response = self.generate_response(query, retrieved_candidates, task_id=task_id)
         # filter out unused citations
         used_ctxs_ids = list(set(extract_citations(initial_response)))
         for cand_idx, cand in enumerate(retrieved_candidates):
@@ -517,159 +709,159 @@ class OpenScholar:
                 "Generating feedback(s) on the initial draft.",
                 estimated_time=f"{self.n_feedback} minutes",
             )
-            feedbacks = self.get_feedback(
-                query=query,
-                ctxs=retrieved_candidates,
-                initial_response=initial_response,
-            )[: self.n_feedback]
+            with timed_stage("feedback", timings):
+                feedbacks = self.get_feedback(
+                    query=query,
+                    ctxs=retrieved_candidates,
+                    initial_response=initial_response,
+                )[: self.n_feedback]
             previous_response = initial_response
-            for feedback_idx, feedback in enumerate(feedbacks):
-                self.update_task_state(
-                    task_id,
-                    "Incorporating feedback {}.".format((feedback_idx + 1)),
-                    f"{(self.n_feedback - feedback_idx)} minutes",
+            # the follow-up questions are all known now, so their evidence is retrieved and reranked while the
+            # draft is being edited, and each edit step picks it up when its turn comes
+            feedback_executor = ThreadPoolExecutor(
+                max_workers=max(1, len(feedbacks)), thread_name_prefix=f"feedback-{task_id}"
+            )
+            prefetched_evidence = {
+                feedback_idx: feedback_executor.submit(
+                    with_deadline(self.retrieve_feedback_evidence), query, feedback[1], task_id, feedback_idx
                 )
-                if len(feedback[1]) == 0:
-                    edited_answer = self.edit_with_feedback(
-                        query, retrieved_candidates, previous_response, feedback[0]
-                    )
-                    edited_answer = re.sub(filter_demo_pattern, "", edited_answer)
-                    if "Here is the revised answer:\n\n" in edited_answer:
-                        edited_answer = edited_answer.split(
-                            "Here is the revised answer:\n\n"
-                        )[1]
-                    if (
-                            len(edited_answer) > 0
-                            and len(edited_answer) / len(previous_response) > 0.9
-                            # and len(edited_answer.splitlines()) / len(previous_response.splitlines()) > 0.5
-                    ):
-                        initial_citations = copy.deepcopy(citation_lists[0])
-                        citation_lists.append(initial_citations)
-                        used_ctxs_ids = extract_citations(edited_answer)
-
-                        previous_response = edited_answer
-
-                        for cand_idx, cand in enumerate(initial_citations):
-                            if cand_idx in used_ctxs_ids:
-                                cand["used"] = True
-                            else:
-                                cand["used"] = False
-
-                        logger.info(
-                            f"after feedback, the number of citations are: {len(citation_lists[-1])}"
-                        )
-                        logger.info("new responses added")
-                        responses.append(
-                            get_response(
-                                {
-                                    "text": edited_answer,
-                                    "feedback": feedback[0],
-                                    "citations": citation_lists[-1],
-                                }
-                            )
-                        )
-                        event_trace.trace_summary_event(
-                            responses[-1].model_dump(), feedback_idx + 1
-                        )
-
-                    else:
-                        print("Skipping as edited answers got too short")
-                else:
-                    new_papers = []
-                    # FIXME: Fix API endpoint
-                    new_papers = self.retrieve(
-                        feedback[1],
+                for feedback_idx, feedback in enumerate(feedbacks)
+                if len(feedback[1]) > 0
+            }
+            try:
+                for feedback_idx, feedback in enumerate(feedbacks):
+                    self.update_task_state(
                         task_id,
-                        f"Feedback {(feedback_idx + 1)}- ",
+                        "Incorporating feedback {}.".format((feedback_idx + 1)),
+                        f"{(self.n_feedback - feedback_idx)} minutes",
                     )
-                    if self.ss_retriever is True:
-                        new_keywords = self.retrieve_keywords(feedback[1])
-                        if len(new_keywords) > 0:
-                            ss_retrieved_papers = self.retrieve_additional_passages_ss(
-                                feedback[1]
+                    if len(feedback[1]) == 0:
+                        with timed_stage("edit", timings):
+                            edited_answer = self.edit_with_feedback(
+                                query, retrieved_candidates, previous_response, feedback[0], task_id=task_id
                             )
-                            new_papers += ss_retrieved_papers
-                    if len(new_papers) > 0:
-                        # TODO: add dedup check
-                        new_papers = self.check_paper_duplication(new_papers)
-                        self.update_task_state(
-                            task_id,
-                            f"Feedback {(feedback_idx + 1)}- Re-ranking top passages",
-                        )
-                        new_papers = self.rerank(
-                            feedback[1] + " " + query, new_papers, filtering=False
-                        )
-
-                        event_trace.trace_retrieval_event(new_papers, feedback_idx + 1)
-                        prev_citations = copy.deepcopy(citation_lists[-1])
-                        passages_start_index = len(prev_citations)
-
-                        self.update_task_state(
-                            task_id,
-                            f"Feedback {(feedback_idx + 1)}- Updating the draft",
-                        )
-                        edited_answer = self.edit_with_feedback_retrieval(
-                            query=query,
-                            ctxs=new_papers,
-                            previous_response=previous_response,
-                            feedback=feedback[0],
-                            passage_start_index=passages_start_index,
-                        )
                         edited_answer = re.sub(filter_demo_pattern, "", edited_answer)
-
-                        if (len(edited_answer) / len(previous_response)) > 0.9:
-                            # and len(edited_answer.splitlines()) / len(previous_response.splitlines()) > 0.5:
-                            prev_citations += new_papers[: self.n_rerank]
-                            # merge citations
-                            logger.info("merging citations")
-                            text_to_citations = {}
-                            for cand_idx, cand in enumerate(prev_citations):
-                                if (
-                                        " ".join(cand["text"].split()[:20])
-                                        in text_to_citations
-                                ):
-                                    edited_answer.replace(
-                                        "[{}]".format(cand_idx),
-                                        "[{}]".format(
-                                            text_to_citations[
-                                                " ".join(cand["text"].split()[:20])
-                                            ]
-                                        ),
-                                    )
-                                else:
-                                    text_to_citations[
-                                        " ".join(cand["text"].split()[:20])
-                                    ] = cand_idx
-
+                        if "Here is the revised answer:\n\n" in edited_answer:
+                            edited_answer = edited_answer.split(
+                                "Here is the revised answer:\n\n"
+                            )[1]
+                        if (
+                                len(edited_answer) > 0
+                                and len(edited_answer) / len(previous_response) > 0.9
+                                # and len(edited_answer.splitlines()) / len(previous_response.splitlines()) > 0.5
+                        ):
+                            initial_citations = copy.deepcopy(citation_lists[0])
+                            citation_lists.append(initial_citations)
                             used_ctxs_ids = extract_citations(edited_answer)
 
                             previous_response = edited_answer
 
-                            for cand_idx, cand in enumerate(prev_citations):
+                            for cand_idx, cand in enumerate(initial_citations):
                                 if cand_idx in used_ctxs_ids:
                                     cand["used"] = True
                                 else:
                                     cand["used"] = False
 
+                            logger.info(
+                                f"after feedback, the number of citations are: {len(citation_lists[-1])}"
+                            )
+                            logger.info("new responses added")
                             responses.append(
                                 get_response(
                                     {
                                         "text": edited_answer,
                                         "feedback": feedback[0],
-                                        "citations": prev_citations,
+                                        "citations": citation_lists[-1],
                                     }
                                 )
                             )
-                            citation_lists.append(prev_citations)
                             event_trace.trace_summary_event(
                                 responses[-1].model_dump(), feedback_idx + 1
                             )
+
                         else:
-                            print("skipping as edited answers got too short")
-                self.update_task_state(
-                    task_id,
-                    f"Feedback {(feedback_idx + 1)}- Incorporated successfully",
-                    curr_response=responses,
-                )
+                            print("Skipping as edited answers got too short")
+                    else:
+                        with timed_stage("feedback_evidence_wait", timings):
+                            new_papers = prefetched_evidence[feedback_idx].result()
+                        if len(new_papers) > 0:
+                            event_trace.trace_retrieval_event(new_papers, feedback_idx + 1)
+                            prev_citations = copy.deepcopy(citation_lists[-1])
+                            passages_start_index = len(prev_citations)
+
+                            self.update_task_state(
+                                task_id,
+                                f"Feedback {(feedback_idx + 1)}- Updating the draft",
+                            )
+                            with timed_stage("edit", timings):
+                                edited_answer = self.edit_with_feedback_retrieval(
+                                    query=query,
+                                    ctxs=new_papers,
+                                    previous_response=previous_response,
+                                    feedback=feedback[0],
+                                    passage_start_index=passages_start_index,
+                                    task_id=task_id,
+                                )
+                            edited_answer = re.sub(filter_demo_pattern, "", edited_answer)
+
+                            if (len(edited_answer) / len(previous_response)) > 0.9:
+                                # and len(edited_answer.splitlines()) / len(previous_response.splitlines()) > 0.5:
+                                prev_citations += new_papers[: self.n_rerank]
+                                # merge citations
+                                logger.info("merging citations")
+                                text_to_citations = {}
+                                for cand_idx, cand in enumerate(prev_citations):
+                                    if (
+                                            " ".join(cand["text"].split()[:20])
+                                            in text_to_citations
+                                    ):
+                                        edited_answer.replace(
+                                            "[{}]".format(cand_idx),
+                                            "[{}]".format(
+                                                text_to_citations[
+                                                    " ".join(cand["text"].split()[:20])
+                                                ]
+                                            ),
+                                        )
+                                    else:
+                                        text_to_citations[
+                                            " ".join(cand["text"].split()[:20])
+                                        ] = cand_idx
+
+                                used_ctxs_ids = extract_citations(edited_answer)
+
+                                previous_response = edited_answer
+
+                                for cand_idx, cand in enumerate(prev_citations):
+                                    if cand_idx in used_ctxs_ids:
+                                        cand["used"] = True
+                                    else:
+                                        cand["used"] = False
+
+                                responses.append(
+                                    get_response(
+                                        {
+                                            "text": edited_answer,
+                                            "feedback": feedback[0],
+                                            "citations": prev_citations,
+                                        }
+                                    )
+                                )
+                                citation_lists.append(prev_citations)
+                                event_trace.trace_summary_event(
+                                    responses[-1].model_dump(), feedback_idx + 1
+                                )
+                            else:
+                                print("skipping as edited answers got too short")
+                    self.update_task_state(
+                        task_id,
+                        f"Feedback {(feedback_idx + 1)}- Incorporated successfully",
+                        curr_response=responses,
+                    )
+            finally:
+                # waits for the prefetches, which stop at their next stage if the task was cancelled
+                feedback_executor.shutdown()
         event_trace.push_trace_to_gcs()
+        logger.info(f"{task_id}: Stage timings: {timings}")
+        self.n_published_iterations.pop(task_id, None)
         return TaskResult(iterations=responses)
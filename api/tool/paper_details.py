@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from tool.cache import TTLCache
+from tool.utils import query_s2_api
+
+logger = logging.getLogger(__name__)
+
+PAPER_CACHE_SIZE = int(os.getenv("PAPER_CACHE_SIZE", 50000))
+PAPER_CACHE_TTL = float(os.getenv("PAPER_CACHE_TTL", 24 * 60 * 60))
+# Requests arriving within PAPER_BATCH_WINDOW seconds of each other are merged into one S2 batch call
+PAPER_BATCH_WINDOW = float(os.getenv("PAPER_BATCH_WINDOW", 0.02))
+# Max number of ids per call to the S2 paper/batch end point
+PAPER_BATCH_SIZE = int(os.getenv("PAPER_BATCH_SIZE", 500))
+PAPER_FETCH_WORKERS = int(os.getenv("PAPER_FETCH_WORKERS", 4))
+
+PaperKey = Tuple[int, str]
+
+
+class PaperDetailsFetcher:
+    """
+    Fetches paper metadata from the S2 paper/batch end point, with an LRU + TTL cache keyed by corpus id and field set.
+    Ids which are not cached are queued for a short window, so that concurrent requests share a single batch call,
+    and the queue is flushed early as soon as it holds a full batch, so long id lists are fetched in parallel chunks.
+    Papers unknown to S2 are cached as None, like S2 returns them.
+    """
+
+    def __init__(self, max_size: int = PAPER_CACHE_SIZE, ttl: float = PAPER_CACHE_TTL,
+                 window: float = PAPER_BATCH_WINDOW, batch_size: int = PAPER_BATCH_SIZE,
+                 n_workers: int = PAPER_FETCH_WORKERS) -> None:
+        self.window = window
+        self.batch_size = batch_size
+        self.n_workers = n_workers
+        self._cache: TTLCache[Optional[Dict[str, Any]]] = TTLCache(max_size, ttl)
+        self._lock = threading.Lock()
+        # ids waiting for the next batch call, per field set
+        self._pending: Dict[str, List[int]] = dict()
+        # ids which are queued or being fetched, so that concurrent requests for them wait on the same call
+        self._in_flight: Dict[PaperKey, Future] = dict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # created lazily, so that every (forked) worker process gets its own threads
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix="paper-details")
+            self._pending, self._in_flight = dict(), dict()
+            self._pid = os.getpid()
+        return self._executor
+
+    def get(self, corpus_ids: List[int], fields: str) -> List[Optional[Dict[str, Any]]]:
+        """The details of the papers in the order of `corpus_ids`, with None for papers which were not found"""
+        details, futures = dict(), dict()
+        for corpus_id in dict.fromkeys(corpus_ids):
+            cached = self._cache.get_with_age((corpus_id, fields))
+            if cached is not None and cached[1] <= self._cache.ttl:
+                details[corpus_id] = cached[0]
+            else:
+                futures[corpus_id] = self._enqueue(corpus_id, fields)
+        if futures:
+            logger.info(f"Paper details: {len(details)} cached, fetching {len(futures)} from S2")
+        for corpus_id, future in futures.items():
+            details[corpus_id] = future.result()
+        return [details[corpus_id] for corpus_id in corpus_ids]
+
+    def _enqueue(self, corpus_id: int, fields: str) -> Future:
+        with self._lock:
+            executor = self._get_executor()
+            if future := self._in_flight.get((corpus_id, fields)):
+                return future
+            future = self._in_flight[(corpus_id, fields)] = Future()
+            pending = self._pending.setdefault(fields, [])
+            pending.append(corpus_id)
+            if len(pending) >= self.batch_size:
+                executor.submit(self._fetch, fields, self._pending.pop(fields))
+            elif len(pending) == 1:
+                # the first id queued for the field set opens the window
+                timer = threading.Timer(self.window, self._flush, args=(fields,))
+                timer.daemon = True
+                timer.start()
+            return future
+
+    def _flush(self, fields: str) -> None:
+        with self._lock:
+            # the batch may have been flushed already because it filled up
+            if corpus_ids := self._pending.pop(fields, None):
+                self._get_executor().submit(self._fetch, fields, corpus_ids)
+
+    def _fetch(self, fields: str, corpus_ids: List[int]) -> None:
+        try:
+            # S2 returns the papers in the order of the ids, with null for the ones it does not know
+            data = query_s2_api(
+                end_pt="paper/batch",
+                method="post",
+                params={"fields": fields},
+                payload={"ids": [f"CorpusId:{cid}" for cid in corpus_ids]},
+            )
+            results = dict(zip(corpus_ids, data))
+        except Exception as e:
+            logger.warning(f"Fetching details of {len(corpus_ids)} papers from S2 failed: {e}")
+            with self._lock:
+                futures = [self._in_flight.pop((cid, fields)) for cid in corpus_ids]
+            for future in futures:
+                future.set_exception(e)
+            return
+        with self._lock:
+            futures = []
+            for corpus_id in corpus_ids:
+                self._cache.set((corpus_id, fields), results.get(corpus_id))
+                futures.append(self._in_flight.pop((corpus_id, fields)))
+        for corpus_id, future in zip(corpus_ids, futures):
+            future.set_result(results.get(corpus_id))
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
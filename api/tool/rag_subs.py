@@ -1,23 +1,184 @@
-from typing import Dict, Any, List
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple, cast
 
+import modal
+import numpy as np
 from scholarqa import ModalReranker, PaperFinderWithReranker
 from logging import getLogger
 
+from tool.cache import TTLCache
+from tool.deadline import call_timeout, with_deadline
+from tool.metrics import RERANK_CACHE_LOOKUPS, timed_dependency
+from tool.result_cache import normalize_query
+from tool.warm_state import warm_state
+
 logger = getLogger(__name__)
 
+# Scores of (query, passage) pairs, which repeat across identical queries and feedback rounds
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", 100000))
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", 24 * 60 * 60))
+# Passages are scored in shards of at most RERANK_SHARD_SIZE passages (0, the default, sends them all in one call), and
+# up to RERANK_SHARD_CONCURRENCY shards of a process are in flight at once. A failed shard is retried
+# RERANK_SHARD_RETRIES times. The reranker deployment runs a single container, so sharding only pays off once it
+# scales out
+RERANK_SHARD_SIZE = int(os.getenv("RERANK_SHARD_SIZE", 0))
+RERANK_SHARD_CONCURRENCY = int(os.getenv("RERANK_SHARD_CONCURRENCY", 4))
+RERANK_SHARD_RETRIES = int(os.getenv("RERANK_SHARD_RETRIES", 1))
+# At most this many of the reranked passages come from the same paper, 0 does not cap them
+RERANK_MAX_PASSAGES_PER_PAPER = int(os.getenv("RERANK_MAX_PASSAGES_PER_PAPER", 0))
+# Max seconds a call to the reranker may take, less once the deadline of its task is closer than that
+RERANK_TIMEOUT = float(os.getenv("RERANK_TIMEOUT", 120))
+
+
+def _content_hash(text: str) -> bytes:
+    return blake2b(text.encode("utf-8"), digest_size=16).digest()
+
 
 class ModalRerankerNoBatch(ModalReranker):
-    def __init__(self, app_name: str, api_name: str, gen_options: Dict[str, Any] = None):
+    def __init__(self, app_name: str, api_name: str, gen_options: Dict[str, Any] = None,
+                 shard_size: int = RERANK_SHARD_SIZE, shard_concurrency: int = RERANK_SHARD_CONCURRENCY,
+                 shard_retries: int = RERANK_SHARD_RETRIES):
         super().__init__(app_name, api_name, batch_size=-1, gen_options=gen_options)
+        self.score_cache: TTLCache[float] = TTLCache(RERANK_CACHE_SIZE, RERANK_CACHE_TTL)
+        self.shard_size = shard_size
+        self.shard_concurrency = shard_concurrency
+        self.shard_retries = shard_retries
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._pid = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # the pool is shared by all the queries of a process, which bounds the load on the reranker deployment
+        with self._executor_lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.shard_concurrency,
+                                                    thread_name_prefix="rerank-shard")
+                self._pid = os.getpid()
+            return self._executor
+
+    def shutdown(self) -> None:
+        """Stop the shard pool of this process once its shards are scored, the next query starts a new one"""
+        with self._executor_lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+    # ModalReranker.get_scores is not annotated, its return type is inferred from ModalEngine.generate
+    def get_scores(self, query: str, documents: List[str]) -> List[float]:  # pyright: ignore reportIncompatibleMethodOverride
+        """Scores of the documents for the query, only the pairs which were not scored before are sent to Modal"""
+        query_hash = _content_hash(normalize_query(query))
+        keys: List[Tuple[bytes, bytes]] = [(query_hash, _content_hash(document)) for document in documents]
+        scores: List[Optional[float]] = [self.score_cache.get(key) for key in keys]
+        misses = [idx for idx, score in enumerate(scores) if score is None]
+        RERANK_CACHE_LOOKUPS.labels("hit").inc(len(documents) - len(misses))
+        RERANK_CACHE_LOOKUPS.labels("miss").inc(len(misses))
+        if misses:
+            logger.info(f"Reranker score cache: {len(documents) - len(misses)} hits, {len(misses)} misses")
+            for idx, score in zip(misses, self.score_documents(query, [documents[idx] for idx in misses])):
+                self.score_cache.set(keys[idx], score)
+                scores[idx] = score
+        # every miss was scored
+        return cast(List[float], scores)
+
+    def score_documents(self, query: str, documents: List[str]) -> List[float]:
+        """
+        Scores of the documents, in their order. The documents are split into shards which are scored concurrently,
+        and only the shards which failed are retried.
+        """
+        if self.shard_size <= 0 or len(documents) <= self.shard_size:
+            return self._score_shard(query, documents)
+        shards = {start: documents[start:start + self.shard_size] for start in range(0, len(documents), self.shard_size)}
+        logger.info(f"Scoring {len(documents)} documents in {len(shards)} shards")
+        scores: List[Optional[float]] = [None] * len(documents)
+        failed: Dict[int, Exception] = dict()
+        for attempt in range(max(self.shard_retries, 0) + 1):
+            executor = self._get_executor()
+            score_shard = with_deadline(self._score_shard)
+            futures = {start: executor.submit(score_shard, query, shard) for start, shard in shards.items()}
+            failed = dict()
+            for start, future in futures.items():
+                try:
+                    scores[start:start + len(shards[start])] = future.result()
+                except Exception as e:
+                    failed[start] = e
+            if not failed:
+                # every shard was scored
+                return cast(List[float], scores)
+            if attempt < self.shard_retries:
+                logger.warning(f"Retrying {len(failed)} of {len(shards)} reranker shards: {next(iter(failed.values()))}")
+                shards = {start: shards[start] for start in failed}
+        raise next(iter(failed.values()))
 
-    def get_scores(self, query: str, documents: List[str]):
+    def _score_shard(self, query: str, documents: List[str]) -> List[float]:
         logger.info("Invoking the reranker deployed on Modal")
-        return self.modal_engine.generate(
-            (query, documents), streaming=False
-        )
+        fn, opts = self.modal_engine.fn_lookup()
+        with timed_dependency("reranker"):
+            call = fn.spawn(query, documents, **opts) if opts else fn.spawn(query, documents)
+            try:
+                scores = call.get(timeout=call_timeout(RERANK_TIMEOUT))
+            except modal.exception.TimeoutError:
+                # the container would keep scoring documents nobody waits for anymore
+                call.cancel()
+                raise
+        warm_state.mark_warm("reranker")
+        # the reranker endpoint returns one score per document
+        return cast(List[float], scores)
+
+    def ping(self) -> None:
+        """Minimal request, which boots a container if the deployment scaled down"""
+        self._score_shard("ping", ["ping"])
+
+
+class RerankedPassages(NamedTuple):
+    # positions of the kept passages in the candidates, best first, and their scores
+    indices: np.ndarray
+    scores: np.ndarray
+
+
+def select_top_passages(scores: np.ndarray, threshold: float, k: int, papers: Optional[List[Any]] = None,
+                        max_per_paper: int = 0) -> RerankedPassages:
+    """
+    The (at most) `k` best scores of at least `threshold`, and at most `max_per_paper` of them from the same paper.
+    Passages whose paper is None are not capped. Ties are broken by position, like a stable sort of the scores.
+    """
+    eligible = np.flatnonzero(scores >= threshold)
+    if max_per_paper > 0 and papers is not None and len(eligible):
+        # rank of each eligible passage among the passages of its paper, a passage of an unknown paper is on its own
+        paper_keys = [f"paper:{papers[idx]}" if papers[idx] is not None else f"passage:{idx}" for idx in eligible]
+        _, paper_labels = np.unique(paper_keys, return_inverse=True)
+        order = np.lexsort((eligible, -scores[eligible], paper_labels))
+        firsts = np.flatnonzero(np.concatenate([[True], paper_labels[order][1:] != paper_labels[order][:-1]]))
+        ranks = np.arange(len(order)) - np.repeat(firsts, np.diff(np.append(firsts, len(order))))
+        eligible = np.sort(eligible[order[ranks < max_per_paper]])
+    if 0 < k < len(eligible):
+        # the k-th best score, every passage above it is kept, and the passages at it by position
+        kth_score = -np.partition(-scores[eligible], k - 1)[k - 1]
+        above, at = eligible[scores[eligible] > kth_score], eligible[scores[eligible] == kth_score]
+        eligible = np.concatenate([above, at[:k - len(above)]])
+    top = eligible[np.lexsort((eligible, -scores[eligible]))]
+    return RerankedPassages(top, scores[top])
 
 
 class PaperFinderWithRerankerThreshold(PaperFinderWithReranker):
+    def __init__(self, *args, max_passages_per_paper: int = RERANK_MAX_PASSAGES_PER_PAPER, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_passages_per_paper = max_passages_per_paper
+
+    def rerank_indices(self, query: str, retrieved_ctxs: List[Dict[str, Any]]) -> RerankedPassages:
+        """The top n_rerank passages with a score of at least the context threshold, without a full sort"""
+        passages = [doc["title"] + " " + doc["text"] if "title" in doc else doc["text"] for doc in retrieved_ctxs]
+        scores = np.asarray(self.reranker_engine.get_scores(query, passages), dtype=float)
+        return select_top_passages(scores, self.context_threshold, self.n_rerank,
+                                   [doc.get("corpus_id") for doc in retrieved_ctxs], self.max_passages_per_paper)
+
     def rerank(self, query: str, retrieved_ctxs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        sorted_snippets = super().rerank(query, retrieved_ctxs)
-        return [ss for ss in sorted_snippets if ss["rerank_score"] >= self.context_threshold]
+        reranked = self.rerank_indices(query, retrieved_ctxs)
+        # only the kept passages are annotated with their scores
+        top_ctxs = [retrieved_ctxs[idx] for idx in reranked.indices]
+        for doc, score in zip(top_ctxs, reranked.scores.tolist()):
+            doc["rerank_score"] = score
+        logger.info(f"Done reranking: {len(top_ctxs)} of {len(retrieved_ctxs)} passages remain")
+        return top_ctxs
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import re
+from time import time
+from typing import Any, Optional, Tuple, Union
+
+from nora_lib.tasks.models import AsyncTaskState, TASK_STATUSES
+from nora_lib.tasks.state import NoSuchTaskException
+
+from tool.cache import TTLCache
+from tool.locked_state import LockedStateManager
+from tool.models import FINISHED_TASK_STATUSES
+from tool.sqlite_state import SqliteStateManager
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 1024))
+# Results are served as is for RESULT_CACHE_TTL seconds, and for another RESULT_CACHE_STALE_TTL seconds while
+# they are recomputed in the background
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 6 * 60 * 60))
+RESULT_CACHE_STALE_TTL = float(os.getenv("RESULT_CACHE_STALE_TTL", 18 * 60 * 60))
+# Identical requests stop being attached to a task this many seconds after it was registered, tasks time out before that
+RESULT_CACHE_IN_FLIGHT_TTL = float(os.getenv("RESULT_CACHE_IN_FLIGHT_TTL", 60 * 60))
+
+
+def normalize_query(query: str) -> str:
+    """Queries which only differ in case, whitespace or punctuation are answered the same"""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+
+class QueryResultCache:
+    """
+    Maps a normalized query and the pipeline parameters to the task which answered it, or is answering it right now.
+    The results themselves stay in the task state store, so a cached answer is served by pointing the caller to the
+    completed task, and identical concurrent requests are attached to the task already in flight (single-flight).
+    Both maps are kept in the task state store as well, so every gunicorn worker serves the same results and attaches
+    to the same task. Each worker keeps the fresh results it looked up in an LRU in front of the store.
+    """
+
+    def __init__(self, task_mgr: Union[LockedStateManager, SqliteStateManager], max_size: int = RESULT_CACHE_SIZE,
+                 ttl: float = RESULT_CACHE_TTL, stale_ttl: float = RESULT_CACHE_STALE_TTL,
+                 in_flight_ttl: float = RESULT_CACHE_IN_FLIGHT_TTL) -> None:
+        self.task_mgr = task_mgr
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        # a task which never reports that it finished (e.g. its worker died) stops being attached to after this long
+        self.in_flight_ttl = in_flight_ttl
+        # task ids of fresh results, along with when they were recorded in the store
+        self._results: TTLCache[Tuple[str, float]] = TTLCache(max_size, ttl)
+
+    @staticmethod
+    def make_key(query: str, **params: Any) -> str:
+        return json.dumps({"query": normalize_query(query), **params}, sort_keys=True)
+
+    @staticmethod
+    def _result_key(key: str) -> str:
+        return f"result:{key}"
+
+    @staticmethod
+    def _in_flight_key(key: str) -> str:
+        return f"in_flight:{key}"
+
+    def _read_state(self, task_id: str) -> Optional[AsyncTaskState]:
+        try:
+            return self.task_mgr.read_state(task_id)
+        except NoSuchTaskException:
+            # expired by the state janitor
+            return None
+
+    def _read_result(self, key: str) -> Optional[Tuple[str, float]]:
+        """The task which answered the key and the age of its result, while the result can be served"""
+        entry = self._results.get(key)
+        if entry is None or time() - entry[1] > self.ttl:
+            # a result which went stale might have been refreshed by another worker
+            entry = self.task_mgr.read_key(self._result_key(key))
+            if entry is None or time() - entry[1] > self.ttl + self.stale_ttl:
+                return None
+            self._results.set(key, entry)
+        return entry[0], time() - entry[1]
+
+    def _read_in_flight(self, key: str) -> Optional[str]:
+        entry = self.task_mgr.read_key(self._in_flight_key(key))
+        return entry[0] if entry is not None and time() - entry[1] < self.in_flight_ttl else None
+
+    def _settle(self, key: str, task_id: str, state: Optional[AsyncTaskState]) -> None:
+        # keep the result of a completed task, and stop attaching requests to the task
+        if state is not None and state.task_status == TASK_STATUSES["COMPLETED"] and state.task_result:
+            self.task_mgr.claim_key(self._result_key(key), task_id)
+            self._results.pop(key)
+        self.task_mgr.release_key(self._in_flight_key(key), task_id)
+
+    def _promote(self, key: str) -> Optional[str]:
+        """
+        Move the in-flight task for the key to the results once it completes, or drop it if it failed.
+        Returns the task which is still in flight, if any.
+        """
+        task_id = self._read_in_flight(key)
+        if not task_id:
+            return None
+        state = self._read_state(task_id)
+        if state is None or state.task_status in FINISHED_TASK_STATUSES:
+            self._settle(key, task_id, state)
+            return None
+        return task_id
+
+    def lookup(self, key: str) -> Tuple[Optional[AsyncTaskState], bool]:
+        """
+        The state of the completed (possibly stale) or in-flight task for the key, if any,
+        and whether a new task should be started to refresh a stale result.
+        """
+        in_flight_id = self._promote(key)
+        if cached := self._read_result(key):
+            task_id, age = cached
+            state = self._read_state(task_id)
+            if state is not None and state.task_status == TASK_STATUSES["COMPLETED"]:
+                return state, age > self.ttl and in_flight_id is None
+            self._results.pop(key)
+            self.task_mgr.release_key(self._result_key(key), task_id)
+        if in_flight_id and (state := self._read_state(in_flight_id)) is not None:
+            # requests are not attached to a task which is being cancelled
+            if not state.extra_state.get("cancel_requested"):
+                return state, False
+        return None, False
+
+    def register(self, key: str, task_id: str) -> str:
+        """
+        Record the task started to answer the key, which identical requests attach to until it finishes.
+        Returns the task which identical requests attach to, which is another one if an identical request (on any
+        worker) registered its task first.
+        """
+        return self.task_mgr.claim_key(self._in_flight_key(key), task_id, self.in_flight_ttl)
+
+    def finish(self, key: str, task_id: str) -> None:
+        """Called once the task registered for the key is done (or will never run), whatever its outcome"""
+        self._settle(key, task_id, self._read_state(task_id))
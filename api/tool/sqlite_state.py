@@ -0,0 +1,253 @@
+import json
+import os
+import sqlite3
+import threading
+from time import time
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+from nora_lib.tasks.models import AsyncTaskState, R
+from nora_lib.tasks.state import IStateManager, NoSuchTaskException
+
+from tool.locked_state import ACTIVE_TASK_AGE
+from tool.models import FINISHED_TASK_STATUSES
+
+# fields of AsyncTaskState stored in their own columns, any other field of the concrete state class goes into `fields`
+STATE_COLUMNS = ("task_status", "estimated_time", "task_result", "extra_state")
+
+
+def check_local_db_path(db_path: str, network_dir: str) -> None:
+    """Reject a database path inside `network_dir`, a directory mounted from a network filesystem"""
+    db_dir = os.path.dirname(os.path.realpath(db_path))
+    network_dir = os.path.realpath(network_dir)
+    if os.path.commonpath([db_dir, network_dir]) == network_dir:
+        raise ValueError(
+            f"The task state database {db_path} is in {network_dir}, which is on a network filesystem where WAL mode "
+            f"can corrupt it, use a pod-local path instead"
+        )
+
+
+class SqliteStateManager(IStateManager[R]):
+    """
+    Stores task state as one row per task in a SQLite database in WAL mode.
+    Readers never block on writers, and status updates rewrite only the columns that change.
+    WAL relies on shared memory between the processes which open the database, so `db_path` must be on a host-local
+    filesystem: it is safe for the workers of a single replica, but not over a network filesystem (like the PVC that
+    ASYNC_STATE_DIR is mounted from) shared by several replicas.
+    """
+
+    def __init__(self, task_state_class: Type[AsyncTaskState[R]], db_path: str) -> None:
+        self._task_state_class = task_state_class
+        self._db_path = db_path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS task_state (
+                task_id TEXT PRIMARY KEY,
+                task_status TEXT,
+                estimated_time TEXT,
+                task_result TEXT,
+                extra_state TEXT,
+                fields TEXT,
+                updated_at REAL
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS task_state_updated_at ON task_state (updated_at)")
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS task_event (
+                task_id TEXT,
+                seq INTEGER,
+                event TEXT,
+                PRIMARY KEY (task_id, seq)
+            )"""
+        )
+        # the tasks recorded for keys, see claim_key
+        conn.execute(
+            """CREATE TABLE IF NOT EXISTS task_key (
+                key TEXT PRIMARY KEY,
+                task_id TEXT,
+                updated_at REAL
+            )"""
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS task_key_updated_at ON task_key (updated_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can be shared neither across threads nor across forked processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def read_state(self, task_id: str) -> AsyncTaskState[R]:
+        row = self._connection().execute(
+            "SELECT task_status, estimated_time, task_result, extra_state, fields FROM task_state WHERE task_id = ?",
+            (task_id,),
+        ).fetchone()
+        if row is None:
+            raise NoSuchTaskException(task_id)
+        task_status, estimated_time, task_result, extra_state, fields = row
+        return self._task_state_class(
+            task_id=task_id,
+            task_status=task_status,
+            estimated_time=estimated_time,
+            task_result=json.loads(task_result) if task_result else None,
+            extra_state=json.loads(extra_state),
+            **json.loads(fields),
+        )
+
+    def write_state(self, state: AsyncTaskState[R]) -> None:
+        state_dict = state.model_dump(mode="json")
+        fields = {k: v for k, v in state_dict.items() if k != "task_id" and k not in STATE_COLUMNS}
+        self._connection().execute(
+            """INSERT INTO task_state (task_id, task_status, estimated_time, task_result, extra_state, fields, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (task_id) DO UPDATE SET
+                task_status = excluded.task_status,
+                estimated_time = excluded.estimated_time,
+                task_result = excluded.task_result,
+                extra_state = excluded.extra_state,
+                fields = excluded.fields,
+                updated_at = excluded.updated_at""",
+            (
+                state.task_id,
+                state_dict["task_status"],
+                state_dict["estimated_time"],
+                json.dumps(state_dict["task_result"]) if state_dict["task_result"] is not None else None,
+                json.dumps(state_dict["extra_state"]),
+                json.dumps(fields),
+                time(),
+            ),
+        )
+
+    def update_fields(
+            self,
+            task_id: str,
+            task_status: Optional[str] = None,
+            estimated_time: Optional[str] = None,
+            task_result: Optional[R] = None,
+            extra_state: Optional[Dict[str, Any]] = None,
+            unless_finished: bool = False,
+    ) -> bool:
+        """
+        Update only the given fields of a task's state, `extra_state` is merged into the existing one.
+        With `unless_finished`, the state of a task which already has an outcome is left as is.
+        Returns whether the state was updated.
+        """
+        updates: Dict[str, Any] = {"updated_at": time()}
+        if task_status is not None:
+            updates["task_status"] = task_status
+        if estimated_time is not None:
+            updates["estimated_time"] = estimated_time
+        if task_result is not None:
+            updates["task_result"] = task_result.model_dump_json()
+        conn = self._connection()
+        # the read-modify-write of extra_state has to hold the write lock for the whole transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if extra_state or unless_finished:
+                row = conn.execute(
+                    "SELECT task_status, extra_state FROM task_state WHERE task_id = ?", (task_id,)
+                ).fetchone()
+                if row is None:
+                    raise NoSuchTaskException(task_id)
+                if unless_finished and row[0] in FINISHED_TASK_STATUSES:
+                    conn.execute("ROLLBACK")
+                    return False
+                if extra_state:
+                    updates["extra_state"] = json.dumps({**json.loads(row[1]), **extra_state})
+            cursor = conn.execute(
+                f"UPDATE task_state SET {', '.join(f'{col} = ?' for col in updates)} WHERE task_id = ?",
+                (*updates.values(), task_id),
+            )
+            if cursor.rowcount == 0:
+                raise NoSuchTaskException(task_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    def append_event(self, task_id: str, event: Dict[str, Any]) -> None:
+        """Append an event to the task's event log"""
+        self._connection().execute(
+            "INSERT INTO task_event SELECT ?, COALESCE(MAX(seq), 0) + 1, ? FROM task_event WHERE task_id = ?",
+            (task_id, json.dumps(event), task_id),
+        )
+
+    def read_events(
+            self, task_id: str, after: int = 0, offset: int = 0
+    ) -> Tuple[List[Tuple[int, Dict[str, Any]]], int]:
+        """
+        Events logged for the task with a sequence number greater than `after`, as (sequence number, event), and the
+        offset to pass to the next call. Events are looked up by their sequence number, so the offset is unused.
+        """
+        rows = self._connection().execute(
+            "SELECT seq, event FROM task_event WHERE task_id = ? AND seq > ? ORDER BY seq", (task_id, after)
+        ).fetchall()
+        return [(seq, json.loads(event)) for seq, event in rows], offset
+
+    def read_key(self, key: str) -> Optional[Tuple[str, float]]:
+        """The task recorded for the key and when it was recorded, if any"""
+        row = self._connection().execute("SELECT task_id, updated_at FROM task_key WHERE key = ?", (key,)).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def claim_key(self, key: str, task_id: str, ttl: float = 0.0) -> str:
+        """
+        Record the task for the key, unless another task was recorded for it less than `ttl` seconds ago.
+        Returns the task recorded for the key, which concurrent claims agree on.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT task_id, updated_at FROM task_key WHERE key = ?", (key,)).fetchone()
+            if row is not None and time() - row[1] < ttl:
+                task_id = row[0]
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO task_key (key, task_id, updated_at) VALUES (?, ?, ?)",
+                    (key, task_id, time()),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return task_id
+
+    def release_key(self, key: str, task_id: str) -> None:
+        """Forget the task recorded for the key, if it is still `task_id`"""
+        self._connection().execute("DELETE FROM task_key WHERE key = ? AND task_id = ?", (key, task_id))
+
+    def expire_tasks(self, max_age: float, max_count: int) -> Tuple[int, int]:
+        """
+        Delete the rows of tasks which were last updated more than `max_age` seconds ago, and of the oldest tasks
+        beyond the newest `max_count`, along with their events. Keys recorded more than `max_age` seconds ago are
+        deleted too.
+        Returns the number of tasks expired and the number of bytes freed up in the database for reuse.
+        """
+        conn = self._connection()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        n_free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        now = time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            expired = [row[0] for row in conn.execute(
+                """SELECT task_id FROM task_state WHERE updated_at < ?
+                UNION
+                SELECT task_id FROM (SELECT task_id, updated_at FROM task_state ORDER BY updated_at DESC LIMIT -1 OFFSET ?)
+                WHERE updated_at < ?""",
+                (now - max_age, max_count, now - ACTIVE_TASK_AGE),
+            )]
+            for idx in range(0, len(expired), 500):
+                batch = expired[idx:idx + 500]
+                placeholders = ", ".join("?" * len(batch))
+                conn.execute(f"DELETE FROM task_state WHERE task_id IN ({placeholders})", batch)
+                conn.execute(f"DELETE FROM task_event WHERE task_id IN ({placeholders})", batch)
+            conn.execute("DELETE FROM task_key WHERE updated_at < ?", (now - max_age,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        n_bytes = (conn.execute("PRAGMA freelist_count").fetchone()[0] - n_free_pages) * page_size
+        return len(expired), max(n_bytes, 0)
@@ -0,0 +1,294 @@
+import json
+import logging
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from time import sleep, time
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from filelock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# "thread" runs the (I/O bound) pipeline on a pool of threads inside the gunicorn worker,
+# "process" pre-forks a pool of long-lived worker processes instead, in every gunicorn worker.
+TASK_RUNNER_MODE = os.getenv("TASK_RUNNER_MODE", "thread")
+# Max number of tasks running at once in the whole pod, across all of its gunicorn workers
+TASK_RUNNER_POOL_SIZE = int(os.getenv("TASK_RUNNER_POOL_SIZE", 2))
+# The runner slots of all the gunicorn workers of a pod are accounted for in this dir, which must be local to the pod
+TASK_RUNNER_DIR = os.getenv("TASK_RUNNER_DIR", "/tmp/task_runners")
+# How often (in seconds) a worker with queued tasks checks whether the tasks of other workers freed up a runner
+TASK_DISPATCH_INTERVAL = float(os.getenv("TASK_DISPATCH_INTERVAL", 0.25))
+# Max number of tasks of the pod waiting for a free runner before new tasks are rejected
+TASK_QUEUE_SIZE = int(os.getenv("TASK_QUEUE_SIZE", 4))
+# Initial guess (in seconds) of how long a task occupies a runner, refined as tasks complete
+TASK_DURATION_ESTIMATE = float(os.getenv("TASK_DURATION_ESTIMATE", 60))
+
+
+class TaskQueueFullException(Exception):
+    def __init__(self, retry_after: int):
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return f"All task runners are busy and the task queue is full, retry after {self.retry_after} seconds"
+
+
+class TaskCancelledException(Exception):
+    """Raised inside a running task once it has been cancelled, or has run past its deadline"""
+
+    def __init__(self, task_id: str, timed_out: bool = False):
+        self._task_id = task_id
+        self.timed_out = timed_out
+
+    def __str__(self):
+        return f"Task {self._task_id} {'ran past its deadline' if self.timed_out else 'was cancelled'}"
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TaskRunnerPool:
+    """
+    A bounded, long-lived pool of task runners, shared by all the gunicorn workers of a pod.
+    Every worker runs its tasks on its own executor, but a task is only handed to it once it holds one of the
+    `pool_size` runner slots of the pod. Tasks wait for a slot in a bounded FIFO queue, shared by the workers as well.
+    The slots and the queue are kept in a file of `runner_dir`, under a file lock, so the number of concurrently
+    running pipelines (and the memory they hold) and of queued tasks are capped per pod, irrespective of the number of
+    workers and of the request rate. Once the queue is full, new tasks are rejected with a `TaskQueueFullException`.
+    The slots and queued tasks of a worker which died are freed.
+    """
+
+    def __init__(self, pool_size: int = TASK_RUNNER_POOL_SIZE, max_pending: int = TASK_QUEUE_SIZE,
+                 mode: str = TASK_RUNNER_MODE, runner_dir: str = TASK_RUNNER_DIR) -> None:
+        if mode not in {"thread", "process"}:
+            raise ValueError(f"Unsupported task runner mode: {mode}, expected one of 'thread' or 'process'")
+        self.pool_size = pool_size
+        self.max_pending = max_pending
+        self.mode = mode
+        self._lock = threading.RLock()
+        self._executor: Optional[Executor] = None
+        self._pid = None
+        # the tasks of this worker, the queue of the pod only holds their ids
+        self._pending: OrderedDict[str, Tuple[Callable[..., Any], Tuple[Any, ...], Optional[Callable[[], None]]]] = (
+            OrderedDict()
+        )
+        self._running: Dict[str, Tuple[Future, float]] = dict()
+        # polls for slots freed up by other workers while tasks of this worker are queued
+        self._poller: Optional[threading.Thread] = None
+        os.makedirs(runner_dir, exist_ok=True)
+        self._slots_path = os.path.join(runner_dir, "slots.json")
+        self._slots_lock = FileLock(os.path.join(runner_dir, "slots.lock"))
+        logger.info(
+            f"Task runner pool configured with {pool_size} {mode} runner(s) and a queue of {max_pending} per pod"
+        )
+
+    def _read_slots(self) -> Dict[str, Any]:
+        """
+        The runner slots of the pod: the running and queued tasks (in order) along with the pid of the worker which owns
+        them, and the exponential moving average of the time a task occupies a runner
+        """
+        # the file is atomically replaced, so it can be read without the lock
+        try:
+            with open(self._slots_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"running": dict(), "queued": [], "avg_duration": TASK_DURATION_ESTIMATE}
+
+    @contextmanager
+    def _update_slots(self) -> Iterator[Dict[str, Any]]:
+        """The runner slots of the pod, written back once the block exits"""
+        with self._slots_lock:
+            slots = self._read_slots()
+            slots["running"] = {task_id: pid for task_id, pid in slots["running"].items() if _is_alive(pid)}
+            slots["queued"] = [[task_id, pid] for task_id, pid in slots["queued"] if _is_alive(pid)]
+            yield slots
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self._slots_path), prefix=".slots.", suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(slots, f)
+            os.replace(tmp_path, self._slots_path)
+
+    def _is_full(self, slots: Dict[str, Any]) -> bool:
+        # queued tasks which are about to take a free slot do not count against the queue
+        return len(slots["running"]) + len(slots["queued"]) >= self.pool_size + self.max_pending
+
+    def _get_executor(self) -> Executor:
+        # the executor is created lazily so that every (forked) worker process gets its own pool, which is as large as
+        # the pod's, since this worker might hold all the slots
+        if self._executor is None or self._pid != os.getpid():
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size, mp_context=multiprocessing.get_context("fork")
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="task-runner")
+            if self._pid != os.getpid():
+                self._pending, self._running, self._poller = OrderedDict(), dict(), None
+            self._pid = os.getpid()
+        return self._executor
+
+    def is_full(self) -> bool:
+        return self._is_full(self._read_slots())
+
+    def submit(self, task_id: str, fn: Callable[..., Any], *args: Any,
+               on_done: Optional[Callable[[], None]] = None) -> int:
+        """
+        Queue `fn(*args)` to be run for `task_id` and return its position in the queue (0 if it started right away).
+        `on_done` is called in this process once the task finished, also when it ran in a runner process, or once it
+        was cancelled while waiting for a runner.
+        """
+        with self._lock:
+            self._get_executor()
+            with self._update_slots() as slots:
+                if self._is_full(slots):
+                    raise TaskQueueFullException(self._retry_after(slots))
+                slots["queued"].append([task_id, os.getpid()])
+            self._pending[task_id] = (fn, args, on_done)
+            self._dispatch()
+            return self.queue_position(task_id) or 0
+
+    def _dispatch(self) -> None:
+        with self._lock:
+            if not self._pending:
+                return
+            with self._update_slots() as slots:
+                queued_ids = {task_id for task_id, _ in slots["queued"]}
+                # tasks of this worker cancelled by another one
+                dropped = [task_id for task_id in self._pending if task_id not in queued_ids]
+                # the first tasks of the queue take the free slots, those of other workers are started by their owner
+                started = [task_id for task_id, pid in slots["queued"][:self._n_free(slots)]
+                           if pid == os.getpid() and task_id in self._pending]
+                slots["queued"] = [entry for entry in slots["queued"] if entry[0] not in started]
+                for task_id in started:
+                    slots["running"][task_id] = os.getpid()
+            for task_id in dropped:
+                self._call_on_done(task_id, self._pending.pop(task_id)[2])
+            for task_id in started:
+                fn, args, on_done = self._pending.pop(task_id)
+                future = self._get_executor().submit(fn, *args)
+                self._running[task_id] = (future, time())
+                future.add_done_callback(partial(self._reap, task_id, on_done))
+            if self._pending and self._poller is None:
+                self._poller = threading.Thread(target=self._poll_slots, name="task-dispatcher", daemon=True)
+                self._poller.start()
+
+    def _poll_slots(self) -> None:
+        while True:
+            sleep(TASK_DISPATCH_INTERVAL)
+            with self._lock:
+                if not self._pending:
+                    self._poller = None
+                    return
+                self._dispatch()
+
+    def _reap(self, task_id: str, on_done: Optional[Callable[[], None]], future: Future) -> None:
+        with self._lock:
+            with self._update_slots() as slots:
+                if task_id in self._running and self._running[task_id][0] is future:
+                    _, started = self._running.pop(task_id)
+                    slots["avg_duration"] = 0.8 * slots["avg_duration"] + 0.2 * (time() - started)
+                if slots["running"].get(task_id) == os.getpid():
+                    del slots["running"][task_id]
+            self._dispatch()
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"{task_id}: task runner raised an unhandled exception: {future.exception()}")
+        self._call_on_done(task_id, on_done)
+
+    @staticmethod
+    def _call_on_done(task_id: str, on_done: Optional[Callable[[], None]]) -> None:
+        if on_done is None:
+            return
+        try:
+            on_done()
+        except Exception as e:
+            logger.error(f"{task_id}: done callback raised an exception: {e}")
+
+    def cancel(self, task_id: str) -> bool:
+        """
+        Remove a task which is still waiting for a runner from the queue, returns whether it was found. The task can
+        be owned by any worker of the pod, the owner drops it (and calls its `on_done`) at its next dispatch.
+        """
+        with self._lock:
+            with self._update_slots() as slots:
+                found = any(queued_id == task_id for queued_id, _ in slots["queued"])
+                slots["queued"] = [entry for entry in slots["queued"] if entry[0] != task_id]
+            pending = self._pending.pop(task_id, None)
+        if not found:
+            return False
+        if pending is not None:
+            self._call_on_done(task_id, pending[2])
+        return True
+
+    def _n_free(self, slots: Dict[str, Any]) -> int:
+        return max(self.pool_size - len(slots["running"]), 0)
+
+    def _queue_position(self, slots: Dict[str, Any], task_id: str) -> Optional[int]:
+        if task_id in slots["running"]:
+            return 0
+        n_free = self._n_free(slots)
+        for idx, (queued_id, _) in enumerate(slots["queued"]):
+            if queued_id == task_id:
+                # a task which gets one of the free slots is about to start
+                return max(idx + 1 - n_free, 0)
+        return None
+
+    def queue_position(self, task_id: str) -> Optional[int]:
+        """
+        1-based position of a waiting task in the queue of the pod, 0 for a task which is running (or about to) and
+        None if the task is unknown
+        """
+        return self._queue_position(self._read_slots(), task_id)
+
+    def next_queue_position(self) -> int:
+        """The queue position a task submitted right now would be assigned"""
+        slots = self._read_slots()
+        return max(len(slots["queued"]) + 1 - self._n_free(slots), 0)
+
+    @property
+    def avg_duration(self) -> float:
+        """Exponential moving average of the time (in seconds) a task occupies a runner of the pod"""
+        return self._read_slots()["avg_duration"]
+
+    def estimate_wait(self, queue_position: int) -> float:
+        """Conservative estimate (in seconds) of how long a task at `queue_position` waits for a runner"""
+        if queue_position <= 0:
+            return 0.0
+        return math.ceil(queue_position / self.pool_size) * self.avg_duration
+
+    def _retry_after(self, slots: Dict[str, Any]) -> int:
+        return max(1, math.ceil(slots["avg_duration"] / self.pool_size))
+
+    def retry_after(self) -> int:
+        """Seconds after which a runner is expected to free up, and so a rejected task could be admitted"""
+        return self._retry_after(self._read_slots())
+
+    @property
+    def n_tasks(self) -> int:
+        """Number of tasks owned by this worker which have not finished yet (running or waiting for a runner)"""
+        with self._lock:
+            return len(self._running) + len(self._pending)
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            executor = self._executor if self._pid == os.getpid() else None
+            self._executor = None
+            if self._pending:
+                # the queued tasks of this worker are never going to run
+                with self._update_slots() as slots:
+                    slots["queued"] = [entry for entry in slots["queued"] if entry[0] not in self._pending]
+            self._pending, self._running = OrderedDict(), dict()
+        # outside of the lock, which the done callbacks of the running tasks acquire
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -1,16 +1,40 @@
 import os
 import re
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 import logging
 
 import jsonlines
 import requests
+from requests.adapters import HTTPAdapter
 from fastapi import HTTPException
 from google.cloud import storage
 
+from tool.deadline import call_timeout
+from tool.metrics import timed_dependency
+
 S2_APIKEY = os.getenv("S2_API_KEY", "")
 S2_HEADERS = {"x-api-key": S2_APIKEY}
 S2_API_BASE_URL = "https://api.semanticscholar.org/graph/v1/"
+# Max number of pooled (keep-alive) connections to the S2 API per process
+S2_POOL_SIZE = int(os.getenv("S2_POOL_SIZE", 16))
+# Max seconds an S2 API request may take, less once the deadline of its task is closer than that
+S2_TIMEOUT = float(os.getenv("S2_TIMEOUT", 30))
+
+_s2_session: Optional[requests.Session] = None
+_s2_session_pid: Optional[int] = None
+
+
+def get_s2_session() -> requests.Session:
+    """Process-wide session to the S2 API, so that connections are reused across calls and threads"""
+    global _s2_session, _s2_session_pid
+    # pooled connections must not be shared with forked processes
+    if _s2_session is None or _s2_session_pid != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=S2_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.headers.update(S2_HEADERS)
+        _s2_session, _s2_session_pid = session, os.getpid()
+    return _s2_session
 
 
 def load_jsonlines(file):
@@ -31,8 +55,10 @@ def query_s2_api(
     method="get",
 ):
     url = S2_API_BASE_URL + end_pt
-    req_method = requests.get if method == "get" else requests.post
-    response = req_method(url, headers=S2_HEADERS, params=params, json=payload)
+    session = get_s2_session()
+    req_method = session.get if method == "get" else session.post
+    with timed_dependency(f"s2_{end_pt.replace('/', '_')}"):
+        response = req_method(url, params=params, json=payload, timeout=call_timeout(S2_TIMEOUT))
     if response.status_code != 200:
         logging.exception(f"S2 API request to end point {end_pt} failed with status code {response.status_code}")
         raise HTTPException(
@@ -69,10 +95,11 @@ def extract_citations(text):
 
 def push_to_gcs(text: str, bucket: str, file_path: str):
     try:
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket)
-        blob = bucket.blob(file_path)
-        blob.upload_from_string(text)
+        with timed_dependency("gcs"):
+            storage_client = storage.Client()
+            bucket = storage_client.bucket(bucket)
+            blob = bucket.blob(file_path)
+            blob.upload_from_string(text)
         logging.info(f"Pushed event trace: {file_path} to GCS")
     except Exception as e:
         logging.info(f"Error pushing {file_path} to GCS: {e}")
\ No newline at end of file
@@ -0,0 +1,117 @@
+import logging
+import os
+import threading
+from time import time
+from typing import Callable, Dict, Optional, Tuple
+
+from filelock import FileLock, Timeout
+
+logger = logging.getLogger(__name__)
+
+# Idle time (in seconds) after which the Modal deployments scale down, see the scaledown_window of their apps
+LLM_SCALEDOWN_WINDOW = float(os.getenv("LLM_SCALEDOWN_WINDOW", 5 * 60))
+RERANKER_SCALEDOWN_WINDOW = float(os.getenv("RERANKER_SCALEDOWN_WINDOW", 10 * 60))
+# How often (in seconds) the background thread checks the dependencies and pings the idle ones, 0 disables it
+KEEP_WARM_INTERVAL = float(os.getenv("KEEP_WARM_INTERVAL", 0))
+# The background thread pings a dependency once it has been idle for this fraction of its scaledown window,
+# so that it is kept warm instead of being woken up
+KEEP_WARM_IDLE_FRACTION = 0.8
+
+
+class WarmStateTracker:
+    """
+    Tracks when each remote dependency last responded successfully, and sends it a minimal ping only when it has been
+    idle for longer than its scaledown window, i.e. when it may be cold. Pings run in the background, and concurrent
+    requests to warm up the same dependency share a single ping.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._pings: Dict[str, Tuple[Callable[[], None], float]] = dict()
+        self._last_ok: Dict[str, float] = dict()
+        self._in_flight: Dict[str, threading.Event] = dict()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = os.getpid()
+
+    def register(self, dependency: str, ping: Callable[[], None], scaledown_window: float) -> None:
+        with self._lock:
+            self._pings[dependency] = (ping, scaledown_window)
+
+    def mark_warm(self, dependency: str) -> None:
+        """Record that the dependency just responded successfully"""
+        with self._lock:
+            self._last_ok[dependency] = time()
+
+    def is_warm(self, dependency: str, idle_fraction: float = 1.0) -> bool:
+        with self._lock:
+            _, scaledown_window = self._pings[dependency]
+            return time() - self._last_ok.get(dependency, 0.0) < idle_fraction * scaledown_window
+
+    def ensure_warm(self, dependency: str, idle_fraction: float = 1.0) -> Optional[threading.Event]:
+        """
+        Ping the dependency in the background if it may be cold. Returns an event which is set once the ping
+        completes, or None if the dependency is warm.
+        """
+        if self.is_warm(dependency, idle_fraction):
+            return None
+        with self._lock:
+            if self._pid != os.getpid():
+                # pings in flight in the parent of a forked (task runner) process never complete in the child
+                self._in_flight, self._pid = dict(), os.getpid()
+            if (done := self._in_flight.get(dependency)) is not None:
+                return done
+            done = self._in_flight[dependency] = threading.Event()
+        threading.Thread(target=self._ping, args=(dependency, done), name=f"warm-{dependency}", daemon=True).start()
+        return done
+
+    def _ping(self, dependency: str, done: threading.Event) -> None:
+        ping, _ = self._pings[dependency]
+        logger.info(f"Waking {dependency} for a warm start")
+        try:
+            ping()
+            self.mark_warm(dependency)
+        except Exception as e:
+            logger.warning(f"Warm-up ping to {dependency} failed: {e}")
+        finally:
+            with self._lock:
+                if self._in_flight.get(dependency) is done:
+                    del self._in_flight[dependency]
+            done.set()
+
+    def _keep_warm(self, interval: float, leader_lock: Optional[FileLock]) -> None:
+        try:
+            while not self._stop.wait(interval):
+                if leader_lock is not None and not leader_lock.is_locked:
+                    try:
+                        leader_lock.acquire(timeout=0)
+                        logger.info("Keeping the dependencies warm on behalf of all workers")
+                    except Timeout:
+                        # another worker is the leader, this one takes over if that worker exits
+                        continue
+                for dependency in list(self._pings):
+                    self.ensure_warm(dependency, KEEP_WARM_IDLE_FRACTION)
+        finally:
+            if leader_lock is not None and leader_lock.is_locked:
+                leader_lock.release()
+
+    def start_keep_warm(self, interval: float = KEEP_WARM_INTERVAL, lock_path: Optional[str] = None) -> None:
+        """
+        Keep the dependencies warm in the background, e.g. through off-peak hours.
+        Every gunicorn worker starts the thread, but with a `lock_path` only the worker holding the lock pings. It only
+        sees the calls of its own process, so it may ping a deployment which other workers kept busy, which is cheap.
+        """
+        if interval > 0 and (self._thread is None or not self._thread.is_alive()):
+            self._stop.clear()
+            leader_lock = FileLock(lock_path) if lock_path else None
+            self._thread = threading.Thread(
+                target=self._keep_warm, args=(interval, leader_lock), name="keep-warm", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+# shared by all the pipelines of a process
+warm_state = WarmStateTracker()